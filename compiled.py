@@ -0,0 +1,371 @@
+'''
+This file contains a compact compiled form of a CSP model, for sending
+models to worker processes (or storing them) without pickling the Variable
+and Constraint objects and their tables of tuples.
+
+1. compile_model(csp, board=None) and compile_kenken(kenken_grid, implied=False)
+    - Compile a CSP (e.g. the output of kenken_csp_model) into a
+      CompiledModel. compile_kenken builds the KenKen model first.
+
+2. CompiledModel object
+    - The model as flat arrays of integers: variables and constraints are
+      numbered by their ids (their index in csp.vars and csp.cons).
+    - to_bytes() / from_bytes(data) convert it to and from a binary string;
+      data may be any buffer, e.g. an mmap. save(path) writes it to a file
+      and load_model(path) maps the file back. Pickling a CompiledModel
+      pickles its binary form, so it can be passed to a multiprocessing pool
+      as is.
+    - rehydrate() builds a fresh (csp, board) pair, ready for bt_search, as
+      returned by kenken_csp_model. board is None for models compiled without
+      one.
+
+The arrays are:
+    dom_start, dom_vals      the permanent domain of variable i is
+                             dom_vals[dom_start[i]:dom_start[i+1]]
+    kinds, flags             the kind of every constraint (KIND_* below) and
+                             its flags (FLAG_ALLDIFF, FLAG_EXACT)
+    scope_start, scope_ids   the variable ids of the scope of constraint c
+    param_start, params      the parameters of constraint c: the index of its
+                             table for tables and MDDs, target and
+                             coefficients for sums, target for products
+    table_start, table_vals  the packed tables: for a table of tuples its
+                             arity followed by the tuples, for an MDD its
+                             number of layers, the number of edges of every
+                             layer and then the edges as (u, val, w) triples
+    var_cons, neighbours     the adjacency of the CSP (see CSP.var_cons and
+                             CSP.var_neighbours): for every variable, the
+                             number of its constraints followed by their
+                             ids, and likewise for its neighbours
+    board                    the number of rows, followed by the variable ids
+                             of the board row by row
+
+Identical tables are stored once (all the row and column tables of a board
+are the same table of permutations). Rehydrated tables are kept in a
+per-process cache keyed by a digest of their content, shared by the
+constraints of every model rehydrated afterwards, so that a worker only
+builds the dictionaries of the tables of a board size once. Only the
+permanent domains are compiled, not current domains or assignments, and
+values, targets and coefficients must be integers.
+'''
+
+import array
+import collections
+import hashlib
+import mmap
+import struct
+import sys
+
+from cspbase import CSP, Variable, Constraint, AllDiffConstraint, \
+                    NotEqualConstraint, SumConstraint, ProductConstraint, \
+                    MDDConstraint
+from kenken_csp import kenken_csp_model
+
+KIND_TABLE    = 0
+KIND_ALLDIFF  = 1
+KIND_NOTEQUAL = 2
+KIND_SUM      = 3
+KIND_PRODUCT  = 4
+KIND_MDD      = 5
+
+KINDS = {Constraint: KIND_TABLE, AllDiffConstraint: KIND_ALLDIFF,
+         NotEqualConstraint: KIND_NOTEQUAL, SumConstraint: KIND_SUM,
+         ProductConstraint: KIND_PRODUCT, MDDConstraint: KIND_MDD}
+
+FLAG_ALLDIFF = 1 #the alldiff flag of a table constraint
+FLAG_EXACT   = 2 #exact propagation of a sum or product
+
+MAGIC  = b'KKCM\x01'
+ARRAYS = ('dom_start', 'dom_vals', 'kinds', 'flags', 'scope_start',
+          'scope_ids', 'param_start', 'params', 'table_start', 'table_vals',
+          'var_cons', 'neighbours', 'board')
+DIGEST_SIZE = 16
+
+TABLE_CACHE_SIZE = 256 #rehydrated tables kept per process
+TABLE_CACHE = collections.OrderedDict() #digest -> tables, LRU first
+
+def int_array(values=()):
+    '''Returns an array of 32-bit signed integers'''
+    return array.array('i', values)
+
+class CompiledModel:
+    '''
+    Class for a CSP model compiled into flat integer arrays (see the file
+    header). Build it with compile_model, compile_kenken or from_bytes.
+    '''
+
+    def __init__(self, name, var_names, con_names, digests, **arrays):
+        self.name = name
+        self.var_names = var_names
+        self.con_names = con_names
+        self.digests = digests #digest of every table
+        for key in ARRAYS:
+            setattr(self, key, arrays[key])
+
+    def n_vars(self):
+        '''Return the number of variables'''
+        return len(self.dom_start) - 1
+
+    def n_cons(self):
+        '''Return the number of constraints'''
+        return len(self.kinds)
+
+    def to_bytes(self):
+        '''
+        Return the model as bytes: the magic string, the names, the table
+        digests, then every array, each preceded by its length.
+        '''
+        names = '\n'.join([self.name] + self.var_names +
+                          self.con_names).encode('utf-8')
+        parts = [MAGIC, struct.pack('<III', len(self.var_names),
+                                    len(self.con_names), len(names)),
+                 names, struct.pack('<I', len(self.digests))]
+        parts.extend(self.digests)
+        for key in ARRAYS:
+            values = getattr(self, key)
+            if sys.byteorder == 'big':
+                values = int_array(values)
+                values.byteswap()
+            parts.append(struct.pack('<I', len(values)))
+            parts.append(values.tobytes())
+        return b''.join(parts)
+
+    @staticmethod
+    def from_bytes(data):
+        '''
+        Return the CompiledModel of bytes made by to_bytes. data may be any
+        buffer (bytes, memoryview, mmap).
+        '''
+        with memoryview(data) as view:
+            return CompiledModel.read(view)
+
+    @staticmethod
+    def read(view):
+        '''Internal routine. from_bytes over a memoryview'''
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("Not a compiled model")
+        pos = len(MAGIC)
+        n_vars, n_cons, size = struct.unpack_from('<III', view, pos)
+        pos += 12
+        names = str(view[pos:pos + size], 'utf-8').split('\n')
+        pos += size
+        n_tables, = struct.unpack_from('<I', view, pos)
+        pos += 4
+        digests = [bytes(view[pos + k*DIGEST_SIZE:pos + (k+1)*DIGEST_SIZE])
+                   for k in range(n_tables)]
+        pos += n_tables * DIGEST_SIZE
+        arrays = dict()
+        for key in ARRAYS:
+            length, = struct.unpack_from('<I', view, pos)
+            pos += 4
+            values = int_array()
+            values.frombytes(view[pos:pos + 4*length])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            pos += 4*length
+            arrays[key] = values
+        return CompiledModel(names[0], names[1:n_vars+1],
+                             names[n_vars+1:n_vars+1+n_cons], digests, **arrays)
+
+    def __reduce__(self):
+        #pickle the binary form rather than the arrays and names
+        return (CompiledModel.from_bytes, (self.to_bytes(),))
+
+    def save(self, path):
+        '''Write the model to the file path'''
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    def table(self, k, kind):
+        '''
+        Internal routine. Return table k, rehydrated: the (sat_tuples,
+        sup_tuples) pair of a table of tuples, or the (edges, arcs) pair of
+        an MDD, from the per-process cache if possible.
+        '''
+        digest = self.digests[k]
+        tables = TABLE_CACHE.get(digest)
+        if tables is not None:
+            TABLE_CACHE.move_to_end(digest)
+            return tables
+        vals = self.table_vals[self.table_start[k]:self.table_start[k+1]]
+        if kind == KIND_MDD:
+            n_layers = vals[0]
+            edges = []
+            pos = 1 + n_layers
+            for i in range(n_layers):
+                end = pos + 3*vals[1 + i]
+                edges.append([tuple(vals[j:j+3]) for j in range(pos, end, 3)])
+                pos = end
+            tables = (edges, [{(u, val): w for u, val, w in layer}
+                              for layer in edges])
+        else:
+            arity = vals[0]
+            c = Constraint(None, [None] * arity)
+            c.add_satisfying_tuples(tuple(vals[j:j+arity])
+                                    for j in range(1, len(vals), arity))
+            tables = (c.sat_tuples, c.sup_tuples)
+        TABLE_CACHE[digest] = tables
+        if len(TABLE_CACHE) > TABLE_CACHE_SIZE:
+            TABLE_CACHE.popitem(last=False)
+        return tables
+
+    def rehydrate(self):
+        '''
+        Return a fresh (csp, board) pair for the model. The constraints share
+        the rehydrated tables (see the file header), so no tuples may be
+        added to them.
+        '''
+        dom_start, dom_vals = self.dom_start, self.dom_vals
+        domains = dict() #(start, end) -> list of values
+        variables = []
+        for i, name in enumerate(self.var_names):
+            key = (dom_start[i], dom_start[i+1])
+            if key not in domains:
+                domains[key] = dom_vals[key[0]:key[1]].tolist()
+            variables.append(Variable(name, domains[key]))
+        csp = CSP(self.name, variables)
+
+        scope_start, scope_ids = self.scope_start, self.scope_ids
+        param_start, params = self.param_start, self.params
+        constraints = []
+        for c_id, name in enumerate(self.con_names):
+            kind = self.kinds[c_id]
+            flags = self.flags[c_id]
+            scope = [variables[i] for i in
+                     scope_ids[scope_start[c_id]:scope_start[c_id+1]]]
+            par = params[param_start[c_id]:param_start[c_id+1]]
+            if kind == KIND_TABLE:
+                c = Constraint(name, scope)
+                c.sat_tuples, c.sup_tuples = self.table(par[0], kind)
+                if flags & FLAG_ALLDIFF:
+                    c.alldiff = True
+            elif kind == KIND_ALLDIFF:
+                c = AllDiffConstraint(name, scope)
+            elif kind == KIND_NOTEQUAL:
+                c = NotEqualConstraint(name, scope)
+            elif kind == KIND_SUM:
+                c = SumConstraint(name, scope, par[0], par[1:].tolist(),
+                                  exact=bool(flags & FLAG_EXACT))
+            elif kind == KIND_PRODUCT:
+                c = ProductConstraint(name, scope, par[0],
+                                      exact=bool(flags & FLAG_EXACT))
+            else:
+                c = MDDConstraint(name, scope)
+                c.edges, c.arcs = self.table(par[0], kind)
+            c.id = c_id
+            constraints.append(c)
+
+        #the adjacency is compiled too, rather than rebuilt by add_constraint
+        csp.cons = constraints
+        var_cons = []
+        neighbours = []
+        for ids, items, adjacency in ((self.var_cons, constraints, var_cons),
+                                      (self.neighbours, variables, neighbours)):
+            pos = 0
+            for i in range(len(variables)):
+                end = pos + 1 + ids[pos]
+                adjacency.append(tuple([items[k] for k in ids[pos+1:end]]))
+                pos = end
+        csp.var_cons = var_cons
+        csp.var_neighbours = neighbours
+
+        board = None
+        if self.board:
+            rows = self.board[0]
+            ids = self.board[1:]
+            width = len(ids) // rows
+            board = [[variables[i] for i in ids[r*width:(r+1)*width]]
+                     for r in range(rows)]
+        return csp, board
+
+def load_model(path):
+    '''
+    Return the CompiledModel saved in the file path. The file is memory
+    mapped, and only the arrays are copied out of it.
+    '''
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return CompiledModel.from_bytes(data)
+
+def compile_model(csp, board=None):
+    '''
+    Compile csp (and optionally its board, a list of lists of its Variables)
+    into a CompiledModel. Raises TypeError for constraints of other classes
+    than those of cspbase.
+    '''
+    csp.reindex()
+    arrays = {key: int_array() for key in ARRAYS}
+    dom_start, dom_vals = arrays['dom_start'], arrays['dom_vals']
+    dom_start.append(0)
+    for var in csp.vars:
+        dom_vals.extend(var.dom)
+        dom_start.append(len(dom_vals))
+
+    scope_start, param_start = arrays['scope_start'], arrays['param_start']
+    table_start, table_vals = arrays['table_start'], arrays['table_vals']
+    scope_start.append(0)
+    param_start.append(0)
+    table_start.append(0)
+    tables = dict() #digest -> table index
+    digests = []
+    for c in csp.cons:
+        kind = KINDS.get(type(c))
+        if kind is None:
+            raise TypeError("Cannot compile constraint {} of class {}".format(
+                c.name, type(c).__name__))
+        flags = 0
+        if kind == KIND_TABLE and c.alldiff:
+            flags |= FLAG_ALLDIFF
+        if kind in (KIND_SUM, KIND_PRODUCT) and c.exact:
+            flags |= FLAG_EXACT
+        arrays['kinds'].append(kind)
+        arrays['flags'].append(flags)
+        arrays['scope_ids'].extend(var.id for var in c.scope)
+        scope_start.append(len(arrays['scope_ids']))
+
+        if kind in (KIND_TABLE, KIND_MDD):
+            if kind == KIND_TABLE:
+                packed = int_array([len(c.scope)])
+                for t in c.sat_tuples:
+                    packed.extend(t)
+            else:
+                packed = int_array([len(c.edges)])
+                packed.extend(len(layer) for layer in c.edges)
+                for layer in c.edges:
+                    for edge in layer:
+                        packed.extend(edge)
+            digest = hashlib.blake2b(bytes([kind]) + packed.tobytes(),
+                                     digest_size=DIGEST_SIZE).digest()
+            if digest not in tables:
+                tables[digest] = len(digests)
+                digests.append(digest)
+                table_vals.extend(packed)
+                table_start.append(len(table_vals))
+            arrays['params'].append(tables[digest])
+        elif kind == KIND_SUM:
+            arrays['params'].append(c.target)
+            arrays['params'].extend(c.coeffs)
+        elif kind == KIND_PRODUCT:
+            arrays['params'].append(c.target)
+        param_start.append(len(arrays['params']))
+
+    for var in csp.vars:
+        cons = csp.get_cons_with_var(var)
+        arrays['var_cons'].append(len(cons))
+        arrays['var_cons'].extend(c.id for c in cons)
+        nbrs = csp.get_neighbours(var)
+        arrays['neighbours'].append(len(nbrs))
+        arrays['neighbours'].extend(u.id for u in nbrs)
+
+    if board is not None:
+        arrays['board'].append(len(board))
+        for row in board:
+            arrays['board'].extend(var.id for var in row)
+
+    return CompiledModel(csp.name, [var.name for var in csp.vars],
+                         [c.name for c in csp.cons], digests, **arrays)
+
+def compile_kenken(kenken_grid, implied=False):
+    '''
+    Returns the CompiledModel of kenken_csp_model(kenken_grid, implied).
+    '''
+    return compile_model(*kenken_csp_model(kenken_grid, implied))
@@ -13,6 +13,12 @@ Constraint Satisfaction Routines and Objects
 2. Constraint object
     - This class allows one to define constraints specified by tables of 
       satisfying assignments.
+    - AllDiffConstraint and NotEqualConstraint are intensional all-different 
+      and binary not-equal constraints that need no table. SumConstraint and 
+      ProductConstraint are intensional (weighted) sum and product 
+      constraints propagated on bounds, or exactly (exact=True) by dynamic 
+      programming over partial results. 
+      MDDConstraint compresses a table into a multi-valued decision diagram.
     - On initialization, the variables that the constraint is over is specified 
       (i.e. the scope of the constraint). This must be an ORDERED list of 
       variables. This list of variables cannot be changed once the constraint 
@@ -39,10 +45,66 @@ Constraint Satisfaction Routines and Objects
     - takes a propagator and a CSP as arguments
     - Executes backtracking, forward-checking or GAC, depending on the 
       propagator argument.
+    - Returns a SolveResult object.
+    - bt_search_async is a coroutine running the same search in slices, 
+      giving control back to the asyncio event loop between them; it can be 
+      cancelled or timed out, which undoes the search. bt_search_steps is 
+      the underlying step generator.
+    - set_limits bounds the search (nodes, failures, time, trail size): a 
+      stopped bt_search returns a TIMEOUT result, and bt_solutions and 
+      bt_extend return None; set_transposition_table attaches a table of failed states (see 
+      transposition.py) that lets the search skip repeated dead-ends.
+    - checkpoint() captures the position of a running search and 
+      set_checkpoint saves it to disk at intervals; bt_search(resume=...) 
+      continues a search from a checkpoint (see load_checkpoint) over the 
+      same model.
+    - bt_extend searches for solutions extending the current assignment and 
+      domains, leaving them as they were (see session.py).
+
+6. SolveResult object
+    - Compact record of one bt_search run: status, the solution as a flat 
+      list of values (in the order the variables were added to the CSP, 
+      i.e. row by row for the KenKen models), the search statistics, CPU 
+      time and optionally the time spent in each stage of the search.
 '''
 
 import time
 import functools
+import copy
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import zlib
+
+from searchtrace import TRACE_ROOT, TRACE_ASSIGN, TRACE_FAIL, TRACE_UNDO, \
+                        TRACE_SOLUTION
+
+#domain events, as bit flags (see Constraint.events)
+EVENT_ASSIGNED = 1 #the domain was reduced to a single value
+EVENT_BOUNDS   = 2 #the smallest or the largest value was removed
+EVENT_REMOVED  = 4 #some value was removed
+EVENT_ALL      = EVENT_ASSIGNED | EVENT_BOUNDS | EVENT_REMOVED
+
+#propagation priorities (see Constraint.priority), cheapest first
+PRIORITY_UNARY  = 0 #not-equal, singletons
+PRIORITY_BOUNDS = 1 #bounds reasoning
+PRIORITY_DP     = 2 #dynamic programming over partial sums/products
+PRIORITY_TABLE  = 3 #tables and MDDs
+PRIORITY_GLOBAL = 4 #matching-based all-different
+N_PRIORITIES    = 5
+
+def exhaust(steps):
+    '''
+    Run a step generator (e.g. BT.bt_search_steps) to the end and return its 
+    return value.
+    '''
+    try:
+        while True:
+            next(steps)
+    except StopIteration as done:
+        return done.value
 
 class Variable: 
     '''
@@ -92,6 +154,21 @@ class Variable:
         self.dom           = list(domain)         # Make a copy of passed domain
         self.curdom        = [True] * len(domain) # Using list
         self.assignedValue = None                 # For bt_search
+        self.id            = None                 # Index in csp.vars, set by CSP
+
+    def copy(self):
+        '''
+        Return an unassigned copy of the variable with a fully restored current 
+        domain. The copy shares the (permanent) domain list with the original, 
+        so no domain values may be added to either afterwards.
+        '''
+        var = Variable.__new__(Variable)
+        var.name          = self.name
+        var.dom           = self.dom
+        var.curdom        = [True] * len(self.dom)
+        var.assignedValue = None
+        var.id            = None
+        return var
 
     def add_domain_values(self, values):
         '''
@@ -211,8 +288,23 @@ class Constraint:
     variables.  This ordering is used when calling the satisfied function which 
     tests if an assignment to the variables in the constraint's scope satisfies 
     the constraint
+
+    The alldiff flag tells propagators that the constraint requires its scope
+    to take pairwise different values, whatever its representation (e.g. the
+    row and column tables of the KenKen models set it).
+
+    The propagation engine (see propagators.propagate) revises a constraint
+    when one of the domain events in its events mask happens to a variable of
+    its scope, cheapest priority first. A constraint is idempotent if revising
+    it twice in a row never prunes anything the second time; the engine does
+    not wake such a constraint on its own prunings.
     '''
 
+    alldiff = False 
+    events = EVENT_REMOVED 
+    priority = PRIORITY_TABLE 
+    idempotent = True
+
     def __init__(self, name, scope): 
         '''
         Create a constraint object, specify the constraint name (a string) and 
@@ -231,11 +323,17 @@ class Constraint:
         self.scope = list(scope)
         self.name = name
         self.sat_tuples = dict()
+        self.id = None #index in csp.cons, set by CSP.add_constraint
 
         # The next object data item 'sup_tuples' will be used to help support 
         # GAC propgation. It allows access to a list of satisfying tuples that 
-        # contain a particular variable/value pair.
-        self.sup_tuples = dict()
+        # contain a particular variable/value pair: sup_tuples[i][val] holds 
+        # the tuples giving val to the i-th variable of the scope (see 
+        # var_pos). Indexing by position rather than by variable lets copies 
+        # of the constraint share it, and avoids building and hashing a 
+        # (variable, value) key for every lookup.
+        self.sup_tuples = [dict() for var in self.scope]
+        self.var_pos = {var: i for i, var in enumerate(self.scope)}
 
     def add_satisfying_tuples(self, tuples):
         '''
@@ -249,10 +347,23 @@ class Constraint:
 
             #now put t in as a support for all of the variable values in it
             for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var,val) in self.sup_tuples:
-                    self.sup_tuples[(var,val)] = []
-                self.sup_tuples[(var,val)].append(t)
+                sups = self.sup_tuples[i]
+                if not val in sups:
+                    sups[val] = []
+                sups[val].append(t)
+
+    def copy(self, var_map):
+        '''
+        Return a copy of the constraint over the variables var_map[v] for each 
+        variable v of the scope. The copy shares the tables of satisfying 
+        tuples with the original, so no tuples may be added to either 
+        afterwards.
+        '''
+        c = copy.copy(self)
+        c.scope = [var_map[var] for var in self.scope]
+        c.var_pos = {var: i for i, var in enumerate(c.scope)}
+        c.id = None
+        return c
 
     def get_scope(self):
         '''Get the list of variables that the constraint is over'''
@@ -295,8 +406,9 @@ class Constraint:
         assignments satisfying the constraint where each value is still in the 
         corresponding variables current domain.
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
+        sups = self.sup_tuples[self.var_pos[var]].get(val)
+        if sups:
+            for t in sups:
                 if self.tuple_is_valid(t):
                     return True
         return False
@@ -311,14 +423,643 @@ class Constraint:
                 return False
         return True
 
+    def unsupported(self):
+        '''
+        Generate the (var, val) pairs of the scope whose value has no 
+        supporting tuple. Pairs are generated lazily, so values pruned by the 
+        caller in the meantime are taken into account. Used by prop_GAC; 
+        intensional constraints override it with a specialised algorithm.
+        '''
+        for var in self.scope:
+            for val in var.cur_domain():
+                if not self.has_support(var, val):
+                    yield var, val
+
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class AllDiffConstraint(Constraint):
+    '''
+    Class for n-ary all-different constraints represented intensionally, i.e. 
+    without a table of satisfying tuples. Usable on boards whose n! row 
+    permutations are too many to enumerate.
+
+    Support is computed with Regin's matching algorithm: a value has support 
+    iff the edge (var, val) belongs to some maximum matching of the 
+    variable-value graph of the current domains.
+    '''
+
+    alldiff = True 
+    priority = PRIORITY_GLOBAL
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported: the constraint is defined by its scope alone'''
+        raise TypeError("AllDiffConstraint {} has no tuple table".format(
+            self.name))
+
+    def check(self, vals):
+        '''Return True iff all values are different'''
+        return len(set(vals)) == len(vals)
+
+    def has_support(self, var, val):
+        '''Test if var = val can be extended to all different values'''
+        if not var.in_cur_domain(val):
+            return False
+        return (var, val) not in set(self.unsupported())
+
+    def unsupported(self):
+        '''
+        Return the list of (var, val) pairs of the current domains that are in 
+        no maximum matching. If no matching covers every variable, the 
+        constraint cannot be satisfied and every value of the unassigned 
+        variables is returned.
+        '''
+        scope = self.scope
+        k = len(scope)
+        doms = [var.cur_domain() for var in scope]
+
+        #maximum matching by augmenting paths
+        match_val = dict() #val -> index of var matched to it
+        match_var = [None] * k
+        def augment(i, seen):
+            for val in doms[i]:
+                if val in seen:
+                    continue
+                seen.add(val)
+                if val not in match_val or augment(match_val[val], seen):
+                    match_val[val] = i
+                    match_var[i] = val
+                    return True
+            return False
+        for i in range(k):
+            if not augment(i, set()):
+                return [(scope[j], val) for j in range(k) 
+                        if not scope[j].is_assigned() for val in doms[j]]
+
+        #directed graph: var i -> its matched value, value -> vars it is in 
+        #the domain of (non-matching edges). Nodes are ('x', i) and ('v', val)
+        succ = dict()
+        for i in range(k):
+            succ[('x', i)] = [('v', match_var[i])]
+        for i in range(k):
+            for val in doms[i]:
+                if match_var[i] != val:
+                    succ.setdefault(('v', val), []).append(('x', i))
+        vals = set(val for dom in doms for val in dom)
+        for val in vals:
+            succ.setdefault(('v', val), [])
+
+        #edges on an alternating path from a free value are supported
+        free = [('v', val) for val in vals if val not in match_val]
+        reached = set(free)
+        stack = list(free)
+        while stack:
+            node = stack.pop()
+            for nxt in succ[node]:
+                if nxt not in reached:
+                    reached.add(nxt)
+                    stack.append(nxt)
+
+        #edges inside a strongly connected component are supported (Tarjan)
+        index = dict()
+        low = dict()
+        comp = dict()
+        on_stack = set()
+        stack = []
+        counter = [0]
+        def strongconnect(node):
+            index[node] = low[node] = counter[0]
+            counter[0] += 1
+            stack.append(node)
+            on_stack.add(node)
+            for nxt in succ[node]:
+                if nxt not in index:
+                    strongconnect(nxt)
+                    low[node] = min(low[node], low[nxt])
+                elif nxt in on_stack:
+                    low[node] = min(low[node], index[nxt])
+            if low[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    comp[member] = node
+                    if member == node:
+                        break
+        for node in succ:
+            if node not in index:
+                strongconnect(node)
+
+        pairs = []
+        for i in range(k):
+            x = ('x', i)
+            for val in doms[i]:
+                v = ('v', val)
+                if match_var[i] == val or v in reached or comp[v] == comp[x]:
+                    continue
+                pairs.append((scope[i], val))
+        return pairs
+
+class NotEqualConstraint(Constraint):
+    '''
+    Class for binary not-equal constraints x != y represented intensionally,  
+    i.e. without a table of the pairs of different values. 
+
+    Only a fixed value has consequences: when one side's current domain is a  
+    single value, that value is unsupported on the other side.
+    '''
+
+    alldiff = True
+    events = EVENT_ASSIGNED
+    priority = PRIORITY_UNARY
+
+    def __init__(self, name, scope):
+        if len(scope) != 2:
+            raise ValueError("NotEqualConstraint {} needs a scope of 2 "
+                             "variables".format(name))
+        Constraint.__init__(self, name, scope)
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported: the constraint is defined by its scope alone'''
+        raise TypeError("NotEqualConstraint {} has no tuple table".format(
+            self.name))
+
+    def check(self, vals):
+        '''Return True iff the two values are different'''
+        return vals[0] != vals[1]
+
+    def has_support(self, var, val):
+        '''Test if the other variable has a current value other than val'''
+        if not var.in_cur_domain(val):
+            return False
+        other = self.scope[1 - self.var_pos[var]]
+        dom = other.cur_domain()
+        return len(dom) > 1 or (len(dom) == 1 and dom[0] != val)
+
+    def unsupported(self):
+        '''
+        Return the (var, val) pairs where val is the only current value of  
+        the other variable.
+        '''
+        x, y = self.scope
+        pairs = []
+        if x.cur_domain_size() == 1:
+            val = x.cur_domain()[0]
+            if y.in_cur_domain(val):
+                pairs.append((y, val))
+        if y.cur_domain_size() == 1:
+            val = y.cur_domain()[0]
+            if x.in_cur_domain(val):
+                pairs.append((x, val))
+        return pairs
+
+class SumConstraint(Constraint):
+    '''
+    Class for intensional linear constraints sum(coeffs[i] * scope[i]) == 
+    target over integer variables, with coefficients defaulting to 1.
+
+    By default propagation is bounds-based: a value is supported if the 
+    target minus its contribution lies between the smallest and the largest 
+    sum the other variables can still make. If exact is True, support is 
+    exact (GAC): it is computed by dynamic programming over the partial sums 
+    reachable from the left and from the right of the scope, without 
+    enumerating combinations.
+    '''
+
+    def __init__(self, name, scope, target, coeffs=None, exact=False):
+        Constraint.__init__(self, name, scope)
+        self.target = target
+        self.coeffs = list(coeffs) if coeffs is not None else [1] * len(scope)
+        self.exact = exact
+        if exact:
+            self.priority = PRIORITY_DP
+        else:
+            #bounds reasoning only looks at the bounds of the other variables
+            self.events = EVENT_BOUNDS
+            self.priority = PRIORITY_BOUNDS
+            self.idempotent = False
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported: the constraint is defined by its target'''
+        raise TypeError("SumConstraint {} has no tuple table".format(self.name))
+
+    def check(self, vals):
+        '''Return True iff the weighted sum of vals is the target'''
+        return sum(a * v for a, v in zip(self.coeffs, vals)) == self.target
+
+    def bounds(self):
+        '''
+        Return the lists of the smallest and largest contribution of each 
+        variable of the scope given its current domain.
+        '''
+        lows = []
+        highs = []
+        for a, var in zip(self.coeffs, self.scope):
+            dom = var.cur_domain()
+            if not dom:
+                return None, None
+            low, high = a * min(dom), a * max(dom)
+            if low > high:
+                low, high = high, low
+            lows.append(low)
+            highs.append(high)
+        return lows, highs
+
+    def has_support(self, var, val):
+        '''Test if var = val lies within the bounds of the other variables'''
+        if not var.in_cur_domain(val):
+            return False
+        if self.exact:
+            return val in self.supported_values()[self.var_pos[var]]
+        lows, highs = self.bounds()
+        if lows is None:
+            return False
+        i = self.var_pos[var]
+        rest = self.target - self.coeffs[i] * val
+        return sum(lows) - lows[i] <= rest <= sum(highs) - highs[i]
+
+    def supported_values(self):
+        '''
+        Return, for each variable of the scope, the set of its current values 
+        that belong to a satisfying assignment of current values.
+
+        forward[i] holds the partial sums of the first i variables that can 
+        still be completed (those within the bounds of the rest of the scope) 
+        and backward[i] the sums the variables from i on can make, so the 
+        work is O(k * d * width) for k variables of d values whose sums span 
+        width integers.
+        '''
+        k = len(self.scope)
+        doms = [[a * val for val in var.cur_domain()]
+                for a, var in zip(self.coeffs, self.scope)]
+        if not all(doms):
+            return [set() for i in range(k)]
+
+        #bounds of the sums the variables from i on can make
+        suffix_low = [0] * (k + 1)
+        suffix_high = [0] * (k + 1)
+        for i in range(k - 1, -1, -1):
+            suffix_low[i] = suffix_low[i+1] + min(doms[i])
+            suffix_high[i] = suffix_high[i+1] + max(doms[i])
+
+        target = self.target
+        forward = [set([0])]
+        for i in range(k):
+            low = target - suffix_high[i+1]
+            high = target - suffix_low[i+1]
+            forward.append(set(s + d for s in forward[i] for d in doms[i]
+                               if low <= s + d <= high))
+        backward = [None] * (k + 1)
+        backward[k] = set([0])
+        for i in range(k - 1, -1, -1):
+            backward[i] = set(s + d for s in backward[i+1] for d in doms[i])
+
+        supported = []
+        for i, var in enumerate(self.scope):
+            a = self.coeffs[i]
+            before = forward[i]
+            after = backward[i+1]
+            supported.append(set(val for val in var.cur_domain()
+                                 if any(target - s - a * val in after
+                                        for s in before)))
+        return supported
+
+    def unsupported(self):
+        '''Return the (var, val) pairs outside the bounds of the others'''
+        if self.exact:
+            supported = self.supported_values()
+            return [(var, val) for i, var in enumerate(self.scope)
+                    for val in var.cur_domain() if val not in supported[i]]
+        lows, highs = self.bounds()
+        if lows is None:
+            return []
+        low, high = sum(lows), sum(highs)
+        pairs = []
+        for i, var in enumerate(self.scope):
+            rest_low = low - lows[i]
+            rest_high = high - highs[i]
+            a = self.coeffs[i]
+            for val in var.cur_domain():
+                if not rest_low <= self.target - a * val <= rest_high:
+                    pairs.append((var, val))
+        return pairs
+
+class ProductConstraint(Constraint):
+    '''
+    Class for intensional constraints prod(scope) == target over variables 
+    with positive integer values.
+
+    By default propagation is bounds-based: a value is supported if it 
+    divides the target and the quotient lies between the smallest and the 
+    largest product the other variables can still make. If exact is True, 
+    support is exact (GAC): it is computed by dynamic programming over the 
+    partial products reachable from the left and from the right of the 
+    scope, all of which are divisors of the target.
+    '''
+
+    def __init__(self, name, scope, target, exact=False):
+        Constraint.__init__(self, name, scope)
+        self.target = target
+        self.exact = exact
+        if exact:
+            self.priority = PRIORITY_DP
+        else:
+            #bounds reasoning only looks at the bounds of the other variables
+            self.events = EVENT_BOUNDS
+            self.priority = PRIORITY_BOUNDS
+            self.idempotent = False
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported: the constraint is defined by its target'''
+        raise TypeError("ProductConstraint {} has no tuple table".format(
+            self.name))
+
+    def check(self, vals):
+        '''Return True iff the product of vals is the target'''
+        product = 1
+        for v in vals:
+            product *= v
+        return product == self.target
+
+    def bounds(self):
+        '''
+        Return the lists of the smallest and largest value of each variable 
+        of the scope given its current domain.
+        '''
+        lows = []
+        highs = []
+        for var in self.scope:
+            dom = var.cur_domain()
+            if not dom:
+                return None, None
+            lows.append(min(dom))
+            highs.append(max(dom))
+        return lows, highs
+
+    def supports(self, i, val, lows, highs):
+        '''Internal routine. Test val for scope[i] against the bounds'''
+        if self.target % val != 0:
+            return False
+        rest_low = 1
+        rest_high = 1
+        for j in range(len(lows)):
+            if j != i:
+                rest_low *= lows[j]
+                rest_high *= highs[j]
+        return rest_low <= self.target // val <= rest_high
+
+    def has_support(self, var, val):
+        '''Test if var = val is consistent with the bounds of the others'''
+        if not var.in_cur_domain(val):
+            return False
+        if self.exact:
+            return val in self.supported_values()[self.var_pos[var]]
+        lows, highs = self.bounds()
+        if lows is None:
+            return False
+        return self.supports(self.var_pos[var], val, lows, highs)
+
+    def supported_values(self):
+        '''
+        Return, for each variable of the scope, the set of its current values 
+        that belong to a satisfying assignment of current values.
+
+        forward[i] holds the partial products of the first i variables and 
+        backward[i] the products of the variables from i on. Only divisors of 
+        the target are kept, so each set has at most as many elements as the 
+        target has divisors.
+        '''
+        k = len(self.scope)
+        target = self.target
+        doms = [[val for val in var.cur_domain() if target % val == 0]
+                for var in self.scope]
+
+        forward = [set([1])]
+        for i in range(k):
+            forward.append(set(p * d for p in forward[i] for d in doms[i]
+                               if target % (p * d) == 0))
+        backward = [None] * (k + 1)
+        backward[k] = set([1])
+        for i in range(k - 1, -1, -1):
+            backward[i] = set(p * d for p in backward[i+1] for d in doms[i]
+                              if target % (p * d) == 0)
+
+        supported = []
+        for i in range(k):
+            before = forward[i]
+            after = backward[i+1]
+            supported.append(set(val for val in doms[i]
+                                 if any(target % (p * val) == 0 and
+                                        target // (p * val) in after
+                                        for p in before)))
+        return supported
+
+    def unsupported(self):
+        '''Return the (var, val) pairs inconsistent with the others' bounds'''
+        if self.exact:
+            supported = self.supported_values()
+            return [(var, val) for i, var in enumerate(self.scope)
+                    for val in var.cur_domain() if val not in supported[i]]
+        lows, highs = self.bounds()
+        if lows is None:
+            return []
+        pairs = []
+        for i, var in enumerate(self.scope):
+            for val in var.cur_domain():
+                if not self.supports(i, val, lows, highs):
+                    pairs.append((var, val))
+        return pairs
+
+class MDDConstraint(Constraint):
+    '''
+    Class for constraints represented by a reduced multi-valued decision 
+    diagram (MDD): a layered DAG with one layer per variable of the scope, 
+    whose root-to-terminal paths are exactly the satisfying tuples. Its size 
+    grows with the number of distinct partial states rather than with the 
+    number of tuples.
+
+    The MDD is compiled either from a state machine (init, step, accept): 
+    reading the values of scope[0], scope[1], ... in order, step(state, val, 
+    i) returns the next state, or None if no satisfying tuple continues this 
+    way, and accept(state) tells if the final state satisfies the 
+    constraint; equal states are shared. Or it is compiled from a list of 
+    satisfying tuples with add_satisfying_tuples.
+
+    GAC support is computed in one forward and one backward pass over the 
+    edges whose values are still in the current domains.
+    '''
+
+    def __init__(self, name, scope, init=None, step=None, accept=None):
+        Constraint.__init__(self, name, scope)
+        self.edges = [[] for var in self.scope] #edges[i] = [(u, val, w)]
+        self.arcs = [dict() for var in self.scope] #arcs[i][(u, val)] = w
+        if step is not None:
+            self.compile(init, step, accept)
+
+    def compile(self, init, step, accept):
+        '''
+        Build the MDD layer by layer from the state machine (init, step, 
+        accept) over the permanent domains of the scope, then reduce it.
+        '''
+        k = len(self.scope)
+        states = {init: 0}
+        edges = []
+        for i, var in enumerate(self.scope):
+            nxt = dict()
+            layer = []
+            for state, u in states.items():
+                for val in var.dom:
+                    new = step(state, val, i)
+                    if new is None:
+                        continue
+                    if i == k - 1:
+                        if not accept(new):
+                            continue
+                        new = True #the terminal
+                    if new not in nxt:
+                        nxt[new] = len(nxt)
+                    layer.append((u, val, nxt[new]))
+            edges.append(layer)
+            states = nxt
+        self.edges = self.reduce(edges)
+        self.arcs = [{(u, val): w for u, val, w in layer} 
+                     for layer in self.edges]
+
+    def reduce(self, edges):
+        '''
+        Internal routine. Return the edges of the reduced MDD: nodes that 
+        cannot reach the terminal are removed and nodes with the same 
+        outgoing edges are merged, bottom-up.
+        '''
+        reduced = [None] * len(edges)
+        alive = {0: 0} #old id -> new id of the nodes of the layer below
+        for i in range(len(edges) - 1, -1, -1):
+            out = dict() #old id -> list of (val, new child id)
+            for u, val, w in edges[i]:
+                if w in alive:
+                    out.setdefault(u, []).append((val, alive[w]))
+            signatures = dict()
+            alive = dict()
+            for u, arcs in out.items():
+                sig = tuple(sorted(arcs))
+                if sig not in signatures:
+                    signatures[sig] = len(signatures)
+                alive[u] = signatures[sig]
+            reduced[i] = [(nid, val, w) for sig, nid in signatures.items() 
+                          for val, w in sig]
+        if 0 not in alive: #no satisfying tuple at all
+            return [[] for layer in edges]
+        return reduced
+
+    def add_satisfying_tuples(self, tuples):
+        '''
+        Compile the given satisfying tuples (together with those already 
+        represented) into the MDD.
+        '''
+        tuples = set(tuple(t) for t in tuples) | set(self.tuples())
+        prefixes = set(t[:i] for t in tuples for i in range(len(t) + 1))
+        def step(prefix, val, i):
+            prefix = prefix + (val,)
+            return prefix if prefix in prefixes else None
+        self.compile((), step, lambda prefix: prefix in tuples)
+
+    def tuples(self):
+        '''Generate the satisfying tuples (the paths of the MDD)'''
+        if not self.edges or not self.edges[0]:
+            return
+        children = [dict() for layer in self.edges]
+        for i, layer in enumerate(self.edges):
+            for u, val, w in layer:
+                children[i].setdefault(u, []).append((val, w))
+        stack = [(0, 0, ())]
+        while stack:
+            i, u, prefix = stack.pop()
+            if i == len(self.edges):
+                yield prefix
+                continue
+            for val, w in children[i].get(u, []):
+                stack.append((i + 1, w, prefix + (val,)))
+
+    def size(self):
+        '''Return the number of (nodes, edges) of the MDD'''
+        nodes = 1 + sum(len(set(w for u, val, w in layer)) 
+                        for layer in self.edges)
+        return nodes, sum(len(layer) for layer in self.edges)
+
+    def check(self, vals):
+        '''Return True iff vals is a path of the MDD'''
+        u = 0
+        for i, val in enumerate(vals):
+            u = self.arcs[i].get((u, val))
+            if u is None:
+                return False
+        return True
+
+    def supported_values(self):
+        '''
+        Return, for each variable of the scope, the set of its current values 
+        lying on a root-to-terminal path of current values.
+        '''
+        k = len(self.scope)
+        doms = [set(var.cur_domain()) for var in self.scope]
+        #forward: nodes reachable from the root
+        reach = [set([0])]
+        for i in range(k):
+            nxt = set()
+            dom = doms[i]
+            cur = reach[i]
+            for u, val, w in self.edges[i]:
+                if u in cur and val in dom:
+                    nxt.add(w)
+            reach.append(nxt)
+        #backward: edges that also reach the terminal
+        supported = [set() for i in range(k)]
+        alive = reach[k] #only the terminal, if reachable
+        for i in range(k - 1, -1, -1):
+            above = set()
+            dom = doms[i]
+            cur = reach[i]
+            for u, val, w in self.edges[i]:
+                if w in alive and u in cur and val in dom:
+                    supported[i].add(val)
+                    above.add(u)
+            alive = above
+        return supported
+
+    def has_support(self, var, val):
+        '''Test if var = val lies on a path of current values'''
+        if not var.in_cur_domain(val):
+            return False
+        return val in self.supported_values()[self.var_pos[var]]
+
+    def unsupported(self):
+        '''Return the (var, val) pairs lying on no path of current values'''
+        supported = self.supported_values()
+        return [(var, val) for i, var in enumerate(self.scope) 
+                for val in var.cur_domain() if val not in supported[i]]
+
 class CSP:
     '''
     Class for packing up a set of variables into a CSP problem. Contains various 
     utility routines for accessing the problem. The variables of the CSP can be 
     added later or on initialization. The constraints must be added later.
+
+    Variables and constraints are given dense integer ids as they are added: 
+    v.id is the index of v in csp.vars and c.id the index of c in csp.cons. 
+    The adjacency is kept in arrays indexed by variable id: var_cons[v.id] is 
+    the tuple of constraints over v, and var_neighbours[v.id] the tuple of 
+    variables sharing a constraint with v. 
+
+    Variables and constraints may be shared by several CSPs (e.g. models 
+    built over the same variables). Their ids then index the CSP they were 
+    last added to; reindex() gives a CSP its own ids back. has_var, 
+    get_cons_with_var and get_neighbours do so when they meet an id taken 
+    over by another CSP, and BT searches, LocalSearch, CSPEncoding and 
+    compile_model do so when they start, so two CSPs sharing objects must not 
+    be searched at the same time. Give each concurrent search its own copies 
+    (see Variable.copy and Constraint.copy).
     '''
 
     def __init__(self, name, vars=[]):
@@ -329,10 +1070,41 @@ class CSP:
         self.name = name
         self.vars = []
         self.cons = []
-        self.vars_to_cons = dict()
+        self.var_cons = []       #var id -> tuple of constraints over the var
+        self.var_neighbours = [] #var id -> tuple of vars sharing a constraint
+        self.profiler = None #see profiler.py; set through BT.set_profiler
         for v in vars:
             self.add_var(v)
 
+    def has_var(self, v):
+        '''Return True iff variable v has been added to this CSP'''
+        if v.id is None:
+            return False
+        if v.id < len(self.vars) and self.vars[v.id] is v:
+            return True
+        #v may be ours, with its id taken over by another CSP sharing it
+        self.reindex()
+        return v.id < len(self.vars) and self.vars[v.id] is v
+
+    def has_constraint(self, c):
+        '''Return True iff constraint c has been added to this CSP'''
+        if c.id is None:
+            return False
+        if c.id < len(self.cons) and self.cons[c.id] is c:
+            return True
+        self.reindex()
+        return c.id < len(self.cons) and self.cons[c.id] is c
+
+    def reindex(self):
+        '''
+        Give the variables and constraints of the CSP their ids in this CSP, 
+        after another CSP sharing them took their ids over.
+        '''
+        for i, v in enumerate(self.vars):
+            v.id = i
+        for i, c in enumerate(self.cons):
+            c.id = i
+
     def add_var(self,v):
         '''
         Add variable object to CSP while setting up an index to obtain the 
@@ -340,26 +1112,35 @@ class CSP:
         '''
         if not type(v) is Variable:
             print("WARNING: Trying to add non variable ", v, " to CSP object")
-        elif v in self.vars_to_cons:
+        elif self.has_var(v):
             print("WARNING: Trying to add variable ", v, " to CSP object that already has it")
         else:
+            v.id = len(self.vars)
             self.vars.append(v)
-            self.vars_to_cons[v] = []
+            self.var_cons.append(())
+            self.var_neighbours.append(())
 
     def add_constraint(self,c):
         '''
         Add constraint to CSP. Note that all variables in the constraints scope 
         must already have been added to the CSP.
         '''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("WARNING: Trying to add non constraint ", c, " to CSP object")
+        elif self.has_constraint(c):
+            print("WARNING: Trying to add constraint ", c, " to CSP object that already has it")
         else:
             for v in c.scope:
-                if not v in self.vars_to_cons:
+                if not self.has_var(v):
                     print("WARNING: Trying to add constraint ", c, " with unknown variables to CSP object")
                     return
-                self.vars_to_cons[v].append(c)
+            c.id = len(self.cons)
             self.cons.append(c)
+            for v in c.scope:
+                self.var_cons[v.id] += (c,)
+                nbrs = self.var_neighbours[v.id]
+                self.var_neighbours[v.id] = nbrs + tuple(
+                    u for u in c.scope if u is not v and u not in nbrs)
 
     def get_all_cons(self):
         '''
@@ -369,9 +1150,19 @@ class CSP:
         
     def get_cons_with_var(self, var):
         '''
-        Return list of constraints that include var in their scope.
+        Return tuple of constraints that include var in their scope.
         '''
-        return list(self.vars_to_cons[var])
+        if not self.has_var(var):
+            raise KeyError(var)
+        return self.var_cons[var.id]
+
+    def get_neighbours(self, var):
+        '''
+        Return tuple of variables sharing at least one constraint with var.
+        '''
+        if not self.has_var(var):
+            raise KeyError(var)
+        return self.var_neighbours[var.id]
 
     def get_all_vars(self):
         '''
@@ -397,6 +1188,81 @@ class CSP:
             print(v, " = ", v.get_assigned_value(), "    ", end='')
         print("")
 
+class SolveResult:
+    '''
+    Class for reporting the outcome of a bt_search run without printing.
+
+    status is one of SolveResult.SOLVED, SolveResult.UNSOLVABLE or 
+    SolveResult.TIMEOUT (a limit set with BT.set_limits stopped the search; 
+    limit then names it). solution is a list holding the assigned value of 
+    every CSP variable (in the order of csp.vars), or None if no solution was 
+    found. After a timeout, partial holds the deepest partial assignment the 
+    search reached, in the same layout with None for unassigned variables. 
+    nFailures is the number of assignments the propagator refuted. nShaved is 
+    the number of values removed by root shaving (see BT.shave). timings is 
+    None unless stage timings were requested, in which case it maps a stage 
+    name ('setup', 'root', 'shave', 'search') to the CPU time spent in it.
+    '''
+    SOLVED     = 'solved'
+    UNSOLVABLE = 'unsolvable'
+    TIMEOUT    = 'timeout'
+
+    __slots__ = ('status', 'solution', 'nDecisions', 'nPrunings', 'runtime', 
+                 'timings', 'nShaved', 'nFailures', 'limit', 'partial')
+
+    def __init__(self, status, solution, nDecisions, nPrunings, runtime, 
+                 timings=None, nShaved=0, nFailures=0, limit=None, 
+                 partial=None):
+        self.status     = status
+        self.solution   = solution
+        self.nDecisions = nDecisions
+        self.nPrunings  = nPrunings
+        self.runtime    = runtime
+        self.timings    = timings
+        self.nShaved    = nShaved
+        self.nFailures  = nFailures
+        self.limit      = limit
+        self.partial    = partial
+
+    def solved(self):
+        '''Return True iff a solution was found'''
+        return self.status == SolveResult.SOLVED
+
+    def __bool__(self):
+        return self.solved()
+
+    def as_board(self, n):
+        '''
+        Return the solution as a list of n lists of n values (the layout of 
+        the board returned by the KenKen models), or None if unsolved.
+        '''
+        if self.solution is None:
+            return None
+        return [self.solution[i*n:(i+1)*n] for i in range(n)]
+
+    def __repr__(self):
+        return("SolveResult({}, decisions={}, prunings={}, time={:.6f})".format(
+            self.status, self.nDecisions, self.nPrunings, self.runtime))
+
+def load_checkpoint(path):
+    '''
+    Read a checkpoint written by BT.save_checkpoint, to pass as the resume 
+    argument of BT.bt_search or BT.bt_solutions.
+    '''
+    with open(path, 'rb') as f:
+        return json.loads(zlib.decompress(f.read()).decode())
+
+class SearchLimitReached(Exception):
+    '''
+    Raised inside the search when a limit set with BT.set_limits is reached. 
+    bt_search catches it, once the search has been unwound, and reports a 
+    SolveResult with status TIMEOUT. limit names the limit.
+    '''
+
+    def __init__(self, limit):
+        Exception.__init__(self, limit)
+        self.limit = limit
+
 ########################################################
 # Backtracking Routine                                 #
 ########################################################
@@ -416,29 +1282,336 @@ class BT:
                             #assignments made during search
         self.nPrunings   = 0 #nPrunings is the number of value prunings during search
         self.unasgn_vars = [] #used to track unassigned variables
-        self.LOG_LEVEL   = 1
+        self.LOG_LEVEL   = 0 #nothing is printed unless asked for
         self.runtime     = 0
+        self.profiler    = None #optional Profiler object, see profiler.py
+        self.tracer      = None #optional TraceRecorder, see searchtrace.py
+        self.solutions   = None #solutions collected by bt_solutions
+        self.solution_limit = 1
+        self.limits      = dict() #see set_limits
+        self.table       = None #TranspositionTable of failed states, if any
+        self.stack       = [] #[var, value order, index, prunings] per level
+        self.checkpoint_path = None #see set_checkpoint
+        self.checkpoint_nodes = None
+        self.checkpoint_seconds = None
+        self.resume_levels = None #levels to re-enter when resuming
+        self.replay      = None #prunings expected from the replayed levels
+        self.model_fingerprint = None #see fingerprint, once per search
 
     def trace_on(self):
         '''Turn search trace on'''
         self.LOG_LEVEL = 2
 
     def trace_off(self):
-        '''Turn search trace off'''
+        '''Turn search trace off, back to printing nothing'''
+        self.LOG_LEVEL = 0
+
+    def verbose(self):
+        '''Print the outcome and statistics of each search'''
         self.LOG_LEVEL = 1
 
     def quiet(self):
         self.LOG_LEVEL = 0
+
+    def set_profiler(self, profiler):
+        '''
+        Attach a Profiler object (see profiler.py) to this search and to its 
+        CSP so that the propagators can report constraint revisions. Pass None 
+        to detach it again.
+        '''
+        self.profiler = profiler
+        self.csp.profiler = profiler
+
+    def set_tracer(self, tracer):
+        '''
+        Attach a TraceRecorder object (see searchtrace.py) that records every 
+        search step as a compact binary record. Pass None to detach it.
+        '''
+        self.tracer = tracer
         
+    def set_checkpoint(self, path, every_nodes=None, every_seconds=None):
+        '''
+        Save a checkpoint of the following searches to path (see 
+        save_checkpoint) every every_nodes decisions and/or every 
+        every_seconds seconds of wall-clock time; set_checkpoint(None) stops 
+        saving. Checkpoints are taken at nodes whose propagation succeeded.
+        '''
+        self.checkpoint_path = path
+        self.checkpoint_nodes = every_nodes
+        self.checkpoint_seconds = every_seconds
+
+    def schedule_checkpoint(self):
+        '''Internal routine. Set when the next checkpoint is due'''
+        if self.checkpoint_nodes is not None:
+            self.next_checkpoint_node = self.nDecisions + self.checkpoint_nodes
+        if self.checkpoint_seconds is not None:
+            self.next_checkpoint_time = time.monotonic() + \
+                                        self.checkpoint_seconds
+
+    def checkpoint_due(self):
+        '''Internal routine. Return True iff a checkpoint is due'''
+        if self.checkpoint_nodes is not None and \
+           self.nDecisions >= self.next_checkpoint_node:
+            return True
+        return self.checkpoint_seconds is not None and \
+               time.monotonic() >= self.next_checkpoint_time
+
+    def checkpoint(self):
+        '''
+        Return the position of the running search (e.g. between two steps of 
+        bt_search_steps) as a dictionary of plain values, ready for JSON:
+
+        path        [var id, value, values still to try] for every level 
+                    whose assignment is being searched below
+        pending     [var id, values still to try] for a deepest level whose 
+                    last value failed, or None
+        trail       the number of values pruned at the root and by each 
+                    level of path
+        stats       nDecisions, nPrunings, nFailures and runtime so far
+        solutions   the solutions collected so far by bt_solutions, or None
+        model       a fingerprint of the CSP
+
+        The pruned values themselves are not stored: resuming replays the 
+        path with the same propagator, which prunes them again, and checks 
+        the replay against trail and model.
+        '''
+        path = []
+        trail = [self.root_prunings]
+        pending = None
+        for var, value_order, i, n in self.stack:
+            rest = list(value_order[i+1:])
+            if n is None:
+                pending = [var.id, rest]
+            else:
+                path.append([var.id, value_order[i], rest])
+                trail.append(n)
+        return {'version': 1, 
+                'model': self.fingerprint(), 
+                'path': path, 
+                'pending': pending, 
+                'trail': trail, 
+                'stats': {'nDecisions': self.nDecisions, 
+                          'nPrunings': self.nPrunings, 
+                          'nFailures': self.nFailures, 
+                          'runtime': self.runtime_offset + 
+                                     time.process_time() - self.start_time}, 
+                'solutions': self.solutions}
+
+    def save_checkpoint(self, path):
+        '''
+        Write checkpoint() to the file path as compressed JSON. The file is 
+        replaced atomically, so a worker stopped while writing leaves the 
+        previous checkpoint intact.
+        '''
+        data = zlib.compress(json.dumps(self.checkpoint(), 
+                                        separators=(',', ':')).encode())
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.nCheckpoints = self.nCheckpoints + 1
+        self.schedule_checkpoint()
+
+    def fingerprint(self):
+        '''
+        Internal routine. Return the fingerprint of the CSP a checkpoint must 
+        match: its name, its size and a digest of its variables (names and 
+        domains) and of its constraints (type, name, scope, target, 
+        coefficients and the digest of their satisfying tuples or MDD edges). 
+        Constraints sharing their tuples or edges are digested once, and the 
+        fingerprint is computed once per search.
+        '''
+        if self.model_fingerprint is not None:
+            return self.model_fingerprint
+        digest = hashlib.blake2b(digest_size=16)
+        for v in self.csp.vars:
+            digest.update(repr((v.name, v.dom)).encode())
+        tables = dict() #id of shared sat_tuples or edges -> their digest
+        for c in self.csp.cons:
+            digest.update(repr((type(c).__name__, c.name, c.alldiff, 
+                                [v.id for v in c.scope], 
+                                getattr(c, 'target', None), 
+                                getattr(c, 'coeffs', None), 
+                                getattr(c, 'exact', None))).encode())
+            for contents in (c.sat_tuples, getattr(c, 'edges', None)):
+                if not contents:
+                    continue
+                table = tables.get(id(contents))
+                if table is None:
+                    #tuples in sorted order, whatever order they were added in
+                    rows = sorted(contents) if contents is c.sat_tuples \
+                           else contents
+                    table = hashlib.blake2b(repr(rows).encode(), 
+                                            digest_size=16).digest()
+                    tables[id(contents)] = table
+                digest.update(table)
+        self.model_fingerprint = [self.csp.name, len(self.csp.vars), 
+                                  len(self.csp.cons), digest.hexdigest()]
+        return self.model_fingerprint
+
+    def start_resume(self, state):
+        '''
+        Internal routine. Prepare the search, after root propagation, to 
+        re-enter the levels of the checkpoint state. Raise ValueError if the 
+        checkpoint was not taken on this model.
+        '''
+        if state.get('version') != 1 or state['model'] != self.fingerprint():
+            raise ValueError("Checkpoint was not taken on CSP {}".format(
+                self.csp.name))
+        if state['trail'][0] != self.root_prunings:
+            raise ValueError("Checkpoint root does not match the propagator")
+        levels = [(var_id, [val] + rest) for var_id, val, rest in state['path']]
+        if state['pending'] is not None:
+            levels.append(tuple(state['pending']))
+        self.resume_levels = collections.deque(levels)
+        self.replay = collections.deque(state['trail'][1:])
+
+        #the replayed levels are counted again
+        stats = state['stats']
+        self.nDecisions = stats['nDecisions'] - len(state['path'])
+        self.nPrunings = stats['nPrunings'] - sum(state['trail'][1:])
+        self.nFailures = stats['nFailures']
+        self.runtime_offset = stats['runtime']
+        if state['solutions'] and self.solutions is not None:
+            self.solutions.extend(state['solutions'])
+
+    def check_replay(self, status, prunings):
+        '''
+        Internal routine. Check that a level replayed from a checkpoint 
+        propagates as it did when the checkpoint was taken.
+        '''
+        if not status or len(prunings) != self.replay.popleft():
+            raise ValueError("Checkpoint does not replay with this propagator")
+
+    def set_transposition_table(self, table):
+        '''
+        Attach a TranspositionTable (see transposition.py) to the following 
+        searches, or detach it with None. Nodes whose state the table knows 
+        to fail are skipped, and the states of failed nodes are stored.
+        '''
+        self.table = table
+
+    def set_limits(self, nodes=None, failures=None, cpu_time=None, 
+                   wall_time=None, trail=None):
+        '''
+        Set hard limits for the following searches: at most nodes decisions, 
+        at most failures refuted assignments, at most cpu_time seconds of CPU 
+        time or wall_time seconds of wall-clock time (counted from the start 
+        of bt_search), and at most trail prunings held for undoing at once. 
+        A limit left as None is not enforced; set_limits() removes them all.
+
+        The limits are checked after every decision (and shaving probe). When 
+        one is reached the search is unwound and bt_search returns a 
+        SolveResult with status TIMEOUT, naming the limit and holding the 
+        deepest partial assignment reached.
+        '''
+        limits = {'nodes': nodes, 'failures': failures, 'cpu_time': cpu_time, 
+                  'wall_time': wall_time, 'trail': trail}
+        self.limits = {k: v for k, v in limits.items() if v is not None}
+
+    def check_limits(self):
+        '''
+        Internal routine. Raise SearchLimitReached if one of the limits of 
+        set_limits has been reached.
+        '''
+        limits = self.limits
+        if 'nodes' in limits and self.nDecisions >= limits['nodes']:
+            raise SearchLimitReached('nodes')
+        if 'failures' in limits and self.nFailures >= limits['failures']:
+            raise SearchLimitReached('failures')
+        if 'trail' in limits and self.trail_size > limits['trail']:
+            raise SearchLimitReached('trail')
+        if 'cpu_time' in limits and time.process_time() >= self.cpu_deadline:
+            raise SearchLimitReached('cpu_time')
+        if 'wall_time' in limits and time.monotonic() >= self.wall_deadline:
+            raise SearchLimitReached('wall_time')
+
     def clear_stats(self):
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
+        self.nFailures = 0
         self.runtime = 0
+        self.nShaved = 0
+        self.shave_time = 0
+        self.trail_size = 0 #prunings currently held for undoing
+        self.max_depth = 0 #deepest level reached, and the assignment there
+        self.partial = None
+        self.nCheckpoints = 0
+        self.runtime_offset = 0 #runtime before the checkpoint resumed from
+        self.model_fingerprint = None
 
     def print_stats(self):
         print("Search made {} variable assignments and pruned {} variable values".format(
             self.nDecisions, self.nPrunings))
+        if self.nShaved:
+            print("Root shaving removed {} variable values in {} seconds".format(
+                self.nShaved, self.shave_time))
+
+    def shave(self, propagator, time_limit=None):
+        '''
+        Singleton arc consistency preprocessing (root shaving). For every 
+        unassigned variable and value in its current domain, try the 
+        assignment and propagate it with propagator; if that leads to a 
+        dead-end, prune the value for the rest of the search and propagate the 
+        removal. Repeat until no value is removed or time_limit seconds of CPU 
+        time have been spent.
+
+        Returns (status, removed): status is False if the CSP was shown to have 
+        no solution, removed is the list of (Variable, Value) pairs pruned 
+        (including the consequences of the removals), to be restored by the 
+        caller. nShaved and shave_time record the values removed by the 
+        probes and the time spent.
+        '''
+        return exhaust(self.shave_steps(propagator, time_limit))
+
+    def shave_steps(self, propagator, time_limit=None):
+        '''
+        The root shaving of shave as a generator that yields once per probe 
+        (see bt_search_steps). If the generator is closed mid-way, the values 
+        removed so far are restored.
+        '''
+        stime = time.process_time()
+        removed = []
+        changed = True
+        try:
+            while changed:
+                changed = False
+                for var in self.unasgn_vars:
+                    for val in var.cur_domain():
+                        if time_limit is not None and \
+                           time.process_time() - stime >= time_limit:
+                            self.shave_time = time.process_time() - stime
+                            return True, removed
+                        if not var.in_cur_domain(val):
+                            continue #pruned by an earlier removal
+
+                        yield
+                        if self.limits:
+                            self.check_limits()
+                        var.assign(val)
+                        status, prunings = propagator(self.csp, var)
+                        self.restoreValues(prunings)
+                        var.unassign()
+                        if status:
+                            continue
+
+                        #val cannot be part of any solution
+                        var.prune_value(val)
+                        removed.append((var, val))
+                        self.nShaved = self.nShaved + 1
+                        changed = True
+                        status, prunings = propagator(self.csp)
+                        removed.extend(prunings)
+                        if not status or var.cur_domain_size() == 0:
+                            self.shave_time = time.process_time() - stime
+                            return False, removed
+        except BaseException:
+            self.restoreValues(removed)
+            raise
+
+        self.shave_time = time.process_time() - stime
+        return True, removed
 
     def restoreValues(self,prunings):
         '''
@@ -459,8 +1632,10 @@ class BT:
         '''Add variable back to list of unassigned vars'''
         self.unasgn_vars.append(var)
         
-    def bt_search(self,propagator,var_ord=None,val_ord=None):
-        '''Try to solve the CSP using specified propagator routine
+    def bt_search(self,propagator,var_ord=None,val_ord=None,timings=False,
+                  shave=None,shave_time=None,resume=None):
+        '''Try to solve the CSP using specified propagator routine and return 
+           a SolveResult object describing the outcome.
 
            propagator == a function with the following template
            propagator(csp, newly_instantiated_variable=None)
@@ -493,10 +1668,44 @@ class BT:
 
            var_ord is the variable ordering function currently being used; 
            val_ord is the value ordering function currently being used.
+
+           If timings is True, the CPU time spent in each stage of the search 
+           is recorded in the returned SolveResult.
+
+           If shave is a propagator (e.g. prop_GAC), the root is shaved with it 
+           (see shave) before the recursive search, spending at most 
+           shave_time seconds.
+
+           If resume is a checkpoint (see checkpoint and load_checkpoint), the 
+           search continues from it. It must be run on the same model with the 
+           same propagator, heuristics and shaving as the search that took 
+           it; statistics and runtime carry on from the checkpoint.
+
+           Nothing is printed unless verbose() or trace_on() was called.
            '''
+        return exhaust(self.bt_search_steps(propagator, var_ord, val_ord, 
+                                            timings, shave, shave_time, 
+                                            resume))
+
+    def bt_search_steps(self, propagator, var_ord=None, val_ord=None, 
+                        timings=False, shave=None, shave_time=None, 
+                        resume=None):
+        '''
+        bt_search as a generator that yields once for every assignment the 
+        search propagates (and every shaving probe), and returns the 
+        SolveResult. Driving it step by step runs the search in slices (see 
+        bt_search_async). If the generator is closed before it finishes, the 
+        search unwinds through the usual restore path: every assignment and 
+        pruning is undone and no SolveResult is produced.
+        '''
 
         self.clear_stats()
+        self.csp.reindex()
         stime = time.process_time()
+        self.start_time = stime
+        self.stack = []
+        self.cpu_deadline = stime + self.limits.get('cpu_time', 0)
+        self.wall_deadline = time.monotonic() + self.limits.get('wall_time', 0)
 
         self.restore_all_variable_domains()
         
@@ -505,46 +1714,235 @@ class BT:
             if not v.is_assigned():
                 self.unasgn_vars.append(v)
 
-        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
+        if timings:
+            stage_times = {'setup': time.process_time() - stime}
+            rtime = time.process_time()
+
+        if self.profiler:
+            status, prunings = self.profiler.time_propagator(propagator, self.csp)
+        else:
+            status, prunings = propagator(self.csp) #initial propagate no assigned variables.
         self.nPrunings = self.nPrunings + len(prunings)
+        self.trail_size = len(prunings)
+        self.root_prunings = len(prunings)
 
         if self.LOG_LEVEL > 1:
             print(len(self.unasgn_vars), " unassigned variables at start of search")
             print("Root Prunings: ", prunings)
 
-        if status == False:
-            print("CSP{} detected contradiction at root".format(
-                self.csp.name))
-        else:
-            status = self.bt_recurse(propagator, var_ord, val_ord, 1)   #now do recursive search
+        if self.tracer:
+            self.tracer.start(self.csp)
+            self.tracer.record(0, None, 0, len(prunings), TRACE_ROOT)
+
+        if timings:
+            stage_times['root'] = time.process_time() - rtime
+            rtime = time.process_time()
+
+        try:
+            if status and shave:
+                status, removed = yield from self.shave_steps(shave, shave_time)
+                prunings = prunings + removed
+                if timings:
+                    stage_times['shave'] = time.process_time() - rtime
+                    rtime = time.process_time()
+
+            if status == False:
+                if self.LOG_LEVEL > 0:
+                    print("CSP{} detected contradiction at root".format(
+                        self.csp.name))
+            else:
+                #now do recursive search
+                self.root_prunings = len(prunings)
+                if resume is not None:
+                    self.start_resume(resume)
+                if self.checkpoint_path:
+                    self.schedule_checkpoint()
+                if self.table:
+                    self.table.start(self.csp)
+                status = yield from self.bt_steps(propagator, var_ord, val_ord, 1)
+        except SearchLimitReached as stop:
+            #the search below the root has been undone; finish normally
+            status = None
+            limit = stop.limit
+        except BaseException:
+            #interrupted: undo the root propagation too
+            self.resume_levels = self.replay = None
+            self.restoreValues(prunings)
+            if self.tracer:
+                self.tracer.flush()
+            raise
+
+        if timings:
+            stage_times['search'] = time.process_time() - rtime
 
         self.restoreValues(prunings)
+        self.resume_levels = self.replay = None
+        self.runtime = self.runtime_offset + time.process_time() - stime
+
+        if self.tracer:
+            self.tracer.flush()
+
+        if status:
+            result = SolveResult(SolveResult.SOLVED, 
+                                 [v.get_assigned_value() for v in self.csp.vars],
+                                 self.nDecisions, self.nPrunings, self.runtime)
+        elif status is None:
+            result = SolveResult(SolveResult.TIMEOUT, None, self.nDecisions, 
+                                 self.nPrunings, self.runtime, limit=limit, 
+                                 partial=self.partial)
+        else:
+            result = SolveResult(SolveResult.UNSOLVABLE, None, self.nDecisions, 
+                                 self.nPrunings, self.runtime)
+        if timings:
+            result.timings = stage_times
+        result.nShaved = self.nShaved
+        result.nFailures = self.nFailures
 
         if self.LOG_LEVEL > 0:
+            if status is None:
+                print("CSP {} search stopped: {} limit reached".format(
+                    self.csp.name, limit))
             if status == False:
                 print("CSP{} unsolved. Has no solutions".format(self.csp.name))
             if status == True:
                 print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
-                                                                time.process_time() - stime))
+                                                                self.runtime))
                 self.csp.print_soln()
 
             print("bt_search finished")
             self.print_stats()
 
+        return result
+
+    async def bt_search_async(self, propagator, var_ord=None, val_ord=None, 
+                              slice_nodes=1000, **kwargs):
+        '''
+        Coroutine version of bt_search, for use inside an asyncio event loop. 
+        The search runs in slices of at most slice_nodes assignments (see 
+        bt_search_steps), and control goes back to the event loop between 
+        slices, so that concurrent searches (on different CSPs) and other 
+        tasks take turns. Other keyword arguments are those of bt_search. 
+        Returns the SolveResult; its runtime includes the CPU time other tasks 
+        used between slices.
+
+        Cancelling the task, including through asyncio.wait_for or 
+        asyncio.timeout, raises CancelledError at the end of the current 
+        slice; the search is then unwound through the restore path, leaving 
+        every variable unassigned with its domain restored, before the error 
+        propagates.
+        '''
+        steps = self.bt_search_steps(propagator, var_ord, val_ord, **kwargs)
+        try:
+            while True:
+                for node in range(slice_nodes):
+                    next(steps)
+                await asyncio.sleep(0)
+        except StopIteration as done:
+            return done.value
+        finally:
+            steps.close()
+
+    def bt_solutions(self, propagator, var_ord=None, val_ord=None, limit=2, 
+                     resume=None):
+        '''
+        Search for up to limit solutions of the CSP and return them as a list 
+        of flat solutions (see SolveResult.solution). Search stops as soon as 
+        limit solutions are found, so limit=2 is a cheap uniqueness check. 
+        Statistics of the search are kept in nDecisions and nPrunings. 
+        Returns None if a limit of set_limits is reached first, since the 
+        solutions found so far may not be all of them. resume continues from 
+        a checkpoint (see bt_search), keeping the solutions found before it.
+        '''
+        self.solutions = []
+        self.solution_limit = limit
+        try:
+            result = self.bt_search(propagator, var_ord, val_ord, 
+                                    resume=resume)
+            if result.status == SolveResult.TIMEOUT:
+                return None
+            return self.solutions
+        finally:
+            self.solutions = None
+            self.restore_all_variable_domains()
+
+    def bt_extend(self, propagator, var_ord=None, val_ord=None, limit=1):
+        '''
+        Search for up to limit solutions extending the current assignment and 
+        current domains of the CSP, e.g. the givens of an interactive session 
+        (see session.py), and return them as a list of flat solutions. Unlike 
+        bt_search, the domains are not restored before the search, and the 
+        CSP is left as it was found: the search is unwound as soon as limit 
+        solutions are found. Returns None if a limit of set_limits is 
+        reached first. Statistics are kept in nDecisions and nPrunings.
+        '''
+        self.clear_stats()
+        self.csp.reindex()
+        self.stack = []
+        self.unasgn_vars = [v for v in self.csp.vars if not v.is_assigned()]
+        self.cpu_deadline = time.process_time() + self.limits.get('cpu_time', 0)
+        self.wall_deadline = time.monotonic() + self.limits.get('wall_time', 0)
+        if self.table:
+            self.table.start(self.csp)
+        self.solutions = []
+        #bt_steps stops in place, leaving the solution assigned, once it has 
+        #solution_limit solutions; never let it, and close the steps instead
+        self.solution_limit = float('inf')
+        steps = self.bt_steps(propagator, var_ord, val_ord, 1)
+        try:
+            for step in steps:
+                if len(self.solutions) >= limit:
+                    break
+        except SearchLimitReached:
+            return None
+        finally:
+            steps.close()
+            found = self.solutions
+            self.solutions = None
+            self.solution_limit = 1
+        return found[:limit]
+
     def bt_recurse(self, propagator, var_ord, val_ord, level):
         '''Return true if found solution. False if still need to search.
            If top level returns false--> no solution'''
+        return exhaust(self.bt_steps(propagator, var_ord, val_ord, level))
+
+    def bt_steps(self, propagator, var_ord, val_ord, level):
+        '''
+        The recursive search of bt_recurse as a generator that yields once 
+        for every assignment it propagates, and returns what bt_recurse 
+        returns. If the generator is closed (or an exception is thrown into 
+        it) mid-search, the assignments and prunings made from this level 
+        down are undone and the variable is returned to unasgn_vars.
+        '''
 
         if self.LOG_LEVEL > 1:
             print('  ' * level, "bt_recurse level ", level)
            
         if not self.unasgn_vars:
             #all variables assigned
+            if self.tracer:
+                self.tracer.record(level, None, 0, 0, TRACE_SOLUTION)
+            if self.solutions is not None:
+                #collecting solutions: keep searching until we have enough
+                self.solutions.append([v.get_assigned_value() 
+                                       for v in self.csp.vars])
+                return len(self.solutions) >= self.solution_limit
             return True
         else:
+            profiler = self.profiler
+            tracer = self.tracer
+            table = self.table
+
             ##Figure out which variable to assign,
             ##Then remove it from the list of unassigned vars
-            if var_ord:
+            ##(when resuming, the variable and values of the checkpoint)
+            resumed = self.resume_levels.popleft() if self.resume_levels \
+                      else None
+            if resumed:
+              var = self.csp.vars[resumed[0]]
+            elif var_ord and profiler:
+              var = profiler.time_heuristic(var_ord, self.csp)
+            elif var_ord:
               var = var_ord(self.csp)
             else:
               var = self.unasgn_vars[0]
@@ -553,35 +1951,95 @@ class BT:
             if self.LOG_LEVEL > 1:
                 print('  ' * level, "bt_recurse var = ", var)
 
-            if val_ord:
+            if resumed:
+              value_order = resumed[1]
+            elif val_ord and profiler:
+              value_order = profiler.time_heuristic(val_ord, self.csp, var)
+            elif val_ord:
               value_order = val_ord(self.csp,var)
             else:
               value_order = var.cur_domain()
 
-            for val in value_order:
+            frame = [var, value_order, 0, None]
+            self.stack.append(frame)
+            for i, val in enumerate(value_order):
+                frame[2] = i
 
                 if self.LOG_LEVEL > 1:
                     print('  ' * level, "bt_recurse trying", var, "=", val)
 
                 var.assign(val)
                 self.nDecisions = self.nDecisions+1
-
-                status, prunings = propagator(self.csp, var)
+                if table:
+                    table.assign(var, val)
+
+                if profiler:
+                    status, prunings = profiler.time_propagator(propagator, 
+                                                                self.csp, var)
+                else:
+                    status, prunings = propagator(self.csp, var)
                 self.nPrunings = self.nPrunings + len(prunings)
+                self.trail_size = self.trail_size + len(prunings)
+                if self.replay:
+                    self.check_replay(status, prunings)
+                if not status:
+                    self.nFailures = self.nFailures + 1
+                elif level > self.max_depth:
+                    self.max_depth = level
+                    self.partial = [v.get_assigned_value()
+                                    for v in self.csp.vars]
 
                 if self.LOG_LEVEL > 1:
                     print('  ' * level, "bt_recurse prop status = ", status)
                     print('  ' * level, "bt_recurse prop pruned = ", prunings)
 
-                if status:
-                    if self.bt_recurse(propagator, var_ord,val_ord, level+1):
-                        return True
+                if table and status:
+                    table.prune(prunings)
+                    if table.is_failed():
+                        status = False #this state was already searched
+                frame[3] = len(prunings) if status else None
+
+                if tracer:
+                    tracer.record(level, var, val, len(prunings), 
+                                  TRACE_ASSIGN if status else TRACE_FAIL)
+
+                try:
+                    if self.limits:
+                        self.check_limits()
+                    if status and self.checkpoint_path and \
+                       self.checkpoint_due():
+                        self.save_checkpoint(self.checkpoint_path)
+                    yield
+                    if status:
+                        found = len(self.solutions or ())
+                        if (yield from self.bt_steps(propagator, var_ord, 
+                                                     val_ord, level+1)):
+                            return True
+                        if tracer:
+                            tracer.record(level, var, val, 0, TRACE_UNDO)
+                        if table and found == len(self.solutions or ()):
+                            #no solution below: the state fails
+                            table.add_failed()
+                except BaseException:
+                    self.restoreValues(prunings)
+                    var.unassign()
+                    if table:
+                        table.unassign(var)
+                    self.restoreUnasgnVar(var)
+                    self.stack.pop()
+                    raise
 
                 if self.LOG_LEVEL > 1:
                     print('  ' * level, "bt_recurse restoring ", prunings)
                 self.restoreValues(prunings)
+                self.trail_size = self.trail_size - len(prunings)
                 var.unassign()
+                if table:
+                    table.unassign(var)
+                if profiler:
+                    profiler.backtrack(var, val, level)
 
+            self.stack.pop()
             self.restoreUnasgnVar(var)
             return False
 
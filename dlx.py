@@ -0,0 +1,386 @@
+'''
+This file contains an exact-cover backend for KenKen, solved with Knuth's
+Algorithm X on dancing links (DLX). It is an alternative to searching the
+CSP of kenken_csp_model with BT.
+
+1. kenken_exact_cover(kenken_grid)
+    - Takes a KenKen grid in the format taken by kenken_csp_model.
+    - Returns the number of items and the list of options of the
+      exact-cover problem, together with the cell placements of every
+      option (see below). cage_options(cage, n) returns the options of one
+      cage, for callers that build the matrix from cached cages.
+
+2. DLX object
+    - A dancing-links matrix over items 0..n_items-1 and a list of options,
+      each a list of items.
+    - solutions(limit) yields exact covers as lists of option indices;
+      count(limit) counts them without building them, which is much cheaper.
+
+3. dlx_solve(kenken_grid), dlx_solutions(kenken_grid, limit=2) and
+   dlx_count(kenken_grid, limit=None)
+    - The counterparts of BT.bt_search, BT.bt_solutions and solution
+      counting. Solutions are flat lists of cell values, row by row, like
+      SolveResult.solution (dlx_solve returns a SolveResult, so
+      as_board(n) gives the board form).
+
+The exact-cover problem has four kinds of items: one per cell, one per (row,
+value) and (column, value) pair, and one per cage. An option places one
+combination of values on the cells of one cage: it covers the cage, its
+cells, and the (row, value) and (column, value) pairs of its placements.
+Only combinations that satisfy the cage (with the check_* functions of
+kenken_csp) and repeat no value within a row or a column are options. Every
+cell is covered once, so the board is filled; every (row, value) and (column,
+value) pair is covered once, so it is a Latin square. A cell outside every
+cage gets one option per value, so grids without cages are Latin squares.
+'''
+
+import collections
+import time
+
+from cspbase import SolveResult
+from kenken_csp import cage_cells, check_add, check_sub, check_div, check_mult
+
+CHECKS = (check_add, check_sub, check_div, check_mult)
+
+PLACEMENT_CACHE_SIZE = 4096 #cage placements kept per process
+PLACEMENT_CACHE = collections.OrderedDict() #cage key -> placements, LRU first
+
+def cage_placements(cells, target, operation, n):
+    '''
+    Returns the list of value tuples (one value per cell of cells) that
+    satisfy a cage and repeat no value within a row or a column. operation
+    is None for a single-cell cage. Partial sums and products are pruned
+    while the tuples are enumerated.
+    The placements only depend on which cells of the cage share a row or a
+    column, so they are cached under that pattern (with target, operation
+    and n) for cages of the same shape; the returned list must not be
+    modified.
+    '''
+    if operation is None:
+        return [(target,)] if 1 <= target <= n else []
+
+    k = len(cells)
+    #earlier cells of the cage sharing a row or a column with cell i
+    clashes = tuple(tuple(h for h in range(i) if cells[h][0] == cells[i][0] or
+                          cells[h][1] == cells[i][1]) for i in range(k))
+    key = (n, operation, target, clashes)
+    placements = PLACEMENT_CACHE.get(key)
+    if placements is not None:
+        PLACEMENT_CACHE.move_to_end(key)
+        return placements
+
+    check = CHECKS[operation]
+    placements = []
+    vals = [0] * k
+
+    def extend(i, partial):
+        if i == k:
+            if check(vals, target):
+                placements.append(tuple(vals))
+            return
+        for val in range(1, n+1):
+            if any(vals[h] == val for h in clashes[i]):
+                continue
+            if operation == 0: #add +
+                #the remaining cells add between 1 and n each
+                rest = k - 1 - i
+                if not partial + val + rest <= target <= \
+                       partial + val + rest * n:
+                    continue
+                vals[i] = val
+                extend(i + 1, partial + val)
+            elif operation == 3: #mult *
+                if target % (partial * val) != 0:
+                    continue
+                vals[i] = val
+                extend(i + 1, partial * val)
+            else:
+                vals[i] = val
+                extend(i + 1, partial)
+        vals[i] = 0
+
+    extend(0, 0 if operation == 0 else 1)
+    PLACEMENT_CACHE[key] = placements
+    if len(PLACEMENT_CACHE) > PLACEMENT_CACHE_SIZE:
+        PLACEMENT_CACHE.popitem(last=False)
+    return placements
+
+def cage_options(cage, n):
+    '''
+    Returns the options of a cage (in KenKen grid format) on an n x n board,
+    as (items, placement) pairs: the cell, (row, value) and (column, value)
+    items of the option, without the cage's own item, and its list of
+    ((row, column), value) placements (see kenken_exact_cover).
+    '''
+    cells = cage_cells(cage)
+    if len(cage) == 2:
+        target, operation = cage[1], None
+    else:
+        target, operation = cage[-2], cage[-1]
+    options = []
+    for vals in cage_placements(cells, target, operation, n):
+        items = []
+        for (i, j), val in zip(cells, vals):
+            items.append(i*n + j)
+            items.append(n*n + i*n + val - 1)
+            items.append(2*n*n + j*n + val - 1)
+        options.append((items, list(zip(cells, vals))))
+    return options
+
+def kenken_exact_cover(kenken_grid):
+    '''
+    Returns (n_items, options, placements) for a KenKen grid: the number of
+    items, the options as lists of items, and for each option the list of
+    ((row, column), value) placements it makes, counted from 0.
+    Cell (i, j) is item i*n + j, (row i, value v) is n*n + i*n + v-1,
+    (column j, value v) is 2*n*n + j*n + v-1 and cage k is 3*n*n + k.
+    '''
+    n = kenken_grid[0][0]
+    cages = kenken_grid[1:]
+    options = []
+    placements = []
+    for k, cage in enumerate(cages):
+        for items, placement in cage_options(cage, n):
+            options.append([3*n*n + k] + items)
+            placements.append(placement)
+
+    #cells outside every cage may take any value
+    caged = set(cell for cage in cages for cell in cage_cells(cage))
+    for i in range(n):
+        for j in range(n):
+            if (i, j) in caged:
+                continue
+            for val in range(1, n+1):
+                options.append([i*n + j, n*n + i*n + val - 1,
+                                2*n*n + j*n + val - 1])
+                placements.append([((i, j), val)])
+    return 3*n*n + len(cages), options, placements
+
+class DLX:
+    '''
+    Class for a dancing-links exact-cover matrix. Every item must be covered
+    by exactly one option of a solution. The matrix is held in flat lists
+    (node 0 is the root, nodes 1..n_items the item headers, then one node
+    per item of every option) and restored after every search. nNodes
+    counts the options tried by the last search.
+    '''
+
+    def __init__(self, n_items, options):
+        '''
+        Build the matrix for items 0..n_items-1 and options, a list of lists
+        of items.
+        '''
+        m = n_items
+        self.n_items = m
+        #horizontal links of the headers (and of the nodes of an option)
+        self.L = [i - 1 for i in range(m + 1)]
+        self.R = [i + 1 for i in range(m + 1)]
+        self.L[0] = m
+        self.R[m] = 0
+        #vertical links, header of each node, and option of each node
+        self.U = list(range(m + 1))
+        self.D = list(range(m + 1))
+        self.C = list(range(m + 1))
+        self.row = [-1] * (m + 1)
+        self.size = [0] * (m + 1)
+        self.nNodes = 0
+
+        L, R, U, D, C = self.L, self.R, self.U, self.D, self.C
+        for r, items in enumerate(options):
+            first = len(C)
+            for h, item in enumerate(items):
+                x = first + h
+                c = item + 1
+                C.append(c)
+                self.row.append(r)
+                #insert x at the bottom of column c
+                U.append(U[c])
+                D.append(c)
+                D[U[c]] = x
+                U[c] = x
+                self.size[c] += 1
+                L.append(x - 1 if h else first + len(items) - 1)
+                R.append(x + 1 if h < len(items) - 1 else first)
+
+    def cover(self, c):
+        '''Remove column c and the options that use it'''
+        L, R, U, D, C, size = self.L, self.R, self.U, self.D, self.C, self.size
+        L[R[c]] = L[c]
+        R[L[c]] = R[c]
+        i = D[c]
+        while i != c:
+            j = R[i]
+            while j != i:
+                U[D[j]] = U[j]
+                D[U[j]] = D[j]
+                size[C[j]] -= 1
+                j = R[j]
+            i = D[i]
+
+    def uncover(self, c):
+        '''Undo cover(c)'''
+        L, R, U, D, C, size = self.L, self.R, self.U, self.D, self.C, self.size
+        i = U[c]
+        while i != c:
+            j = L[i]
+            while j != i:
+                size[C[j]] += 1
+                U[D[j]] = j
+                D[U[j]] = j
+                j = L[j]
+            i = U[i]
+        L[R[c]] = c
+        R[L[c]] = c
+
+    def choose(self):
+        '''
+        Return the uncovered column with the fewest options (Knuth's S
+        heuristic), or 0 if every column is covered.
+        '''
+        R, size = self.R, self.size
+        best = 0
+        best_size = None
+        c = R[0]
+        while c != 0:
+            if best_size is None or size[c] < best_size:
+                best = c
+                best_size = size[c]
+                if best_size <= 1:
+                    break
+            c = R[c]
+        return best
+
+    def solutions(self, limit=None):
+        '''
+        Generator of the exact covers, as lists of option indices, stopping
+        after limit of them. If the generator is closed early the matrix is
+        restored.
+        '''
+        self.nNodes = 0
+        found = [0]
+        chosen = []
+
+        def search():
+            c = self.choose()
+            if c == 0:
+                found[0] += 1
+                yield [self.row[x] for x in chosen]
+                return
+            if self.size[c] == 0:
+                return
+            R, L, D, C = self.R, self.L, self.D, self.C
+            self.cover(c)
+            try:
+                r = D[c]
+                while r != c:
+                    self.nNodes += 1
+                    chosen.append(r)
+                    j = R[r]
+                    while j != r:
+                        self.cover(C[j])
+                        j = R[j]
+                    try:
+                        yield from search()
+                    finally:
+                        j = L[r]
+                        while j != r:
+                            self.uncover(C[j])
+                            j = L[j]
+                        chosen.pop()
+                    if limit is not None and found[0] >= limit:
+                        return
+                    r = D[r]
+            finally:
+                self.uncover(c)
+
+        if limit is not None and limit <= 0:
+            return
+        yield from search()
+
+    def count(self, limit=None):
+        '''
+        Return the number of exact covers, or limit if there are at least
+        that many. Unlike solutions, no cover is built.
+        '''
+        self.nNodes = 0
+        R, L, D, C, size = self.R, self.L, self.D, self.C, self.size
+        cover, uncover, choose = self.cover, self.uncover, self.choose
+
+        def search(needed):
+            c = choose()
+            if c == 0:
+                return 1
+            if size[c] == 0:
+                return 0
+            total = 0
+            cover(c)
+            r = D[c]
+            while r != c:
+                self.nNodes += 1
+                j = R[r]
+                while j != r:
+                    cover(C[j])
+                    j = R[j]
+                total += search(None if needed is None else needed - total)
+                j = L[r]
+                while j != r:
+                    uncover(C[j])
+                    j = L[j]
+                if needed is not None and total >= needed:
+                    break
+                r = D[r]
+            uncover(c)
+            return total
+
+        if limit is not None and limit <= 0:
+            return 0
+        return search(limit)
+
+def grid_solution(n, placements, chosen):
+    '''
+    Returns the flat solution (row by row, see SolveResult.solution) made by
+    the chosen options.
+    '''
+    solution = [None] * (n*n)
+    for r in chosen:
+        for (i, j), val in placements[r]:
+            solution[i*n + j] = val
+    return solution
+
+def dlx_solutions(kenken_grid, limit=2):
+    '''
+    Returns up to limit solutions of a KenKen grid as flat lists of values
+    (see SolveResult.solution), like BT.bt_solutions.
+    '''
+    n = kenken_grid[0][0]
+    n_items, options, placements = kenken_exact_cover(kenken_grid)
+    matrix = DLX(n_items, options)
+    return [grid_solution(n, placements, chosen)
+            for chosen in matrix.solutions(limit)]
+
+def dlx_count(kenken_grid, limit=None):
+    '''
+    Returns the number of solutions of a KenKen grid, or limit if it has at
+    least that many.
+    '''
+    n_items, options, placements = kenken_exact_cover(kenken_grid)
+    return DLX(n_items, options).count(limit)
+
+def dlx_solve(kenken_grid):
+    '''
+    Solve a KenKen grid with Algorithm X and return a SolveResult.
+    nDecisions is the number of options tried, nPrunings is 0, and runtime
+    (CPU time) includes building the exact-cover matrix.
+    '''
+    stime = time.process_time()
+    n = kenken_grid[0][0]
+    n_items, options, placements = kenken_exact_cover(kenken_grid)
+    matrix = DLX(n_items, options)
+    covers = list(matrix.solutions(1))
+    runtime = time.process_time() - stime
+    if not covers:
+        return SolveResult(SolveResult.UNSOLVABLE, None, matrix.nNodes, 0,
+                           runtime)
+    return SolveResult(SolveResult.SOLVED,
+                       grid_solution(n, placements, covers[0]), matrix.nNodes, 0,
+                       runtime)
@@ -41,7 +41,7 @@ def ord_dh(csp):
         count[v] = 0
     
         #loop through list of [all constraints] in the CSP with v
-        for c in csp.get_all_cons_with_var(v):
+        for c in csp.get_cons_with_var(v):
         
             #if constraint c has unassigned vars
             if c.get_n_unasgn() != 0:
@@ -94,7 +94,7 @@ def val_lcv(csp, var):
         # count[v] = 0
     
     #loop through list of [all constraints] in the CSP with var
-    for c in csp.get_all_cons_with_var(var):
+    for c in csp.get_cons_with_var(var):
     
         #if constraint c has unassigned vars besides var
         if c.get_n_unasgn() > 1:
@@ -113,7 +113,7 @@ def val_lcv(csp, var):
                 #count new no. of values in all neighbours' domains
                 sum_new = 0
                 for nbr in c.get_unasgn_vars():
-                    if nbv != var:
+                    if nbr != var:
                         sum_new += nbr.cur_domain_size()
 
                 #add no. of prumes to count{}
@@ -11,16 +11,75 @@ using only n-ary all-different constraints for both the row and column
 constraints.
 
 kenken_csp_model - a model built using n-ary all-different constraints for 
-the grid and KenKen cage constraints.
+the grid and KenKen cage constraints. Optionally, it also adds the sum and 
+product constraints that the cages imply on the rows and columns.
 
 All models return a CSP object, and a list of lists of Variable objects 
 representing the board. The returned list of lists is used to access the 
 solution. 
 
+In a KenKen grid, the first list holds the board size n, and every other list 
+is a cage: its cells, followed by the target and the operation (0 = add, 
+1 = sub, 2 = div, 3 = mult), or a single cell followed by its value. A cell is 
+either an int rc holding its row and column digits (e.g. 23 for row 2, column 
+3, only possible up to 9x9), or a (row, column) pair (e.g. (12, 3)), which 
+works for any n. Rows and columns are numbered from 1.
+
+Boards larger than TABLE_LINE_LIMIT use intensional all-different row and 
+column constraints (AllDiffConstraint) instead of tables of n! permutations. 
+Addition and multiplication cages larger than DP_CAGE_LIMIT are intensional 
+SumConstraints and ProductConstraints whose exact supports are computed by 
+dynamic programming; all other cages (subtraction and division cages always 
+have two cells) are tables. Cages are no longer compressed into multi-valued 
+decision diagrams automatically: with exact DP supports, MDD cages searched 
+the same trees more slowly. cage_mdd still builds an MDDConstraint for a 
+cage, for models built by hand.
+
+The variables and row/column constraints are the same for every n x n 
+puzzle, so they are built once per n (see GridTemplate and grid_template) and 
+cloned for each model; only the cage constraints are built per puzzle.
+
 '''
 import itertools
 from cspbase import *
 
+TABLE_LINE_LIMIT = 7 #largest n whose row/column constraints are tables
+DP_CAGE_LIMIT    = 2 #largest add/mult cage whose constraint is a table
+
+def cell_position(cell):
+    '''
+    Returns the (row, column) position, counted from 0, of a cell given in 
+    KenKen grid format.
+    Example:
+    Input: 23 or (2, 3)
+    Output: (1, 2)
+    '''
+    if type(cell) is int:
+        return (cell // 10) - 1, (cell % 10) - 1
+    return cell[0] - 1, cell[1] - 1
+
+def cell_index(cell, n):
+    '''
+    Returns the flat index (row by row, counted from 0) of a cell given in 
+    KenKen grid format on an n x n board, i.e. its index in csp.vars and in 
+    SolveResult.solution.
+    '''
+    i, j = cell_position(cell)
+    return i*n + j
+
+def var_name(row, column, n):
+    '''
+    Returns the name of the Variable at (row, column), counted from 1, of an 
+    n x n board. Up to 9x9 it is V{row#}{col#}, beyond that the row and 
+    column are separated so that names stay unambiguous.
+    Example:
+    Input: 2, 3, 4 or 2, 3, 12
+    Output: "V23" or "V2_3"
+    '''
+    if n <= 9:
+        return 'V{}{}'.format(row, column)
+    return 'V{}_{}'.format(row, column)
+
 def generate_cons_name(t_list):
     '''
     Returns a Constraint name given its scope of variables in a list.
@@ -129,44 +188,129 @@ def generate_vars(domain):
         vars_row = [] #list of vars
         for column in range(1, n+1):
             #add Variable V{row#}{col#}
-            vars_row.append(Variable('V{}{}'.format(row, column), domain))
+            vars_row.append(Variable(var_name(row, column, n), domain))
         board.append(vars_row)
 
     return board
 
-def binary_ne_grid(kenken_grid):
+def cage_constraint(cage, board, domain):
     '''
-    A model of a KenKen grid (without cage constraints) built using only
-    binary-not-equal constraints for both the row and column constraints.
+    Returns the Constraint for one cage of a KenKen grid, given the board of
+    Variables and the domain of values. Helper function for kenken_csp_model.
+    Example:
+    Input: [11,21,3,0], board, [1, 2, 3]
+    Output: Constraint "cage: C(V11,V21)" over V11, V21 with tuples summing to 3
     '''
-    n = kenken_grid[0][0] #dimension size
-    
-    #---VARIABLES---
-    #build domain of possible values
-    domain = []
-    for i in range(1, n+1): #range goes from 1 to n
-        domain.append(i)
-    #init variables
-    board = []
-    #add nxn Variables V{row#}{col#}
-    for row in range(1, n+1):
-        vars_row = [] #list of vars
-        for column in range(1, n+1):
-            vars_row.append(Variable('V{}{}'.format(row, column), domain))
-        board.append(vars_row)
+    scope = []
+    #init scope, target, [operation]
+    if len(cage) == 2:
+        cell_i, cell_j = cell_position(cage[0])
+        scope.append(board[cell_i][cell_j])
+        target = cage[1]
+
+        c = Constraint("cage: " + "C({})".format(scope[0].name), scope)
+        c.add_satisfying_tuples([(target,)]) #list of 1-ele tuple
+        return c
+
+    for num in range(0, len(cage)-2):
+        cell_i, cell_j = cell_position(cage[num])
+        scope.append(board[cell_i][cell_j])
+    target = cage[-2]
+    operation = cage[-1]
+
+    cons_name = generate_cons_name(scope)
+
+    if len(scope) > DP_CAGE_LIMIT:
+        if operation == 0: #add +
+            return SumConstraint("cage: " + cons_name, scope, target,
+                                 exact=True)
+        if operation == 3: #mult *
+            return ProductConstraint("cage: " + cons_name, scope, target,
+                                     exact=True)
+    c = Constraint("cage: " + cons_name, scope)
+
+    #values that cannot take part in a sum/product are left out early
+    values = domain
+    if operation == 0:
+        values = [d for d in domain if d <= target - (len(scope) - 1)]
+    elif operation == 3:
+        values = [d for d in domain if target % d == 0]
+
+    sat_tuples = []
+    for t in itertools.product(values, repeat=len(scope)):
+        if operation == 0: #add +
+            if check_add(t, target):
+                sat_tuples.append(t)
+        elif operation == 1: #sub -
+            if check_sub(t, target):
+                sat_tuples.append(t)
+        elif operation == 2: #div /
+            if check_div(t, target):
+                sat_tuples.append(t)
+        elif operation == 3: #mult *
+            if check_mult(t, target):
+                sat_tuples.append(t)
+    c.add_satisfying_tuples(sat_tuples)
+    return c
 
-    #---CONSTRAINTS---
+def cage_mdd(name, scope, target, operation, domain):
+    '''
+    Returns an MDDConstraint for a cage over scope. Addition and 
+    multiplication cages are compiled from their partial sums and products, 
+    so no tuples are enumerated; other cages are compiled from their tuples. 
+    Not used by kenken_csp_model (see the file header).
+    '''
+    k = len(scope)
+    if operation == 0: #add +
+        def step(partial, val, i):
+            partial += val
+            #the remaining cells add at least 1 each
+            return partial if partial + (k - 1 - i) <= target else None
+        return MDDConstraint(name, scope, 0, step, 
+                             lambda partial: partial == target)
+    if operation == 3: #mult *
+        def step(partial, val, i):
+            partial *= val
+            return partial if target % partial == 0 else None
+        return MDDConstraint(name, scope, 1, step, 
+                             lambda partial: partial == target)
+
+    c = MDDConstraint(name, scope)
+    check = check_sub if operation == 1 else check_div
+    c.add_satisfying_tuples(t for t in itertools.product(domain, repeat=k) 
+                            if check(t, target))
+    return c
+
+def line_constraints(board, domain):
+    '''
+    Returns the list of n-ary all-different Constraints over the rows and the
+    columns of board. Helper function for kenken_csp_model. Boards larger
+    than TABLE_LINE_LIMIT get AllDiffConstraints instead of tables.
+    '''
+    n = len(domain)
     constraints = []
+
+    if n > TABLE_LINE_LIMIT:
+        for row in board:
+            constraints.append(AllDiffConstraint(
+                "row: " + generate_cons_name(row), row))
+        for i in range(n):
+            column = [board[j][i] for j in range(n)]
+            constraints.append(AllDiffConstraint(
+                "column: " + generate_cons_name(column), column))
+        return constraints
+
     #add row constraints
     for row in board:
-        for t in generate_tuple_list(row, 2):
+        for t in generate_tuple_list(row, n):
             #init constraint c with scope
-            c = Constraint("C({},{})".format(t[0].name, t[1].name),
-                           [t[0], t[1]])
+            cons_name = generate_cons_name(row)
+            c = Constraint("row: " + cons_name, row)
+            c.alldiff = True
             #build list of satisfying tuples
             sat_tuples = []
-            #this generates a list of 2-tuples with diff elements
-            for t in itertools.permutations(domain, 2):
+            #this generates a list of n-tuples with diff elements
+            for t in itertools.permutations(domain, n):
                 sat_tuples.append(t)
             #add tuples to constraint c
             c.add_satisfying_tuples(sat_tuples)
@@ -174,24 +318,202 @@ def binary_ne_grid(kenken_grid):
             constraints.append(c)
 
     #add column constraints
+    #build columns
     for i in range(len(domain)): #column num from 0 to n-1
         column = []
         for j in range(len(domain)): #num of rows
             column.append(board[j][i])
-        for t in generate_tuple_list(column, 2):
+        for t in generate_tuple_list(column, n):
             #init constraint c with scope
-            c = Constraint("C({},{})".format(t[0].name, t[1].name),
-                       [t[0], t[1]])
+            cons_name = generate_cons_name(column)
+            c = Constraint("column: " + cons_name, column)
+            c.alldiff = True
             #build list of satisfying tuples
             sat_tuples = []
-            #this generates a list of 2-tuples with diff elements
-            for t in itertools.permutations(domain, 2):
+            #this generates a list of n-tuples with diff elements
+            for t in itertools.permutations(domain, n):
                 sat_tuples.append(t)
             #add tuples to constraint c
             c.add_satisfying_tuples(sat_tuples)
             #add constraint c to constraints[]
             constraints.append(c)
 
+    return constraints
+
+def binary_line_constraints(board, domain):
+    '''
+    Returns the list of binary NotEqualConstraints over every pair of cells 
+    sharing a row or a column of board. Helper function for binary_ne_grid.
+    '''
+    constraints = []
+    #add row constraints
+    for row in board:
+        for t in generate_tuple_list(row, 2):
+            #init constraint c with scope
+            c = NotEqualConstraint("C({},{})".format(t[0].name, t[1].name),
+                                   [t[0], t[1]])
+            #add constraint c to constraints[]
+            constraints.append(c)
+
+    #add column constraints
+    for i in range(len(domain)): #column num from 0 to n-1
+        column = []
+        for j in range(len(domain)): #num of rows
+            column.append(board[j][i])
+        for t in generate_tuple_list(column, 2):
+            #init constraint c with scope
+            c = NotEqualConstraint("C({},{})".format(t[0].name, t[1].name),
+                                   [t[0], t[1]])
+            #add constraint c to constraints[]
+            constraints.append(c)
+
+    return constraints
+
+def cage_cells(cage):
+    '''
+    Returns the cells of a cage in KenKen grid format as a list of (row, 
+    column) positions counted from 0.
+    Example:
+    Input: [11,21,3,0]
+    Output: [(0, 0), (1, 0)]
+    '''
+    if len(cage) == 2:
+        return [cell_position(cage[0])]
+    return [cell_position(cell) for cell in cage[:-2]]
+
+def implied_constraints(kenken_grid, board):
+    '''
+    Returns the list of redundant constraints implied by the rows and columns 
+    of a KenKen grid: every line sums to n(n+1)/2 and multiplies to n!. 
+    Helper function for kenken_csp_model.
+
+    For the sum, each addition (or single-cell) cage meeting a line replaces 
+    the cells it has in the line by its target minus its cells outside the 
+    line ("innies" and "outies"), giving a SumConstraint with coefficients +1 
+    on the line's other cells and -1 on the outside cells. For the product, 
+    the multiplication (or single-cell) cages lying inside a line divide n! 
+    and a ProductConstraint is put on the line's other cells.
+    '''
+    n = kenken_grid[0][0]
+    line_sum = n*(n+1)//2
+    line_prod = 1
+    for i in range(1, n+1):
+        line_prod *= i
+
+    cages = [(cage_cells(cage), cage[1] if len(cage) == 2 else cage[-2],
+              None if len(cage) == 2 else cage[-1])
+             for cage in kenken_grid[1:]]
+
+    lines = [("row {}".format(i+1), [(i, j) for j in range(n)])
+             for i in range(n)]
+    lines += [("column {}".format(j+1), [(i, j) for i in range(n)])
+              for j in range(n)]
+
+    constraints = []
+    for line_name, line in lines:
+        in_line = set(line)
+
+        #sum: innies and outies of the addition cages
+        target = line_sum
+        outside = []
+        covered = set()
+        for cells, cage_target, operation in cages:
+            if operation not in (None, 0) or in_line.isdisjoint(cells):
+                continue
+            target -= cage_target
+            for cell in cells:
+                if cell in in_line:
+                    covered.add(cell)
+                else:
+                    outside.append(cell)
+        if covered:
+            inner = [cell for cell in line if cell not in covered]
+            scope = [board[i][j] for i, j in inner + outside]
+            if scope:
+                coeffs = [1] * len(inner) + [-1] * len(outside)
+                constraints.append(SumConstraint(
+                    "implied sum {}: {}".format(line_name, 
+                                                generate_cons_name(scope)),
+                    scope, target, coeffs))
+
+        #product: multiplication cages inside the line
+        divisor = 1
+        covered = set()
+        for cells, cage_target, operation in cages:
+            if operation in (None, 3) and in_line.issuperset(cells):
+                divisor *= cage_target
+                covered.update(cells)
+        if covered and line_prod % divisor == 0:
+            scope = [board[i][j] for i, j in line if (i, j) not in covered]
+            if scope:
+                constraints.append(ProductConstraint(
+                    "implied product {}: {}".format(line_name, 
+                                                    generate_cons_name(scope)),
+                    scope, line_prod // divisor))
+
+    return constraints
+
+class GridTemplate:
+    '''
+    The Latin-square skeleton of an n x n KenKen board: its Variables and its 
+    row and column constraints, built once and cloned for every puzzle of 
+    that size. Use grid_template(n) to get the cached template.
+    '''
+
+    def __init__(self, n, binary=False):
+        '''
+        Build the skeleton of an n x n board, with binary not-equal row and 
+        column constraints if binary is True, and n-ary all-different ones 
+        otherwise.
+        '''
+        self.n = n
+        self.domain = list(range(1, n+1))
+        self.board = generate_vars(self.domain)
+        if binary:
+            self.constraints = binary_line_constraints(self.board, self.domain)
+        else:
+            self.constraints = line_constraints(self.board, self.domain)
+
+    def clone(self):
+        '''
+        Returns a fresh (board, constraints) pair for a new puzzle. The 
+        Variables are new (with fully restored domains) and the constraints 
+        are copies over them that share the template's tables.
+        '''
+        var_map = dict()
+        board = []
+        for row in self.board:
+            vars_row = []
+            for var in row:
+                var_map[var] = var.copy()
+                vars_row.append(var_map[var])
+            board.append(vars_row)
+        constraints = [c.copy(var_map) for c in self.constraints]
+        return board, constraints
+
+GRID_TEMPLATES = dict() #(n, binary) -> GridTemplate
+
+def grid_template(n, binary=False):
+    '''
+    Returns the cached GridTemplate for n x n boards, building it on first 
+    use.
+    '''
+    key = (n, binary)
+    if key not in GRID_TEMPLATES:
+        GRID_TEMPLATES[key] = GridTemplate(n, binary)
+    return GRID_TEMPLATES[key]
+
+def binary_ne_grid(kenken_grid):
+    '''
+    A model of a KenKen grid (without cage constraints) built using only
+    binary-not-equal constraints for both the row and column constraints.
+    '''
+    n = kenken_grid[0][0] #dimension size
+    
+    #---VARIABLES & CONSTRAINTS---
+    #clone the cached skeleton of an n x n board
+    board, constraints = grid_template(n, binary=True).clone()
+
     #---CSP---
     #init csp
     csp = CSP("{}-BinaryKenKen".format(n))
@@ -212,58 +534,9 @@ def nary_ad_grid(kenken_grid):
     '''
     n = kenken_grid[0][0] #dimension size
     
-    #---VARIABLES---
-    #build domain of possible values
-    domain = []
-    for i in range(1, n+1): #range goes from 1 to n
-        domain.append(i)
-    #init variables
-    board = []
-    #add nxn Variables V{row#}{col#}
-    for row in range(1, n+1):
-        vars_row = [] #list of vars
-        for column in range(1, n+1):
-            vars_row.append(Variable('V{}{}'.format(row, column), domain))
-        board.append(vars_row)
-
-    #---CONSTRAINTS---
-    constraints = []
-    #add row constraints
-    for row in board:
-        for t in generate_tuple_list(row, n):
-            #init constraint c with scope
-            cons_name = generate_cons_name(row)
-            c = Constraint(cons_name, row)
-            #build list of satisfying tuples
-            sat_tuples = []
-            #this generates a list of n-tuples with diff elements
-            for t in itertools.permutations(domain, n):
-                sat_tuples.append(t)
-            #add tuples to constraint c
-            c.add_satisfying_tuples(sat_tuples)
-            #add constraint c to constraints[]
-            constraints.append(c)
-
-    #add column constraints
-    #build columns
-    for i in range(len(domain)): #column num from 0 to n-1
-        column = []
-        for j in range(len(domain)): #num of rows
-            column.append(board[j][i])
-        for t in generate_tuple_list(column, n):
-            #init constraint c with scope
-            cons_name = generate_cons_name(column)
-            c = Constraint(cons_name, column)
-            #build list of satisfying tuples
-            sat_tuples = []
-            #this generates a list of 2-tuples with diff elements
-            for t in itertools.permutations(domain, 2):
-                sat_tuples.append(t)
-            #add tuples to constraint c
-            c.add_satisfying_tuples(sat_tuples)
-
-            #add constraint c to constraints[]
-            constraints.append(c)
+    #---VARIABLES & CONSTRAINTS---
+    #clone the cached skeleton of an n x n board
+    board, constraints = grid_template(n).clone()
 
     #---CSP---
     #init csp
@@ -278,107 +551,34 @@ def nary_ad_grid(kenken_grid):
 
     return csp, board
     
-def kenken_csp_model(kenken_grid):
+def kenken_csp_model(kenken_grid, implied=False):
     '''
     A model built using n-ary all-different constraints for the grid and
-    KenKen cage constraints.
+    KenKen cage constraints. If implied is True, the redundant row and column 
+    sum and product constraints derived from the cage layout are added too 
+    (see implied_constraints).
     '''
     n = kenken_grid[0][0] #dimension size
     
     #---VARIABLES---
-    #build domain of possible values
-    domain = []
-    for i in range(1, n+1): #range goes from 1 to n
-        domain.append(i)
-    #init variables
-    board = []
-    #add nxn Variables V{row#}{col#}
-    for row in range(1, n+1):
-        vars_row = []
-        for column in range(1, n+1):
-            vars_row.append(Variable('V{}{}'.format(row, column), domain))
-        board.append(vars_row)
+    #clone the cached skeleton of an n x n board (variables, and row and 
+    #column constraints)
+    template = grid_template(n)
+    board, line_cons = template.clone()
 
     #---CONSTRAINTS---
     constraints = []
     
     #add cage constraints
     for cage in kenken_grid[1:len(kenken_grid)]: #ignore the 1st list
-        scope = []
-        #init scope, target, [operation]
-        if len(cage) == 2:
-            cell_i = (cage[0] // 10) - 1
-            cell_j = (cage[0] % 10) - 1
-            scope.append(board[cell_i][cell_j])
-            target = cage[1]
-
-            c = Constraint("cage: " + "C(V{}{})".format(cell_i+1,cell_j+1), scope)
-            c.add_satisfying_tuples([(target,)]) #list of 1-ele tuple
-            constraints.append(c)
-            continue #go on to next cage
-
-        for num in range(0, len(cage)-2):
-            cell_i = (cage[num] // 10) - 1
-            cell_j = (cage[num] % 10) - 1
-            scope.append(board[cell_i][cell_j])
-        target = cage[-2]
-        operation = cage[-1]
-    
-        cons_name = generate_cons_name(scope)
-        # c = Constraint("cage: " + cons_name + ", target = " + str(target), scope)
-        c = Constraint("cage: " + cons_name, scope)
-        sat_tuples = []
-        for t in itertools.product(domain, repeat=len(scope)):
-            if operation == 0: #add +
-                if check_add(t, target):
-                    sat_tuples.append(t)
-            elif operation == 1: #sub -
-                if check_sub(t, target):
-                    sat_tuples.append(t)
-            elif operation == 2: #div /
-                if check_div(t, target):
-                    sat_tuples.append(t)
-            elif operation == 3: #mult *
-                if check_mult(t, target):
-                    sat_tuples.append(t)
-        c.add_satisfying_tuples(sat_tuples)
-        constraints.append(c)
+        constraints.append(cage_constraint(cage, board, template.domain))
     
-    #add row constraints
-    for row in board:
-        for t in generate_tuple_list(row, n):
-            #init constraint c with scope
-            cons_name = generate_cons_name(row)
-            c = Constraint("row: " + cons_name, row)
-            #build list of satisfying tuples
-            sat_tuples = []
-            #this generates a list of n-tuples with diff elements
-            for t in itertools.permutations(domain, n):
-                sat_tuples.append(t)
-            #add tuples to constraint c
-            c.add_satisfying_tuples(sat_tuples)
-            #add constraint c to constraints[]
-            constraints.append(c)
+    #add row and column constraints
+    constraints.extend(line_cons)
 
-    #add column constraints
-    #build columns
-    for i in range(len(domain)): #column num from 0 to n-1
-        column = []
-        for j in range(len(domain)): #num of rows
-            column.append(board[j][i])
-        for t in generate_tuple_list(column, n):
-            #init constraint c with scope
-            cons_name = generate_cons_name(column)
-            c = Constraint("column: " + cons_name, column)
-            #build list of satisfying tuples
-            sat_tuples = []
-            #this generates a list of 2-tuples with diff elements
-            for t in itertools.permutations(domain, n):
-                sat_tuples.append(t)
-            #add tuples to constraint c
-            c.add_satisfying_tuples(sat_tuples)
-            #add constraint c to constraints[]
-            constraints.append(c)
+    #add implied sum and product constraints
+    if implied:
+        constraints.extend(implied_constraints(kenken_grid, board))
 
     #---CSP---
     #init csp
@@ -391,4 +591,4 @@ def kenken_csp_model(kenken_grid):
     for c in constraints:
         csp.add_constraint(c)
 
-    return csp, board
\ No newline at end of file
+    return csp, board
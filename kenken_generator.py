@@ -0,0 +1,250 @@
+'''
+This file contains a generator of KenKen puzzles with a unique solution.
+
+1. KenKenGenerator object
+    - Created once per board size n. Uniqueness is checked on the
+      exact-cover form of the puzzle (see dlx.py); the options of every cage
+      are cached for the current candidate, so a repaired candidate only
+      builds the options of the cages that changed.
+    - generate() returns a KenKen grid (in the list of lists format taken by
+      kenken_csp_model) together with its unique solution.
+
+2. generate_puzzles(n, count, seed=None)
+    - Convenience function returning a list of count (grid, solution) pairs.
+
+A puzzle is generated in four steps:
+    1. A random Latin square is built by shuffling the rows, columns and
+       symbols of the cyclic Latin square.
+    2. The square is partitioned into cages by growing each cage from a
+       random free cell into random free neighbours.
+    3. Every cage is given an operation and the target it yields on the
+       square.
+    4. Uniqueness is checked with DLX.solutions(limit=2). If a second
+       solution exists, the cages around a cell on which the two solutions
+       differ are repaired locally (merged with a neighbouring cage, or split
+       into a single-cell cage), and the check is repeated. Only after
+       max_repairs failed repairs is a new candidate generated.
+'''
+
+import random
+
+from dlx import DLX, cage_options, grid_solution
+
+ADD  = 0
+SUB  = 1
+DIV  = 2
+MULT = 3
+
+class KenKenGenerator:
+    '''
+    Class for generating n x n KenKen puzzles with a unique solution.
+    '''
+
+    def __init__(self, n, seed=None, max_cage=4, max_repairs=20):
+        '''
+        Create a generator for n x n boards. seed seeds the generator's own
+        random number generator. max_cage is the largest cage size generated
+        (repairs never merge cages beyond it).
+        '''
+        self.n = n
+        self.rng = random.Random(seed)
+        self.max_cage = max_cage
+        self.max_repairs = max_repairs
+        self.cage_options = dict() #cage (as a tuple) -> its options
+
+        self.stats = {'puzzles': 0, 'candidates': 0, 'repairs': 0,
+                      'checks': 0}
+
+    # Step 1
+    def latin_square(self):
+        '''Return a random n x n Latin square over 1..n'''
+        n = self.n
+        rows = list(range(n))
+        cols = list(range(n))
+        symbols = list(range(1, n+1))
+        self.rng.shuffle(rows)
+        self.rng.shuffle(cols)
+        self.rng.shuffle(symbols)
+        return [[symbols[(r + c) % n] for c in cols] for r in rows]
+
+    # Step 2
+    def neighbours(self, cell):
+        '''Return the cells orthogonally adjacent to cell (a (row, col) pair)'''
+        i, j = cell
+        return [(a, b) for a, b in ((i-1, j), (i+1, j), (i, j-1), (i, j+1))
+                if 0 <= a < self.n and 0 <= b < self.n]
+
+    def cage_size(self):
+        '''Return a random cage size, favouring cages of 2 and 3 cells'''
+        sizes = [1, 2, 2, 2, 3, 3, 4]
+        return min(self.rng.choice(sizes), self.max_cage)
+
+    def partition(self):
+        '''
+        Return a random partition of the board into cages, each a list of
+        (row, col) cells.
+        '''
+        cells = [(i, j) for i in range(self.n) for j in range(self.n)]
+        self.rng.shuffle(cells)
+        free = set(cells)
+        cages = []
+        for cell in cells:
+            if cell not in free:
+                continue
+            free.discard(cell)
+            cage = [cell]
+            size = self.cage_size()
+            while len(cage) < size:
+                frontier = [nb for c in cage for nb in self.neighbours(c)
+                            if nb in free]
+                if not frontier:
+                    break
+                nb = self.rng.choice(frontier)
+                free.discard(nb)
+                cage.append(nb)
+            cages.append(cage)
+        return cages
+
+    # Step 3
+    def make_cage(self, cells, square):
+        '''
+        Return a cage in KenKen grid format for the given cells, choosing an
+        operation at random and its target from the square.
+        '''
+        cells = sorted(cells)
+        if self.n <= 9:
+            encoded = [(i+1)*10 + (j+1) for i, j in cells]
+        else:
+            encoded = [(i+1, j+1) for i, j in cells]
+        vals = [square[i][j] for i, j in cells]
+        if len(cells) == 1:
+            return encoded + [vals[0]]
+
+        if len(cells) == 2:
+            big, small = max(vals), min(vals)
+            ops = [SUB, SUB, ADD, MULT]
+            if big % small == 0:
+                ops += [DIV, DIV]
+            op = self.rng.choice(ops)
+        else:
+            op = self.rng.choice([ADD, MULT])
+
+        if op == ADD:
+            target = sum(vals)
+        elif op == SUB:
+            target = big - small
+        elif op == DIV:
+            target = big // small
+        else:
+            target = 1
+            for v in vals:
+                target *= v
+        return encoded + [target, op]
+
+    # Step 4
+    def solutions(self, cages, limit=2):
+        '''
+        Return up to limit solutions of the puzzle made of the given cages
+        (in grid format), as flat lists of values row by row. The exact-cover
+        matrix is built like kenken_exact_cover's, from the cached options
+        of the cages.
+        '''
+        n = self.n
+        options = []
+        placements = []
+        for k, cage in enumerate(cages):
+            key = tuple(cage)
+            found = self.cage_options.get(key)
+            if found is None:
+                found = self.cage_options[key] = cage_options(cage, n)
+            for items, placement in found:
+                options.append([3*n*n + k] + items)
+                placements.append(placement)
+
+        self.stats['checks'] += 1
+        matrix = DLX(3*n*n + len(cages), options)
+        return [grid_solution(n, placements, chosen)
+                for chosen in matrix.solutions(limit)]
+
+    def repair(self, partition, first, second):
+        '''
+        Locally change the partition (a list of cell lists) so that the cages 
+        around a cell where the solutions first and second differ are 
+        tightened: the cell's cage is merged with a neighbouring cage or, if 
+        that would exceed max_cage, the cell is split off as a single-cell 
+        cage.
+        '''
+        n = self.n
+        diff = [(k // n, k % n) for k in range(n*n) if first[k] != second[k]]
+        cell = self.rng.choice(diff)
+        owner = {c: idx for idx, cage in enumerate(partition) for c in cage}
+        idx = owner[cell]
+        cage = partition[idx]
+
+        #prefer merging with a neighbouring cage holding another differing cell
+        candidates = []
+        for c in cage:
+            for nb in self.neighbours(c):
+                other = owner[nb]
+                if other != idx and \
+                   len(partition[other]) + len(cage) <= self.max_cage:
+                    candidates.append(other)
+        if candidates:
+            diffs = set(diff)
+            preferred = [o for o in candidates
+                         if any(c in diffs for c in partition[o])]
+            other = self.rng.choice(preferred or candidates)
+            partition[idx] = cage + partition[other]
+            del partition[other]
+        else:
+            #otherwise pin the cell down with a single-cell cage; the rest of 
+            #the cage may fall apart into several connected cages
+            rest = set(cage)
+            rest.discard(cell)
+            del partition[idx]
+            partition.append([cell])
+            while rest:
+                part = [rest.pop()]
+                for c in part:
+                    for nb in self.neighbours(c):
+                        if nb in rest:
+                            rest.discard(nb)
+                            part.append(nb)
+                partition.append(part)
+
+    def generate(self):
+        '''
+        Return a pair (kenken_grid, solution) where kenken_grid is a puzzle 
+        with exactly one solution, and solution the n x n square solving it.
+        '''
+        n = self.n
+        while True:
+            self.stats['candidates'] += 1
+            square = self.latin_square()
+            partition = self.partition()
+            made = dict() #sorted cells -> cage, so repairs keep other cages
+            self.cage_options.clear()
+
+            for attempt in range(self.max_repairs + 1):
+                cages = []
+                for cells in partition:
+                    key = tuple(sorted(cells))
+                    if key not in made:
+                        made[key] = self.make_cage(key, square)
+                    cages.append(made[key])
+
+                found = self.solutions(cages)
+                if len(found) == 1:
+                    self.stats['puzzles'] += 1
+                    return [[n]] + cages, square
+                if attempt < self.max_repairs:
+                    self.stats['repairs'] += 1
+                    self.repair(partition, found[0], found[1])
+
+def generate_puzzles(n, count, seed=None, **kwargs):
+    '''
+    Return a list of count (kenken_grid, solution) pairs of n x n puzzles with
+    a unique solution.
+    '''
+    generator = KenKenGenerator(n, seed=seed, **kwargs)
+    return [generator.generate() for _ in range(count)]
@@ -0,0 +1,352 @@
+'''
+This file contains a min-conflicts local search solver over the CSP and
+Constraint objects of cspbase.py, for finding some solution of large boards
+quickly. It is incomplete: it can fail to find a solution that exists, and
+cannot prove that there is none, so it can fall back to BT when completeness
+is asked for.
+
+1. LocalSearch object
+    - Created over a CSP. solve() returns a SolveResult, like bt_search, and
+      assigns the solution found to the Variables of the CSP.
+    - Statistics of the last run: nIterations, nRestarts, runtime, and
+      iterations_per_second().
+
+The search works on complete assignments:
+    1. The CSP is propagated once at the root (prop_GAC by default); cells
+       whose domain is a single value are fixed.
+    2. Disjoint all-different constraints whose scope must use every value
+       (the rows of a KenKen board) are kept permutations: their cells start
+       as a random perfect matching of cells to values of their current
+       domains, and only ever swap values. They are never violated.
+    3. Every other constraint counts as violated if its values fail check();
+       an all-different constraint (a column) counts one violation per
+       repeated value. A cell holding a value outside its current domain
+       counts as one violation too (swaps kept within the domains could not
+       reach every permutation of a row). Counts are updated incrementally:
+       a move only re-evaluates the constraints over the cells it changes,
+       and all-different constraints keep the number of cells holding each
+       value.
+    4. Each iteration takes the cells of a random violated constraint (or a
+       cell outside its domain) and makes the best move for them
+       (min-conflicts): a swap with another cell of the row, or a new value
+       for a cell in no row. Moves that give a cell back
+       a value it recently held are tabu for tabu_tenure iterations, unless
+       they reach a new best cost. With probability walk_prob a random move
+       is made instead (random walk). After restart_after iterations without
+       a new best cost the search restarts from a new random assignment.
+'''
+
+import random
+import time
+
+from cspbase import BT, SolveResult
+from heuristics import ord_mrv
+from propagators import prop_GAC
+
+class LocalSearch:
+    '''
+    Class for the min-conflicts local search of a CSP (see the file header).
+    '''
+
+    def __init__(self, csp, seed=None, tabu_tenure=10, walk_prob=0.1,
+                 restart_after=2000):
+        '''
+        Create a local search over csp. seed seeds the search's own random
+        number generator.
+        '''
+        self.csp = csp
+        self.rng = random.Random(seed)
+        self.tabu_tenure = tabu_tenure
+        self.walk_prob = walk_prob
+        self.restart_after = restart_after
+        self.nIterations = 0
+        self.nRestarts = 0
+        self.runtime = 0
+
+    def iterations_per_second(self):
+        '''Return the iteration rate of the last run'''
+        if not self.runtime:
+            return 0.0
+        return self.nIterations / self.runtime
+
+    def print_stats(self):
+        print("Local search made {} iterations ({:.0f} per second) and {} restarts".format(
+            self.nIterations, self.iterations_per_second(), self.nRestarts))
+
+    def setup(self):
+        '''
+        Internal routine. Find the permutation groups (rows), the domains and
+        fixed cells, and the constraints to count violations of.
+        '''
+        csp = self.csp
+        csp.reindex()
+        n_vars = len(csp.vars)
+        self.doms = [var.cur_domain() for var in csp.vars]
+        self.domsets = [set(dom) for dom in self.doms]
+        self.fixed = [len(dom) == 1 for dom in self.doms]
+
+        #disjoint all-different constraints that must use every value
+        self.group = [None] * n_vars #group of each var id, or None
+        self.groups = []
+        for c in csp.get_all_cons():
+            if not c.alldiff:
+                continue
+            ids = [var.id for var in c.scope]
+            values = set(val for i in ids for val in self.doms[i])
+            if len(values) == len(ids) and \
+               all(self.group[i] is None for i in ids):
+                for i in ids:
+                    self.group[i] = len(self.groups)
+                self.groups.append(ids)
+
+        #constraints that can be violated, by var id
+        self.cons = [c for c in csp.get_all_cons()
+                     if not (c.alldiff and
+                             len(set(self.group[var.id] for var in c.scope)) == 1
+                             and self.group[c.scope[0].id] is not None)]
+        self.scope_ids = [[var.id for var in c.scope] for c in self.cons]
+        self.var_cons = [[] for i in range(n_vars)]
+        for k, ids in enumerate(self.scope_ids):
+            for i in ids:
+                self.var_cons[i].append(k)
+
+    def restart(self):
+        '''
+        Internal routine. Draw a new random assignment: a random perfect
+        matching of cells to values for every group, and a random value for
+        every other cell. Return False if a group has no perfect matching.
+        '''
+        rng = self.rng
+        vals = [None] * len(self.doms)
+        for ids in self.groups:
+            match = dict() #val -> var id
+            order = list(ids)
+            rng.shuffle(order)
+
+            def augment(i, seen):
+                dom = list(self.doms[i])
+                rng.shuffle(dom)
+                for val in dom:
+                    if val in seen:
+                        continue
+                    seen.add(val)
+                    if val not in match or augment(match[val], seen):
+                        match[val] = i
+                        return True
+                return False
+
+            for i in order:
+                if not augment(i, set()):
+                    return False
+            for val, i in match.items():
+                vals[i] = val
+        for i, dom in enumerate(self.doms):
+            if self.group[i] is None:
+                vals[i] = rng.choice(dom)
+        self.vals = vals
+
+        #violation counts
+        self.counts = []
+        self.viol = []
+        for k, c in enumerate(self.cons):
+            if c.alldiff:
+                counts = dict()
+                for i in self.scope_ids[k]:
+                    counts[vals[i]] = counts.get(vals[i], 0) + 1
+                self.counts.append(counts)
+                self.viol.append(sum(cnt - 1 for cnt in counts.values()))
+            else:
+                self.counts.append(None)
+                self.viol.append(0 if c.check([vals[i] for i in self.scope_ids[k]])
+                                 else 1)
+        self.violated = set(k for k, v in enumerate(self.viol) if v)
+        self.outside = set() #cells holding a value outside their domain
+        self.cost = sum(self.viol)
+        return True
+
+    def set_value(self, i, val):
+        '''
+        Internal routine. Give val to the cell of var id i, updating the
+        violation counts of its constraints incrementally.
+        '''
+        old = self.vals[i]
+        if old == val:
+            return
+        self.vals[i] = val
+        vals = self.vals
+        if val in self.domsets[i]:
+            if i in self.outside:
+                self.outside.discard(i)
+                self.cost -= 1
+        elif i not in self.outside:
+            self.outside.add(i)
+            self.cost += 1
+        for k in self.var_cons[i]:
+            counts = self.counts[k]
+            if counts is not None:
+                before = self.viol[k]
+                counts[old] -= 1
+                after = before - 1 if counts[old] >= 1 else before
+                counts[val] = counts.get(val, 0) + 1
+                if counts[val] >= 2:
+                    after += 1
+            else:
+                before = self.viol[k]
+                scope_vals = [vals[j] for j in self.scope_ids[k]]
+                after = 0 if self.cons[k].check(scope_vals) else 1
+            if after != before:
+                self.viol[k] = after
+                self.cost += after - before
+                if after:
+                    self.violated.add(k)
+                else:
+                    self.violated.discard(k)
+
+    def moves(self, i):
+        '''
+        Internal routine. Return the moves of the cell of var id i: pairs
+        (j, val) giving val to i, and i's value to j if j is not None.
+        '''
+        vals, doms = self.vals, self.doms
+        g = self.group[i]
+        if g is None:
+            return [(None, val) for val in doms[i] if val != vals[i]]
+        moves = []
+        for j in self.groups[g]:
+            if j != i and not self.fixed[j]:
+                moves.append((j, vals[j]))
+        return moves
+
+    def apply(self, i, move):
+        '''Internal routine. Make a move of the cell of var id i'''
+        j, val = move
+        if j is not None:
+            self.set_value(j, self.vals[i])
+        self.set_value(i, val)
+
+    def solve(self, max_iters=100000, time_limit=None, complete=False,
+              propagator=prop_GAC, var_ord=ord_mrv):
+        '''
+        Search for a solution for at most max_iters iterations and, if
+        time_limit is not None, time_limit seconds of CPU time. Return a
+        SolveResult: SOLVED (nDecisions is the number of iterations), or
+        TIMEOUT if no solution was found within the limits (limit names the
+        limit reached), or UNSOLVABLE if root propagation fails.
+
+        If complete is True, a run that does not find a solution falls back
+        to BT.bt_search(propagator, var_ord), whose result is returned.
+        '''
+        csp = self.csp
+        rng = self.rng
+        stime = time.process_time()
+        self.nIterations = 0
+        self.nRestarts = 0
+
+        for var in csp.vars:
+            if var.is_assigned():
+                var.unassign()
+            var.restore_curdom()
+        status, prunings = propagator(csp)
+        solved = False
+        limit = 'iterations'
+        if status:
+            self.setup()
+            status = self.restart()
+        if status:
+            movable = [i for i in range(len(self.doms)) if not self.fixed[i]]
+            tabu = dict() #(var id, val) -> last iteration it is tabu
+            best = self.cost
+            since_best = 0
+            while self.cost > 0:
+                if self.nIterations >= max_iters:
+                    break
+                if time_limit is not None and self.nIterations % 100 == 0 and \
+                   time.process_time() - stime >= time_limit:
+                    limit = 'cpu_time'
+                    break
+                self.nIterations += 1
+                it = self.nIterations
+
+                if since_best >= self.restart_after:
+                    self.nRestarts += 1
+                    self.restart()
+                    tabu.clear()
+                    best = self.cost
+                    since_best = 0
+                    continue
+
+                #the cells of a random violated constraint, or a cell outside
+                #its domain
+                if self.outside and (not self.violated or rng.random() < 0.5):
+                    cells = [rng.choice(tuple(self.outside))]
+                else:
+                    k = rng.choice(tuple(self.violated))
+                    cells = [i for i in self.scope_ids[k] if not self.fixed[i]]
+                    if not cells:
+                        cells = movable
+                moves = [(i, m) for i in cells for m in self.moves(i)]
+                if not moves:
+                    since_best += 1
+                    continue
+
+                if rng.random() < self.walk_prob:
+                    i, move = rng.choice(moves)
+                else:
+                    #min-conflicts: the best non-tabu move, ties broken randomly
+                    move = None
+                    best_cost = None
+                    ties = 0
+                    for i, candidate in moves:
+                        old = self.vals[i]
+                        j, val = candidate
+                        is_tabu = tabu.get((i, val), 0) >= it or \
+                                  (j is not None and tabu.get((j, old), 0) >= it)
+                        self.apply(i, candidate)
+                        cost = self.cost
+                        #undo the move
+                        if j is not None:
+                            self.set_value(j, val)
+                        self.set_value(i, old)
+                        if is_tabu and cost >= best:
+                            continue
+                        if best_cost is None or cost < best_cost:
+                            move, best_cost, ties = (i, candidate), cost, 1
+                        elif cost == best_cost:
+                            ties += 1
+                            if rng.randrange(ties) == 0:
+                                move = (i, candidate)
+                    if move is None:
+                        move = rng.choice(moves)
+                    i, move = move
+
+                j, val = move
+                old = self.vals[i]
+                tabu[(i, old)] = it + self.tabu_tenure
+                if j is not None:
+                    tabu[(j, val)] = it + self.tabu_tenure
+                self.apply(i, move)
+                if self.cost < best:
+                    best = self.cost
+                    since_best = 0
+                else:
+                    since_best += 1
+            solved = self.cost == 0
+
+        self.runtime = time.process_time() - stime
+        if solved:
+            solution = list(self.vals)
+            for var in csp.vars:
+                var.restore_curdom()
+            for var, val in zip(csp.vars, solution):
+                var.assign(val)
+            return SolveResult(SolveResult.SOLVED, solution, self.nIterations,
+                               0, self.runtime)
+        for var in csp.vars:
+            var.restore_curdom()
+        if status and complete:
+            return BT(csp).bt_search(propagator, var_ord)
+        if not status:
+            return SolveResult(SolveResult.UNSOLVABLE, None, self.nIterations,
+                               0, self.runtime)
+        return SolveResult(SolveResult.TIMEOUT, None, self.nIterations, 0,
+                           self.runtime, limit=limit)
@@ -0,0 +1,165 @@
+'''
+This file contains a low-overhead profiling surface for bt_search.
+
+1. Profiler object
+    - Collects counters and timings while a BT object searches.
+    - Attach it with BT.set_profiler(profiler). Detach it with
+      BT.set_profiler(None). When no profiler is attached, bt_search and the
+      propagators only pay for a single attribute test per call.
+    - Records, per propagator, per constraint and per heuristic, the number of
+      calls and the time spent in them. Also counts domain wipe-outs (DWOs)
+      per constraint and backtracks per search level.
+    - Optional callbacks can be registered for any of the events in
+      Profiler.EVENTS. A callback is only invoked if one is registered.
+    - Results can be exported with as_dict() or to_json().
+
+The events (and the arguments handed to their callbacks) are:
+    'propagator_enter'  (propagator, var)
+    'propagator_exit'   (propagator, var, status, prunings)
+    'revise'            (constraint, elapsed)
+    'wipeout'           (constraint, var)
+    'heuristic'         (heuristic, result)
+    'backtrack'         (var, val, level)
+
+Propagators report constraint revisions through revise() and wipeout(); BT
+reports the rest.
+'''
+
+import json
+import time
+
+class Profiler:
+    '''
+    Class for collecting counters and timings during search. One Profiler can
+    be reused over several searches; use reset() to clear it.
+    '''
+
+    EVENTS = ('propagator_enter', 'propagator_exit', 'revise', 'wipeout',
+              'heuristic', 'backtrack')
+
+    def __init__(self, clock=time.perf_counter):
+        '''
+        Create a profiler. Optionally specify the clock function used for
+        timings (defaults to time.perf_counter).
+        '''
+        self.clock = clock
+        self.callbacks = {event: [] for event in Profiler.EVENTS}
+        self.reset()
+
+    def reset(self):
+        '''Clear all counters and timings (callbacks are kept)'''
+        self.counts = {event: 0 for event in Profiler.EVENTS}
+        self.propagators = dict() #name -> [calls, time, prunings, failures]
+        self.constraints = dict() #name -> [revisions, time, wipeouts]
+        self.heuristics = dict()  #name -> [calls, time]
+        self.backtracks = dict()  #level -> no. of backtracks
+
+    def add_callback(self, event, fn):
+        '''Call fn with the event's arguments every time event fires'''
+        if event not in self.callbacks:
+            raise ValueError("Unknown profiler event {}".format(event))
+        self.callbacks[event].append(fn)
+
+    def remove_callback(self, event, fn):
+        '''Stop calling fn on event'''
+        self.callbacks[event].remove(fn)
+
+    def fire(self, event, *args):
+        '''Count event and pass args to its callbacks (if any)'''
+        self.counts[event] += 1
+        for fn in self.callbacks[event]:
+            fn(*args)
+
+    # Hooks used by BT
+    def time_propagator(self, propagator, csp, var=None):
+        '''
+        Run propagator(csp, var), recording the call and returning the
+        propagator's (status, prunings) pair unchanged.
+        '''
+        self.fire('propagator_enter', propagator, var)
+        stime = self.clock()
+        status, prunings = propagator(csp, var)
+        elapsed = self.clock() - stime
+
+        stats = self.propagators.get(propagator.__name__)
+        if stats is None:
+            stats = self.propagators[propagator.__name__] = [0, 0.0, 0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += len(prunings)
+        if not status:
+            stats[3] += 1
+
+        self.fire('propagator_exit', propagator, var, status, prunings)
+        return status, prunings
+
+    def time_heuristic(self, heuristic, *args):
+        '''Run heuristic(*args), recording the call and returning its result'''
+        stime = self.clock()
+        result = heuristic(*args)
+        elapsed = self.clock() - stime
+
+        stats = self.heuristics.get(heuristic.__name__)
+        if stats is None:
+            stats = self.heuristics[heuristic.__name__] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+
+        self.fire('heuristic', heuristic, result)
+        return result
+
+    def backtrack(self, var, val, level):
+        '''Record that the assignment var = val at level was undone'''
+        self.backtracks[level] = self.backtracks.get(level, 0) + 1
+        self.fire('backtrack', var, val, level)
+
+    # Hooks used by propagators
+    def revise(self, c, stime):
+        '''
+        Record that constraint c was revised, the revision having started at
+        clock time stime.
+        '''
+        elapsed = self.clock() - stime
+        stats = self.constraints.get(c.name)
+        if stats is None:
+            stats = self.constraints[c.name] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        self.fire('revise', c, elapsed)
+
+    def wipeout(self, c, var):
+        '''Record that revising constraint c wiped out the domain of var'''
+        stats = self.constraints.get(c.name)
+        if stats is None:
+            stats = self.constraints[c.name] = [0, 0.0, 0]
+        stats[2] += 1
+        self.fire('wipeout', c, var)
+
+    # Reporting
+    def hot_constraints(self, k=10):
+        '''
+        Return the names of the k constraints that took the most time, paired
+        with their time, most expensive first.
+        '''
+        ranked = sorted(self.constraints.items(), key=lambda item: -item[1][1])
+        return [(name, stats[1]) for name, stats in ranked[:k]]
+
+    def as_dict(self):
+        '''Return all counters and timings as a dict of plain values'''
+        return {
+            'events': dict(self.counts),
+            'propagators': {name: {'calls': s[0], 'time': s[1],
+                                   'prunings': s[2], 'failures': s[3]}
+                            for name, s in self.propagators.items()},
+            'constraints': {name: {'revisions': s[0], 'time': s[1],
+                                   'wipeouts': s[2]}
+                            for name, s in self.constraints.items()},
+            'heuristics': {name: {'calls': s[0], 'time': s[1]}
+                           for name, s in self.heuristics.items()},
+            'backtracks': {str(level): n
+                           for level, n in sorted(self.backtracks.items())},
+        }
+
+    def to_json(self, indent=None):
+        '''Return as_dict() serialized as a JSON string'''
+        return json.dumps(self.as_dict(), indent=indent)
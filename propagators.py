@@ -27,8 +27,32 @@ pruned (using the variable's prune_value method). bt_search needs to know
 this in order to correctly restore these values when it undoes a variable 
 assignment.
 
+If a Profiler is attached to the csp (csp.profiler, see profiler.py), 
+propagators report every constraint revision and domain wipe-out to it.
+
+prop_LS adds Latin-square reasoning on the all-different rows and columns and 
+is meant to be run alongside another propagator; combine(prop_GAC, prop_LS) 
+returns a propagator doing both.
+
+prop_BC is a tier between prop_FC and prop_GAC: it enforces bounds 
+consistency (Hall intervals) on the all-different constraints instead of 
+GAC, and GAC on the others.
+
+prop_FC, prop_BC and prop_GAC are configurations of one propagation engine, 
+propagate(csp, newVar, revise, fixpoint): constraints are queued by priority 
+(cheap ones such as bounds reasoning before tables and matching-based 
+all-different) and, when propagating to a fixpoint, a constraint is revised 
+again only when a domain event it subscribes to (a variable of its scope 
+assigned, its bounds changed, or any value removed) happens. See 
+Constraint.events and Constraint.priority in cspbase.py.
+
 '''
 
+import collections
+
+from cspbase import EVENT_ALL, EVENT_ASSIGNED, EVENT_BOUNDS, EVENT_REMOVED, \
+                    N_PRIORITIES
+
 def prop_BT(csp, newVar=None):
     '''
     Do plain backtracking propagation. That is, do no propagation at all. Only 
@@ -62,47 +86,11 @@ def prop_FC(csp, newVar=None):
     If newVar is None, forward check all constraints whose scope contains one 
     variable. Otherwise if newVar = V, forward check constraints containing V
     that have one unassigned variable left.
-    '''
-    pruned = []
-    
-    if newVar: #check constraints containing newVar
-        constraints = csp.get_cons_with_var(newVar)
-    else: #check all constraints
-        constraints = csp.get_all_cons()
 
-    for c in constraints:
-        
-        #if only 1 var in constraint c's scope is unassigned
-        if c.get_n_unasgn() == 1:
-            v = c.get_unasgn_vars()[0]
-            
-            #loop through list of [vals in current domain of unassigned var]
-            for d in v.cur_domain(): #check d & prune if violates
-                
-                #assign d to value of unassigned var
-                v.assign(d)
-                
-                #loop through scope of c, add variables' vals in scope order
-                vals = []
-                vars = c.get_scope()
-                for var in vars:
-                    vals.append(var.get_assigned_value())
-                
-                #if vals assignments don't satisfy constraint c
-                if not c.check(vals):
-                    #if d is in v's domain && v not yet pruned
-                    if (v.in_cur_domain(d)) and ((v, d) not in pruned):
-                        #prune d from current domain (of v)
-                        v.prune_value(d)
-                        pruned.append((v, d))
-
-                #unassign d
-                v.unassign()
-                    
-                if v.cur_domain_size() == 0: #DWO
-                    return False, pruned
-
-    return True, pruned
+    This is the propagation engine run once over the constraints (prunings 
+    do not wake further constraints) with revise_FC.
+    '''
+    return propagate(csp, newVar, revise_FC, fixpoint=False)
 
 def prop_GAC(csp, newVar=None):
     '''
@@ -111,34 +99,444 @@ def prop_GAC(csp, newVar=None):
     If newVar is None, we initialise the GAC queue (do GAC enforce) with all 
     constraints of the CSP. Otherwise if newVar = V, we initialise the queue
     with constraints containing V.
-    
+ 
     note: CSP is GAC iff all constraints are GAC.
     A constraint is GAC iff it's GAC w/r/t each var in scope.
     A constraint is GAC w/r/t a var iff for every value of V_i exist values 
     that satisfy C.
+
+    This is the propagation engine run to a fixpoint with revise_GAC: a 
+    pruning wakes the constraints subscribed to the events it causes.
+    '''
+    return propagate(csp, newVar, revise_GAC)
+
+def prop_BC(csp, newVar=None):
+    '''
+    Do bounds-consistency propagation on the all-different constraints 
+    (those flagged alldiff) and GAC propagation on the others: a tier 
+    between prop_FC and prop_GAC, which replaces the matching-based (or 
+    table) revision of the rows and columns by Hall interval reasoning. 
+
+    If newVar is None, all constraints are revised; otherwise if newVar = V, 
+    the constraints containing V. Propagation runs to a fixpoint: 
+    all-different constraints are revised again whenever the bounds of a 
+    variable of their scope change, the others on their own events.
+    '''
+    return propagate(csp, newVar, revise_BC, events=events_BC)
+
+def revise_FC(c):
+    '''
+    Forward checking revision of constraint c. If exactly one variable of its 
+    scope is unassigned, return the (var, val) pairs of that variable's 
+    values that violate c given the assigned values; otherwise return [].
+    '''
+    if c.get_n_unasgn() != 1:
+        return []
+    v = c.get_unasgn_vars()[0]
+    i = c.var_pos[v]
+    vals = [var.get_assigned_value() for var in c.scope]
+    pairs = []
+    #loop through list of [vals in current domain of unassigned var]
+    for d in v.cur_domain():
+        vals[i] = d
+        #if vals assignments don't satisfy constraint c
+        if not c.check(vals):
+            pairs.append((v, d))
+    return pairs
+
+def revise_GAC(c):
+    '''
+    GAC revision of constraint c: return the (var, val) pairs without a 
+    supporting tuple in c.
+    '''
+    return c.unsupported()
+
+def revise_BC(c):
+    '''
+    Bounds-consistency revision of constraint c if it is an all-different 
+    constraint (see alldiff_bounds), GAC revision otherwise.
+    '''
+    if c.alldiff:
+        return alldiff_bounds(c.scope)
+    return c.unsupported()
+
+def events_BC(c):
+    '''
+    The domain events prop_BC revises constraint c on: bounds changes for 
+    all-different constraints, the constraint's own events otherwise.
+    '''
+    return EVENT_BOUNDS | EVENT_ASSIGNED if c.alldiff else c.events
+
+def alldiff_bounds(scope):
+    '''
+    Return the (var, val) pairs that the all-different constraint over scope 
+    rules out by bounds consistency. As bounds reasoning cannot remove a 
+    value inside a domain, the values of variables with a single value left 
+    are first removed from the others; then every domain is narrowed to the 
+    bounds allowed by its Hall intervals (see hall_bounds), and both steps 
+    are repeated until nothing changes. If the constraint cannot be 
+    satisfied, every value of the unassigned variables is returned.
+    '''
+    doms = [v.cur_domain() for v in scope]
+    while True:
+        changed = False
+        fixed = [dom[0] for dom in doms if len(dom) == 1]
+        if len(fixed) != len(set(fixed)):
+            doms = None
+            break
+        fixed = set(fixed)
+        for i, dom in enumerate(doms):
+            if len(dom) > 1 and not fixed.isdisjoint(dom):
+                doms[i] = [d for d in dom if d not in fixed]
+                changed = True
+        if changed and not all(doms):
+            doms = None
+            break
+
+        narrowed = hall_bounds([min(dom) for dom in doms], 
+                               [max(dom) for dom in doms])
+        if narrowed is None:
+            doms = None
+            break
+        for i, (low, high) in enumerate(zip(*narrowed)):
+            dom = doms[i]
+            if low > min(dom) or high < max(dom):
+                doms[i] = [d for d in dom if low <= d <= high]
+                changed = True
+        if not all(doms): #the narrowed interval held no value
+            doms = None
+            break
+        if not changed:
+            break
+
+    if doms is None: #no solution
+        return [(v, d) for v in scope if not v.is_assigned() 
+                for d in v.cur_domain()]
+    pairs = []
+    for v, dom in zip(scope, doms):
+        if len(dom) < v.cur_domain_size():
+            kept = set(dom)
+            pairs.extend((v, d) for d in v.cur_domain() if d not in kept)
+    return pairs
+
+def pathmax(a, i):
+    '''Internal routine. Follow the links of a up from i, to their end'''
+    while a[i] > i:
+        i = a[i]
+    return i
+
+def pathmin(a, i):
+    '''Internal routine. Follow the links of a down from i, to their end'''
+    while a[i] < i:
+        i = a[i]
+    return i
+
+def pathset(a, start, end, to):
+    '''Internal routine. Point the links of a from start up to end at to'''
+    l = start
+    while l != end:
+        k = l
+        l = a[k]
+        a[k] = to
+
+def hall_bounds(lows, highs):
+    '''
+    Bounds consistency for all-different on the intervals [lows[i], 
+    highs[i]], in O(n log n) with the algorithm of Lopez-Ortiz, Quimper, 
+    Tromp and van Beek (2003): the intervals are visited by increasing upper 
+    bound, pushing up the lower bounds that fall in a Hall interval (a range 
+    of k values that k variables must take), then symmetrically by 
+    decreasing lower bound. Returns the lists of narrowed lower and upper 
+    bounds, or None if the variables cannot all take different values.
+    '''
+    n = len(lows)
+    minsorted = sorted(range(n), key=lambda i: lows[i])
+    maxsorted = sorted(range(n), key=lambda i: highs[i])
+
+    #bounds holds the distinct lows and highs + 1 in increasing order, 
+    #between two sentinels; the ranks are the indices of a variable's bounds
+    minrank = [0] * n
+    maxrank = [0] * n
+    lo = lows[minsorted[0]]
+    hi = highs[maxsorted[0]] + 1
+    last = lo - 2
+    bounds = [last]
+    i = j = 0
+    while True:
+        if i < n and lo <= hi:
+            if lo != last:
+                last = lo
+                bounds.append(lo)
+            minrank[minsorted[i]] = len(bounds) - 1
+            i += 1
+            if i < n:
+                lo = lows[minsorted[i]]
+        else:
+            if hi != last:
+                last = hi
+                bounds.append(hi)
+            maxrank[maxsorted[j]] = len(bounds) - 1
+            j += 1
+            if j == n:
+                break
+            hi = highs[maxsorted[j]] + 1
+    nb = len(bounds) - 1
+    bounds.append(bounds[nb] + 2)
+    new_lows = list(lows)
+    new_highs = list(highs)
+
+    #t links the bounds into the critical capacities (d) still left, h into 
+    #the Hall intervals found so far; both are compressed as they are walked
+    t = [0] * (nb + 2)
+    h = [0] * (nb + 2)
+    d = [0] * (nb + 2)
+    for k in range(1, nb + 2):
+        t[k] = h[k] = k - 1
+        d[k] = bounds[k] - bounds[k-1]
+    #push up the lower bounds
+    for v in maxsorted:
+        x = minrank[v]
+        y = maxrank[v]
+        z = pathmax(t, x + 1)
+        j = t[z]
+        d[z] -= 1
+        if d[z] == 0:
+            t[z] = z + 1
+            z = pathmax(t, t[z])
+            t[z] = j
+        pathset(t, x + 1, z, z)
+        if d[z] < bounds[z] - bounds[y]:
+            return None
+        if h[x] > x:
+            w = pathmax(h, h[x])
+            new_lows[v] = bounds[w]
+            pathset(h, x, w, w)
+        if d[z] == bounds[z] - bounds[y]:
+            pathset(h, h[y], j - 1, y)
+            h[y] = j - 1
+    #symmetrically, push down the upper bounds
+    for k in range(0, nb + 1):
+        t[k] = h[k] = k + 1
+        d[k] = bounds[k+1] - bounds[k]
+    for v in reversed(minsorted):
+        x = maxrank[v]
+        y = minrank[v]
+        z = pathmin(t, x - 1)
+        j = t[z]
+        d[z] -= 1
+        if d[z] == 0:
+            t[z] = z - 1
+            z = pathmin(t, t[z])
+            t[z] = j
+        pathset(t, x - 1, z, z)
+        if d[z] < bounds[y] - bounds[z]:
+            return None
+        if h[x] < x:
+            w = pathmin(h, h[x])
+            new_highs[v] = bounds[w] - 1
+            pathset(h, x, w, w)
+        if d[z] == bounds[y] - bounds[z]:
+            pathset(h, h[y], j + 1, y)
+            h[y] = j + 1
+    return new_lows, new_highs
+
+def domain_events(removed):
+    '''
+    Given a list of (var, val) pairs just pruned, return a list of (var, 
+    events) pairs, one per variable, where events is the mask of domain 
+    events (EVENT_ASSIGNED, EVENT_BOUNDS, EVENT_REMOVED) the prunings caused.
+    '''
+    lost = dict() #var -> list of [values pruned]
+    for v, d in removed:
+        if v in lost:
+            lost[v].append(d)
+        else:
+            lost[v] = [d]
+    events = []
+    for v, vals in lost.items():
+        dom = v.cur_domain()
+        if len(dom) == 1:
+            events.append((v, EVENT_ALL))
+        elif min(vals) < min(dom) or max(vals) > max(dom):
+            events.append((v, EVENT_BOUNDS | EVENT_REMOVED))
+        else:
+            events.append((v, EVENT_REMOVED))
+    return events
+
+def propagate(csp, newVar, revise, fixpoint=True, events=None):
+    '''
+    The propagation engine. Constraints wait in one FIFO queue per priority 
+    (Constraint.priority) and the cheapest queued constraint is revised 
+    first: revise(c) returns the (var, val) pairs to prune.
+
+    If newVar is None, every constraint is queued; otherwise if newVar = V, 
+    the constraints containing V (its assignment fires every event). If 
+    fixpoint is True, the values a revision prunes fire domain events (see 
+    domain_events) on their variables, and the constraints over those 
+    variables subscribed to one of the events (Constraint.events, or
+    events(c) if an events function is given) are queued, unless already
+    queued. An idempotent constraint is not woken by its own prunings.
+
+    Returns a propagator's (status, pruned) pair.
     '''
     pruned = []
-    
-    if newVar: #check constraints containing newVar
+
+    if newVar: #wake constraints containing newVar
         constraints = csp.get_cons_with_var(newVar)
-    else: #check all constraints
+    else: #wake all constraints
         constraints = csp.get_all_cons()
 
+    queues = [collections.deque() for p in range(N_PRIORITIES)]
+    queued = [False] * len(csp.cons) #queued[c.id]: c is in a queue
     for c in constraints:
-        for v in c.get_scope():
-        
-            #loop through list of [vals in current domain of v]
-            for d in v.cur_domain():
+        queued[c.id] = True
+        queues[c.priority].append(c)
+
+    profiler = csp.profiler
+    var_cons = csp.var_cons
+
+    p = 0 #no queue below p holds a constraint
+    while p < N_PRIORITIES:
+        if not queues[p]:
+            p += 1
+            continue
+        c = queues[p].popleft()
+        queued[c.id] = False
+        if profiler:
+            stime = profiler.clock()
+
+        removed = []
+        #loop through list of [(var, val) pairs the revision rules out]
+        for v, d in revise(c):
+            if v.in_cur_domain(d):
+                #prune d from current domain (of v)
+                v.prune_value(d)
+                removed.append((v, d))
 
-                #test if (var, val) pair has supporting tuple in c
-                if not c.has_support(v, d):
-                    
-                    if (v.in_cur_domain(d)) and ((v, d) not in pruned):
-                        #prune d from current domain (of v)
-                        v.prune_value(d)
-                        pruned.append((v, d))
-                
                 if v.cur_domain_size() == 0: #DWO
+                    pruned.extend(removed)
+                    if profiler:
+                        profiler.wipeout(c, v)
+                        profiler.revise(c, stime)
                     return False, pruned
 
-    return True, pruned
\ No newline at end of file
+        if profiler:
+            profiler.revise(c, stime)
+        if not removed:
+            continue
+        pruned.extend(removed)
+
+        if fixpoint:
+            for v, fired in domain_events(removed):
+                for other in var_cons[v.id]:
+                    if queued[other.id]:
+                        continue
+                    wanted = other.events if events is None else events(other)
+                    if not (wanted & fired):
+                        continue
+                    if other is c and c.idempotent:
+                        continue
+                    queued[other.id] = True
+                    queues[other.priority].append(other)
+                    if other.priority < p:
+                        p = other.priority
+
+    return True, pruned
+
+def prop_LS(csp, newVar=None):
+    '''
+    Do Latin-square value-placement propagation (hidden singles) on the 
+    constraints flagged alldiff whose scope must hold every value of the 
+    domain, i.e. the rows and columns of a KenKen board. 
+
+    For each such line, count the cells that can still take each value. If a 
+    value has no possible cell, we have a dead-end. If it has exactly one, 
+    that cell's domain is restricted to the value (all its other values are 
+    pruned, so bt_search restores them on backtrack). Lines of restricted 
+    cells are checked again until nothing changes.
+
+    If newVar is None, check every line; otherwise if newVar = V, check the 
+    lines containing V.
+
+    The counts are rebuilt for every line checked, at O(n^2) per line on an n 
+    x n board (O(n^3) when every line is checked), rather than kept up to 
+    date between calls: Variables report no domain events, and the values 
+    pruned by other propagators and restored by bt_search on backtrack would 
+    all have to update them.
+    '''
+    pruned = []
+
+    if newVar: #check lines containing newVar
+        lines = [c for c in csp.get_cons_with_var(newVar) if c.alldiff]
+    else: #check all lines
+        lines = [c for c in csp.get_all_cons() if c.alldiff]
+
+    profiler = csp.profiler
+    queued = [False] * len(csp.cons) #queued[c.id]: line c is in lines
+    for c in lines:
+        queued[c.id] = True
+
+    while lines:
+        c = lines.pop()
+        queued[c.id] = False
+        if profiler:
+            stime = profiler.clock()
+
+        #places[d] = list of [cells of c that can still take value d]
+        places = dict()
+        values = set()
+        for v in c.scope:
+            values.update(v.dom)
+            for d in v.cur_domain():
+                if d in places:
+                    places[d].append(v)
+                else:
+                    places[d] = [v]
+
+        #every value must be placed only if there are as many cells as values
+        if len(values) == len(c.scope):
+            for d in values:
+                cells = places.get(d)
+                if not cells: #value d fits nowhere
+                    if profiler:
+                        profiler.wipeout(c, None)
+                        profiler.revise(c, stime)
+                    return False, pruned
+                if len(cells) > 1:
+                    continue
+                v = cells[0]
+                if v.is_assigned() or v.cur_domain_size() == 1:
+                    continue
+                #d must go in v: prune every other value of v
+                for other in v.cur_domain():
+                    if other != d:
+                        v.prune_value(other)
+                        pruned.append((v, other))
+                #and look again at the other lines through v
+                for line in csp.get_cons_with_var(v):
+                    if line.alldiff and not queued[line.id]:
+                        queued[line.id] = True
+                        lines.append(line)
+
+        if profiler:
+            profiler.revise(c, stime)
+
+    return True, pruned
+
+def combine(*propagators):
+    '''
+    Returns a propagator that runs each of the given propagators in turn 
+    (with the same arguments), stopping at the first dead-end. Its prunings 
+    are those of all the propagators run.
+    Example: combine(prop_GAC, prop_LS)
+    '''
+    def prop_combined(csp, newVar=None):
+        pruned = []
+        for propagator in propagators:
+            status, prunings = propagator(csp, newVar)
+            pruned.extend(prunings)
+            if not status:
+                return False, pruned
+        return True, pruned
+    prop_combined.__name__ = '+'.join(p.__name__ for p in propagators)
+    return prop_combined
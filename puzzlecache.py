@@ -0,0 +1,279 @@
+'''
+This file contains a canonical form for KenKen grids, to recognise puzzles
+that are the same up to transposition or the order of their cages and
+cells, and a persistent cache of solver results keyed by a hash of that
+form.
+
+1. canonical_grid(kenken_grid)
+    - Returns (canonical, transposed): the canonical form of the grid, and
+      whether it is the form of the transposed grid.
+    - The canonical form writes cells as (row, column) pairs, sorts the cells
+      of every cage and sorts the cages by their cells. Of the forms of the
+      grid and of its transpose (rows and columns swapped, which maps
+      solutions to solutions), the smaller one is canonical.
+
+2. puzzle_hash(kenken_grid)
+    - Returns the SHA-256 hex digest of the canonical form, packed as
+      integers.
+
+3. ResultCache object
+    - A SQLite store of SolveResults keyed by puzzle_hash, in a file (or in
+      memory with ':memory:').
+    - get(kenken_grid) returns the cached result of a puzzle or None;
+      put(kenken_grid, result) stores one. Solutions are stored in the
+      canonical orientation and transposed back for a transposed puzzle.
+    - solve(kenken_grid, solver=None) returns the cached result, or runs
+      solver(kenken_grid) (by default bt_search with prop_GAC and ord_mrv)
+      and caches its result. solve_batch(grids, solver) solves a list of
+      puzzles, solving duplicates only once.
+    - lookup_cost() reports the mean time of a lookup (canonical form, hash
+      and query), hit_rate() the fraction of lookups answered without
+      solving; as_dict() returns all the counters.
+
+Results stopped by a search limit (TIMEOUT) are not cached, since they
+depend on the limits rather than on the puzzle. A cached result keeps the
+statistics of the run that produced it.
+'''
+
+import array
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+
+from cspbase import BT, SolveResult
+from heuristics import ord_mrv
+from kenken_csp import kenken_csp_model, cell_position
+from propagators import prop_GAC
+
+def canonical_forms(kenken_grid):
+    '''
+    Internal routine. Return the forms of a grid and of its transpose: the
+    sorted tuple of its cages, each a pair (sorted cells as (row, column)
+    pairs counted from 0, target and operation).
+    '''
+    cages = []
+    for cage in kenken_grid[1:]:
+        k = 1 if len(cage) == 2 else len(cage) - 2
+        cages.append(([cell_position(cell) for cell in cage[:k]],
+                      tuple(cage[k:])))
+    form = tuple(sorted((tuple(sorted(cells)), rest) for cells, rest in cages))
+    transposed = tuple(sorted((tuple(sorted([(j, i) for i, j in cells])), rest)
+                              for cells, rest in cages))
+    return form, transposed
+
+def canonical_form(kenken_grid):
+    '''
+    Internal routine. Return (form, transposed): the smaller of the forms of
+    a grid and of its transpose (see canonical_forms), and whether it is the
+    form of the transpose.
+    '''
+    form, transposed_form = canonical_forms(kenken_grid)
+    if transposed_form < form:
+        return transposed_form, True
+    return form, False
+
+def canonical_grid(kenken_grid):
+    '''
+    Returns (canonical, transposed) for a KenKen grid (see the file header).
+    Example:
+    Input: [[2], [21, 11, 3, 0], [12, 22, 3, 0]]
+    Output: ([[2], [(1, 1), (1, 2), 3, 0], [(2, 1), (2, 2), 3, 0]], True)
+    '''
+    form, transposed = canonical_form(kenken_grid)
+    canonical = [[kenken_grid[0][0]]]
+    for cells, rest in form:
+        canonical.append([(i+1, j+1) for i, j in cells] + list(rest))
+    return canonical, transposed
+
+def puzzle_hash(kenken_grid):
+    '''Returns the hex digest of the canonical form of a KenKen grid'''
+    return canonical_key(kenken_grid)[0]
+
+def canonical_key(kenken_grid):
+    '''
+    Internal routine. Return (hash, transposed) of a grid: the hash is that
+    of the canonical form packed as 32-bit integers (the board size, then
+    for every cage its number of cells, its cells, and its target and
+    operation, or its value for a single cell).
+    '''
+    form, transposed = canonical_form(kenken_grid)
+    packed = array.array('i', (kenken_grid[0][0], len(form)))
+    for cells, rest in form:
+        packed.append(len(cells))
+        for cell in cells:
+            packed.extend(cell)
+        packed.extend(rest)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return hashlib.sha256(packed.tobytes()).hexdigest(), transposed
+
+def transpose_solution(solution, n):
+    '''
+    Returns the flat solution (row by row) of the transposed board.
+    '''
+    if solution is None:
+        return None
+    return [solution[j*n + i] for i in range(n) for j in range(n)]
+
+def bt_solver(kenken_grid):
+    '''The default solver of ResultCache: bt_search with prop_GAC and ord_mrv'''
+    csp, var_array = kenken_csp_model(kenken_grid)
+    return BT(csp).bt_search(prop_GAC, ord_mrv)
+
+class ResultCache:
+    '''
+    Class for a persistent cache of solver results keyed by the canonical
+    hash of the puzzles (see the file header).
+    '''
+
+    def __init__(self, path=':memory:'):
+        '''Open (or create) the cache stored in the SQLite database path'''
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+                               hash TEXT PRIMARY KEY, n INTEGER, status TEXT,
+                               solution TEXT, nDecisions INTEGER,
+                               nPrunings INTEGER, nFailures INTEGER,
+                               runtime REAL)''')
+        self.db.commit()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.duplicates = 0 #hits on puzzles seen earlier in the same batch
+        self.lookup_time = 0 #wall-clock time of the lookups
+        self.solve_time = 0  #wall-clock time of the solver on misses
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def lookup(self, h, transposed, n):
+        '''
+        Internal routine. Return the cached result of hash h, oriented for a
+        grid that is transposed from the canonical form if transposed is
+        True, or None.
+        '''
+        self.lookups += 1
+        row = self.db.execute('''SELECT status, solution, nDecisions,
+                                        nPrunings, nFailures, runtime
+                                 FROM results WHERE hash = ?''', (h,)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        status, solution, nDecisions, nPrunings, nFailures, runtime = row
+        solution = json.loads(solution) if solution is not None else None
+        if transposed:
+            solution = transpose_solution(solution, n)
+        return SolveResult(status, solution, nDecisions, nPrunings, runtime,
+                           nFailures=nFailures)
+
+    def store(self, h, transposed, n, result):
+        '''Internal routine. Store result under hash h (see lookup)'''
+        if result.status == SolveResult.TIMEOUT:
+            return
+        solution = result.solution
+        if transposed:
+            solution = transpose_solution(solution, n)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?, ?)',
+                            (h, n, result.status,
+                             json.dumps(solution) if solution is not None
+                             else None, result.nDecisions, result.nPrunings,
+                             result.nFailures, result.runtime))
+        self.stores += 1
+
+    def get(self, kenken_grid):
+        '''Return the cached SolveResult of a puzzle, or None'''
+        stime = time.perf_counter()
+        h, transposed = canonical_key(kenken_grid)
+        result = self.lookup(h, transposed, kenken_grid[0][0])
+        self.lookup_time += time.perf_counter() - stime
+        return result
+
+    def put(self, kenken_grid, result):
+        '''Cache the SolveResult of a puzzle'''
+        h, transposed = canonical_key(kenken_grid)
+        self.store(h, transposed, kenken_grid[0][0], result)
+
+    def solve(self, kenken_grid, solver=None):
+        '''
+        Return the cached SolveResult of a puzzle, or solve it with
+        solver(kenken_grid) (bt_solver by default) and cache the result.
+        '''
+        return self.solve_batch([kenken_grid], solver)[0]
+
+    def solve_batch(self, grids, solver=None):
+        '''
+        Return the list of the SolveResults of grids, like solve. A puzzle
+        equal (in canonical form) to one earlier in the batch is not looked
+        up or solved again.
+        '''
+        solver = solver or bt_solver
+        results = []
+        seen = dict() #hash -> (result, transposed) in this batch
+        for grid in grids:
+            n = grid[0][0]
+            stime = time.perf_counter()
+            h, transposed = canonical_key(grid)
+            if h in seen:
+                self.lookups += 1
+                self.hits += 1
+                self.duplicates += 1
+                result, first = seen[h]
+                self.lookup_time += time.perf_counter() - stime
+                if first != transposed:
+                    result = SolveResult(result.status,
+                                         transpose_solution(result.solution, n),
+                                         result.nDecisions, result.nPrunings,
+                                         result.runtime,
+                                         nFailures=result.nFailures)
+                results.append(result)
+                continue
+            result = self.lookup(h, transposed, n)
+            self.lookup_time += time.perf_counter() - stime
+            if result is None:
+                stime = time.perf_counter()
+                result = solver(grid)
+                self.solve_time += time.perf_counter() - stime
+                self.store(h, transposed, n, result)
+            seen[h] = (result, transposed)
+            results.append(result)
+        return results
+
+    def lookup_cost(self):
+        '''Return the mean time of a lookup, in seconds'''
+        if not self.lookups:
+            return 0.0
+        return self.lookup_time / self.lookups
+
+    def hit_rate(self):
+        '''
+        Return the fraction of lookups answered without solving, from the
+        cache or from a duplicate earlier in the batch.
+        '''
+        if not self.lookups:
+            return 0.0
+        return self.hits / self.lookups
+
+    def as_dict(self):
+        '''Return the counters of the cache as a dictionary'''
+        return {'entries': len(self), 'lookups': self.lookups,
+                'hits': self.hits, 'hit_rate': self.hit_rate(),
+                'stores': self.stores, 'duplicates': self.duplicates,
+                'lookup_time': self.lookup_time,
+                'lookup_cost': self.lookup_cost(),
+                'solve_time': self.solve_time}
+
+    def print_stats(self):
+        print("Result cache: {} lookups, {} hits, {} duplicates, {:.1f} us per lookup".format(
+            self.lookups, self.hits, self.duplicates, self.lookup_cost() * 1e6))
@@ -0,0 +1,511 @@
+'''
+This file contains a SAT backend for the CSP models: a CNF encoding of a CSP
+and a built-in CDCL (conflict-driven clause learning) solver, so that no
+external solver is required.
+
+1. CNF object
+    - Holds the clauses over boolean variables 1..n_vars, written as DIMACS
+      literals (v for the variable, -v for its negation).
+    - dimacs() / write_dimacs(target) export the formula in DIMACS format for
+      debugging with other solvers; from_dimacs(text) reads it back.
+
+2. CSPEncoding object
+    - The direct encoding of a CSP: one boolean x(var, val) per variable and
+      value of its current domain, with at-least-one and at-most-one clauses
+      per variable.
+    - Constraints with the alldiff flag (rows and columns) get at-most-one
+      clauses for every value, and at-least-one clauses for every value when
+      the scope must use all of them (as many variables as values).
+    - Every other constraint (cage) gets the support encoding of its table:
+      one boolean y(t) per satisfying tuple t of current values, the clauses
+      y(t) -> x(scope[i], t[i]), and for every (var, val) of the scope the
+      clause x(var, val) -> OR of the y(t) with t giving val to var. Tables
+      are taken from the constraint, or enumerated (with pruning of partial
+      sums and products) for intensional constraints.
+    - solution(model) maps a model back to the values of csp.vars.
+
+3. CDCLSolver object
+    - Two watched literals per clause, first-UIP clause learning with
+      non-chronological backjumping, VSIDS branching with phase saving, and
+      restarts following the Luby sequence.
+    - solve(conflict_limit=None) returns True, False, or None if the limit
+      was reached. model then holds the value of every variable.
+
+4. sat_solve(csp, conflict_limit=None)
+    - Encodes and solves a CSP and returns a SolveResult. If a solution is
+      found it is also assigned to the Variables of the CSP (the board
+      Variables of the KenKen models), as bt_search leaves them.
+'''
+
+import heapq
+import time
+
+from cspbase import MDDConstraint, ProductConstraint, SolveResult, SumConstraint
+
+class CNF:
+    '''
+    Class for formulas in conjunctive normal form over boolean variables
+    1..n_vars. A clause is a list of DIMACS literals.
+    '''
+
+    def __init__(self):
+        self.n_vars = 0
+        self.clauses = []
+
+    def new_var(self):
+        '''Return a new boolean variable'''
+        self.n_vars += 1
+        return self.n_vars
+
+    def add_clause(self, lits):
+        '''Add the clause (disjunction) of the literals lits'''
+        self.clauses.append(list(lits))
+
+    def dimacs(self):
+        '''Return the formula in DIMACS format as a string'''
+        lines = ["p cnf {} {}".format(self.n_vars, len(self.clauses))]
+        for clause in self.clauses:
+            lines.append(" ".join(str(l) for l in clause) + " 0")
+        return "\n".join(lines) + "\n"
+
+    def write_dimacs(self, target):
+        '''Write the formula in DIMACS format to a path or a text file'''
+        if isinstance(target, str):
+            with open(target, 'w') as f:
+                f.write(self.dimacs())
+        else:
+            target.write(self.dimacs())
+
+    @staticmethod
+    def from_dimacs(text):
+        '''Return the CNF held by a string in DIMACS format'''
+        cnf = CNF()
+        lits = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line[0] == 'c':
+                continue
+            if line[0] == 'p':
+                cnf.n_vars = int(line.split()[2])
+                continue
+            for tok in line.split():
+                l = int(tok)
+                if l == 0:
+                    cnf.add_clause(lits)
+                    lits = []
+                else:
+                    lits.append(l)
+        return cnf
+
+def constraint_tuples(c):
+    '''
+    Returns the list of satisfying tuples of constraint c whose values are
+    all in the current domains. Helper function for CSPEncoding.
+    '''
+    doms = [var.cur_domain() for var in c.scope]
+    if isinstance(c, MDDConstraint) or c.sat_tuples:
+        source = c.tuples() if isinstance(c, MDDConstraint) else c.sat_tuples
+        domsets = [set(dom) for dom in doms]
+        return [t for t in source
+                if all(val in domsets[i] for i, val in enumerate(t))]
+
+    #intensional constraint: enumerate, pruning partial sums and products
+    k = len(doms)
+    if isinstance(c, SumConstraint):
+        terms = [[a * val for val in dom] for a, dom in zip(c.coeffs, doms)]
+        low = [0] * (k + 1)
+        high = [0] * (k + 1)
+        for i in range(k - 1, -1, -1):
+            low[i] = low[i+1] + min(terms[i], default=0)
+            high[i] = high[i+1] + max(terms[i], default=0)
+    tuples = []
+    vals = [None] * k
+
+    def extend(i, partial):
+        if i == k:
+            if c.check(vals):
+                tuples.append(tuple(vals))
+            return
+        for val in doms[i]:
+            if isinstance(c, SumConstraint):
+                new = partial + c.coeffs[i] * val
+                if not new + low[i+1] <= c.target <= new + high[i+1]:
+                    continue
+            elif isinstance(c, ProductConstraint):
+                new = partial * val
+                if c.target % new != 0:
+                    continue
+            else:
+                new = partial
+            vals[i] = val
+            extend(i + 1, new)
+
+    extend(0, 1 if isinstance(c, ProductConstraint) else 0)
+    return tuples
+
+class CSPEncoding:
+    '''
+    Class for the direct CNF encoding of a CSP over its current domains (see
+    the file header). lits[var.id][val] is the literal x(var, val).
+    '''
+
+    def __init__(self, csp):
+        self.csp = csp
+        csp.reindex()
+        self.cnf = CNF()
+        self.lits = []
+        for var in csp.vars:
+            self.lits.append({val: self.cnf.new_var() for val in var.cur_domain()})
+            self.exactly_one(list(self.lits[var.id].values()))
+        for c in csp.get_all_cons():
+            if c.alldiff:
+                self.encode_alldiff(c)
+            else:
+                self.encode_table(c)
+
+    def exactly_one(self, lits):
+        '''Add at-least-one and (pairwise) at-most-one clauses over lits'''
+        self.cnf.add_clause(lits)
+        self.at_most_one(lits)
+
+    def at_most_one(self, lits):
+        '''Add pairwise at-most-one clauses over lits'''
+        for i in range(len(lits)):
+            for j in range(i + 1, len(lits)):
+                self.cnf.add_clause([-lits[i], -lits[j]])
+
+    def encode_alldiff(self, c):
+        '''
+        Internal routine. Encode an all-different constraint: every value is
+        taken at most once, and at least once if the scope has as many
+        variables as values.
+        '''
+        values = dict() #val -> literals giving val to a scope variable
+        for var in c.scope:
+            for val, lit in self.lits[var.id].items():
+                values.setdefault(val, []).append(lit)
+        for val, lits in values.items():
+            if len(values) == len(c.scope):
+                self.cnf.add_clause(lits)
+            self.at_most_one(lits)
+
+    def encode_table(self, c):
+        '''Internal routine. Add the support encoding of c's table'''
+        supports = [dict() for var in c.scope] #supports[i][val] = [y(t)]
+        for t in constraint_tuples(c):
+            y = self.cnf.new_var()
+            for i, val in enumerate(t):
+                self.cnf.add_clause([-y, self.lits[c.scope[i].id][val]])
+                supports[i].setdefault(val, []).append(y)
+        for i, var in enumerate(c.scope):
+            for val, lit in self.lits[var.id].items():
+                self.cnf.add_clause([-lit] + supports[i].get(val, []))
+
+    def solution(self, model):
+        '''
+        Return the values of csp.vars (see SolveResult.solution) given by a
+        model of the CNF (model[v] is the value of boolean variable v).
+        '''
+        values = []
+        for var in self.csp.vars:
+            value = None
+            for val, lit in self.lits[var.id].items():
+                if model[lit]:
+                    value = val
+                    break
+            values.append(value)
+        return values
+
+def luby(i):
+    '''Returns the i-th element (counted from 1) of the Luby sequence'''
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    while i != (1 << k) - 1:
+        i -= (1 << (k - 1)) - 1
+        k = 1
+        while (1 << k) - 1 < i:
+            k += 1
+    return 1 << (k - 1)
+
+class CDCLSolver:
+    '''
+    Class for a CDCL SAT solver over a CNF (see the file header).
+
+    Internally the literal of variable v is 2*v if positive and 2*v+1 if
+    negated, so that l ^ 1 is the negation of l. value[l] is 1 if l is
+    true, -1 if false and 0 if unassigned. The first two literals of a
+    clause are its watches; the literal implied by a reason clause is its
+    first.
+    '''
+
+    RESTART_BASE = 100 #conflicts per unit of the Luby sequence
+    VAR_DECAY = 0.95
+
+    def __init__(self, cnf):
+        n = cnf.n_vars
+        self.n_vars = n
+        self.value = [0] * (2 * n + 2)
+        self.level = [0] * (n + 1)
+        self.reason = [None] * (n + 1)
+        self.phase = [False] * (n + 1) #saved phases
+        self.activity = [0.0] * (n + 1)
+        self.var_inc = 1.0
+        self.heap = [(0.0, v) for v in range(1, n + 1)]
+        self.watches = [[] for l in range(2 * n + 2)]
+        self.clauses = []
+        self.trail = []
+        self.trail_lim = [] #trail position of each decision level
+        self.qhead = 0
+        self.model = None
+        self.ok = True #False once the empty clause is derived
+
+        self.nDecisions = 0
+        self.nConflicts = 0
+        self.nPropagations = 0
+        self.nRestarts = 0
+        self.nLearned = 0
+
+        for clause in cnf.clauses:
+            self.add_clause([2 * l if l > 0 else -2 * l + 1 for l in clause])
+
+    def add_clause(self, lits):
+        '''
+        Internal routine. Add a clause of internal literals at level 0,
+        simplifying it against the level-0 assignment.
+        '''
+        if not self.ok:
+            return
+        lits = list(dict.fromkeys(lits))
+        if any(l ^ 1 in lits for l in lits) or \
+           any(self.value[l] == 1 for l in lits):
+            return #tautology or already satisfied
+        lits = [l for l in lits if self.value[l] == 0]
+        if not lits:
+            self.ok = False
+        elif len(lits) == 1:
+            self.enqueue(lits[0], None)
+            if self.propagate() is not None:
+                self.ok = False
+        else:
+            self.attach(lits)
+
+    def attach(self, lits):
+        '''Internal routine. Store a clause and watch its first two literals'''
+        ci = len(self.clauses)
+        self.clauses.append(lits)
+        self.watches[lits[0]].append(ci)
+        self.watches[lits[1]].append(ci)
+        return ci
+
+    def enqueue(self, l, reason):
+        '''Internal routine. Make literal l true'''
+        v = l >> 1
+        self.value[l] = 1
+        self.value[l ^ 1] = -1
+        self.level[v] = len(self.trail_lim)
+        self.reason[v] = reason
+        self.trail.append(l)
+
+    def propagate(self):
+        '''
+        Internal routine. Unit propagation from the unprocessed part of the
+        trail. Return the index of a conflicting clause, or None.
+        '''
+        value, watches, clauses, trail = (self.value, self.watches,
+                                          self.clauses, self.trail)
+        while self.qhead < len(trail):
+            false_lit = trail[self.qhead] ^ 1
+            self.qhead += 1
+            self.nPropagations += 1
+            ws = watches[false_lit]
+            keep = []
+            for w, ci in enumerate(ws):
+                c = clauses[ci]
+                if c[0] == false_lit:
+                    c[0], c[1] = c[1], c[0]
+                first = c[0]
+                if value[first] == 1:
+                    keep.append(ci)
+                    continue
+                #look for a new literal to watch
+                for k in range(2, len(c)):
+                    if value[c[k]] != -1:
+                        c[1], c[k] = c[k], c[1]
+                        watches[c[1]].append(ci)
+                        break
+                else:
+                    keep.append(ci)
+                    if value[first] == -1:
+                        keep.extend(ws[w+1:])
+                        watches[false_lit] = keep
+                        return ci
+                    self.enqueue(first, ci)
+            watches[false_lit] = keep
+        return None
+
+    def analyze(self, confl):
+        '''
+        Internal routine. Return the first-UIP clause learned from the
+        conflicting clause confl (asserting literal first) and the level to
+        backjump to.
+        '''
+        level, reason, trail = self.level, self.reason, self.trail
+        cur_level = len(self.trail_lim)
+        seen = set()
+        learnt = [None]
+        counter = 0
+        p = None
+        idx = len(trail) - 1
+        while True:
+            for q in self.clauses[confl]:
+                if q == p:
+                    continue
+                v = q >> 1
+                if v not in seen and level[v] > 0:
+                    seen.add(v)
+                    self.bump(v)
+                    if level[v] == cur_level:
+                        counter += 1
+                    else:
+                        learnt.append(q)
+            #the next literal of the current level on the trail
+            while trail[idx] >> 1 not in seen:
+                idx -= 1
+            p = trail[idx]
+            idx -= 1
+            counter -= 1
+            if counter == 0:
+                break
+            confl = reason[p >> 1]
+        learnt[0] = p ^ 1
+
+        if len(learnt) == 1:
+            return learnt, 0
+        #watch the literal of the highest level after the asserting one
+        best = max(range(1, len(learnt)), key=lambda i: level[learnt[i] >> 1])
+        learnt[1], learnt[best] = learnt[best], learnt[1]
+        return learnt, level[learnt[1] >> 1]
+
+    def bump(self, v):
+        '''Internal routine. Increase the VSIDS activity of variable v'''
+        self.activity[v] += self.var_inc
+        if self.activity[v] > 1e100:
+            for u in range(1, self.n_vars + 1):
+                self.activity[u] *= 1e-100
+            self.var_inc *= 1e-100
+            self.heap = [(-self.activity[u], u) for u in range(1, self.n_vars + 1)
+                         if self.value[2 * u] == 0]
+            heapq.heapify(self.heap)
+        elif self.value[2 * v] == 0:
+            heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def backtrack(self, target):
+        '''Internal routine. Undo the assignments above level target'''
+        if len(self.trail_lim) <= target:
+            return
+        pos = self.trail_lim[target]
+        for l in self.trail[pos:]:
+            v = l >> 1
+            self.value[l] = 0
+            self.value[l ^ 1] = 0
+            self.reason[v] = None
+            self.phase[v] = not (l & 1)
+            heapq.heappush(self.heap, (-self.activity[v], v))
+        del self.trail[pos:]
+        del self.trail_lim[target:]
+        self.qhead = pos
+
+    def pick_branch(self):
+        '''
+        Internal routine. Return the unassigned variable of highest activity,
+        or None if all are assigned. Stale heap entries are skipped.
+        '''
+        heap, value, activity = self.heap, self.value, self.activity
+        while heap:
+            act, v = heapq.heappop(heap)
+            if value[2 * v] == 0 and -act == activity[v]:
+                return v
+        return None
+
+    def solve(self, conflict_limit=None):
+        '''
+        Search for a model. Return True (model holds it, model[v] being the
+        value of variable v), False if the CNF is unsatisfiable, or None if
+        conflict_limit conflicts were reached first.
+        '''
+        self.model = None
+        if not self.ok:
+            return False
+        if self.propagate() is not None:
+            self.ok = False
+            return False
+        restart = 1
+        budget = luby(restart) * self.RESTART_BASE
+        while True:
+            confl = self.propagate()
+            if confl is not None:
+                self.nConflicts += 1
+                if not self.trail_lim:
+                    self.ok = False
+                    return False
+                learnt, back = self.analyze(confl)
+                self.backtrack(back)
+                if len(learnt) == 1:
+                    self.enqueue(learnt[0], None)
+                else:
+                    self.enqueue(learnt[0], self.attach(learnt))
+                    self.nLearned += 1
+                self.var_inc /= self.VAR_DECAY
+                budget -= 1
+                if conflict_limit is not None and \
+                   self.nConflicts >= conflict_limit:
+                    self.backtrack(0)
+                    return None
+                continue
+
+            if budget <= 0:
+                self.nRestarts += 1
+                self.backtrack(0)
+                restart += 1
+                budget = luby(restart) * self.RESTART_BASE
+                continue
+
+            v = self.pick_branch()
+            if v is None:
+                self.model = [None] + [self.value[2 * u] == 1
+                                       for u in range(1, self.n_vars + 1)]
+                self.backtrack(0)
+                return True
+            self.nDecisions += 1
+            self.trail_lim.append(len(self.trail))
+            self.enqueue(2 * v if self.phase[v] else 2 * v + 1, None)
+
+def sat_solve(csp, conflict_limit=None):
+    '''
+    Solve a CSP with the CDCL solver and return a SolveResult. nDecisions and
+    nFailures are the decisions and conflicts of the solver, nPrunings its
+    propagated literals, and runtime (CPU time) includes the encoding. If
+    conflict_limit conflicts are reached first the status is TIMEOUT.
+    '''
+    stime = time.process_time()
+    encoding = CSPEncoding(csp)
+    solver = CDCLSolver(encoding.cnf)
+    status = solver.solve(conflict_limit)
+    runtime = time.process_time() - stime
+
+    if status:
+        solution = encoding.solution(solver.model)
+        for var, val in zip(csp.vars, solution):
+            if not var.is_assigned():
+                var.assign(val)
+        result = SolveResult(SolveResult.SOLVED, solution, solver.nDecisions,
+                             solver.nPropagations, runtime)
+    elif status is None:
+        result = SolveResult(SolveResult.TIMEOUT, None, solver.nDecisions,
+                             solver.nPropagations, runtime, limit='conflicts')
+    else:
+        result = SolveResult(SolveResult.UNSOLVABLE, None, solver.nDecisions,
+                             solver.nPropagations, runtime)
+    result.nFailures = solver.nConflicts
+    return result
@@ -0,0 +1,244 @@
+'''
+This file contains a compact binary recorder for bt_search traces, and the
+routines to read a recorded trace back for offline analysis.
+
+1. TraceRecorder object
+    - Attach it with BT.set_tracer(recorder). bt_search then appends one
+      fixed-size record per search event instead of printing.
+    - Records are packed into a preallocated buffer. If the recorder was given
+      a file (or a path) the buffer is written out whenever it fills up;
+      otherwise the buffer is used as a ring buffer that keeps the most recent
+      `capacity` records.
+    - getvalue() returns the trace (header and records) as bytes.
+
+2. read_trace(source)
+    - Takes a path, a binary file object or a bytes object holding a trace.
+    - Returns the list of variable names and the list of records, each a
+      tuple (level, var_id, value, prunings, status).
+
+3. build_search_tree(records)
+    - Reconstructs the search tree from the records. Returns the root
+      TraceNode.
+
+4. summarize(names, records)
+    - Aggregates statistics over a trace: nodes, failures per depth, the
+      variables whose assignments caused the most prunings, etc.
+
+A record holds the search level, the index of the variable in csp.vars (-1
+for the root propagation and for solutions), the value assigned (an integer),
+the number of values pruned by the propagator, and one of the statuses below.
+'''
+
+import struct
+import collections
+
+TRACE_ROOT     = 0 #initial propagation, before any assignment
+TRACE_ASSIGN   = 1 #var = value propagated without a DWO; search descends
+TRACE_FAIL     = 2 #var = value led the propagator to a dead-end
+TRACE_UNDO     = 3 #the subtree below var = value had no solution
+TRACE_SOLUTION = 4 #all variables assigned
+
+STATUS_NAMES = ('root', 'assign', 'fail', 'undo', 'solution')
+
+RECORD = struct.Struct('<HiiIB') #level, var id, value, prunings, status
+MAGIC  = b'KKTR\x01'
+
+class TraceRecorder:
+    '''
+    Class for recording bt_search events as packed binary records. Either
+    streams to a file or keeps the last `capacity` records in memory.
+    '''
+
+    def __init__(self, out=None, capacity=4096):
+        '''
+        out is None (ring buffer mode), a path or a binary file object opened
+        for writing. capacity is the number of records held in memory.
+        '''
+        self.capacity = capacity
+        self.buf = bytearray(RECORD.size * capacity)
+        self.pos = 0        #next record slot in buf
+        self.count = 0      #number of records ever recorded
+        self.names = []
+        self.header_written = False
+        self.owns_file = isinstance(out, str)
+        self.out = open(out, 'wb') if self.owns_file else out
+
+    def start(self, csp):
+        '''
+        Called by bt_search before the search starts. Variables are recorded
+        by their id, i.e. their index in csp.vars.
+        '''
+        self.names = [v.name for v in csp.vars]
+        if self.out is not None and not self.header_written:
+            self.out.write(self.header())
+            self.header_written = True
+
+    def header(self):
+        '''Return the trace header: magic, and the variable names'''
+        names = '\n'.join(str(name) for name in self.names).encode('utf-8')
+        return MAGIC + struct.pack('<I', len(names)) + names
+
+    def record(self, level, var, value, prunings, status):
+        '''
+        Append one record. var is a Variable of the CSP (or None), prunings is
+        the number of values pruned.
+        '''
+        var_id = var.id if var is not None else -1
+        RECORD.pack_into(self.buf, self.pos * RECORD.size, level, var_id,
+                         value or 0, prunings, status)
+        self.pos += 1
+        self.count += 1
+        if self.pos == self.capacity:
+            if self.out is not None:
+                self.out.write(self.buf)
+            self.pos = 0
+
+    def flush(self):
+        '''Write buffered records to the file (file mode only)'''
+        if self.out is not None:
+            self.out.write(memoryview(self.buf)[:self.pos * RECORD.size])
+            self.pos = 0
+            self.out.flush()
+
+    def close(self):
+        '''Flush, and close the file if the recorder opened it'''
+        self.flush()
+        if self.owns_file:
+            self.out.close()
+
+    def dropped(self):
+        '''Return the number of records the ring buffer has overwritten'''
+        if self.out is not None:
+            return 0
+        return max(0, self.count - self.capacity)
+
+    def getvalue(self):
+        '''
+        Return the header and the records held in memory (oldest first) as
+        bytes. In file mode, use read_trace on the file instead.
+        '''
+        size = RECORD.size
+        if self.out is None and self.count >= self.capacity:
+            data = self.buf[self.pos*size:] + self.buf[:self.pos*size]
+        else:
+            data = self.buf[:self.pos*size]
+        return self.header() + bytes(data)
+
+def read_trace(source):
+    '''
+    Read a trace written by a TraceRecorder. source is a path, a binary file
+    object or bytes. Returns (names, records).
+    '''
+    if isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            data = f.read()
+    else:
+        data = source.read()
+
+    if not data.startswith(MAGIC):
+        raise ValueError("Not a search trace")
+    start = len(MAGIC)
+    (length,) = struct.unpack_from('<I', data, start)
+    start += 4
+    names = data[start:start+length].decode('utf-8').split('\n') if length else []
+    start += length
+
+    end = start + (len(data) - start) // RECORD.size * RECORD.size
+    records = list(RECORD.iter_unpack(data[start:end]))
+    return names, records
+
+class TraceNode:
+    '''A node of a reconstructed search tree'''
+
+    __slots__ = ('level', 'var_id', 'value', 'prunings', 'status', 'children')
+
+    def __init__(self, level, var_id, value, prunings, status):
+        self.level    = level
+        self.var_id   = var_id
+        self.value    = value
+        self.prunings = prunings
+        self.status   = status
+        self.children = []
+
+    def size(self):
+        '''Return the number of nodes in the subtree rooted here'''
+        return 1 + sum(child.size() for child in self.children)
+
+    def __repr__(self):
+        return("TraceNode(level={}, var={}, value={}, {})".format(
+            self.level, self.var_id, self.value, STATUS_NAMES[self.status]))
+
+def build_search_tree(records):
+    '''
+    Reconstruct the search tree from a list of records. Every assignment
+    becomes a node; a solution is recorded as a leaf of the last assignment.
+    If the start of the trace was lost (ring buffer), orphaned nodes are hung
+    off the root.
+    '''
+    root = TraceNode(0, -1, 0, 0, TRACE_ROOT)
+    path = [root] #path[l] is the open node at level l
+
+    for level, var_id, value, prunings, status in records:
+        if status == TRACE_ROOT:
+            root.prunings = prunings
+            continue
+        if status == TRACE_UNDO:
+            #undo closes the assignment at this level
+            if len(path) > level and path[level].var_id == var_id:
+                path[level].status = TRACE_UNDO
+                del path[level:]
+            continue
+
+        del path[level:] #anything deeper than level is finished
+        parent = path[-1]
+        node = TraceNode(level, var_id, value, prunings, status)
+        parent.children.append(node)
+        if status == TRACE_ASSIGN:
+            while len(path) < level:
+                path.append(parent)
+            path.append(node)
+
+    return root
+
+def summarize(names, records, k=10):
+    '''
+    Aggregate a trace into a dict: number of decisions, failures and undos,
+    solutions, maximum depth, failures per depth, and the k variables whose
+    assignments caused the most prunings (and most failures).
+    '''
+    decisions = 0
+    solutions = 0
+    max_depth = 0
+    failures_per_depth = collections.Counter()
+    undos_per_depth = collections.Counter()
+    prunings_per_var = collections.Counter()
+    failures_per_var = collections.Counter()
+
+    for level, var_id, value, prunings, status in records:
+        if status == TRACE_ASSIGN or status == TRACE_FAIL:
+            decisions += 1
+            max_depth = max(max_depth, level)
+            prunings_per_var[var_id] += prunings
+            if status == TRACE_FAIL:
+                failures_per_depth[level] += 1
+                failures_per_var[var_id] += 1
+        elif status == TRACE_UNDO:
+            undos_per_depth[level] += 1
+        elif status == TRACE_SOLUTION:
+            solutions += 1
+
+    def name(var_id):
+        return names[var_id] if 0 <= var_id < len(names) else var_id
+
+    return {
+        'decisions': decisions,
+        'failures': sum(failures_per_depth.values()),
+        'solutions': solutions,
+        'max_depth': max_depth,
+        'failures_per_depth': dict(sorted(failures_per_depth.items())),
+        'undos_per_depth': dict(sorted(undos_per_depth.items())),
+        'most_pruned': [(name(v), n) for v, n in prunings_per_var.most_common(k)],
+        'most_failed': [(name(v), n) for v, n in failures_per_var.most_common(k)],
+    }
@@ -0,0 +1,179 @@
+'''
+This file contains a persistent solver session over one KenKen puzzle, for
+answering interactive requests (is the current fill still solvable, what is
+the next cell to fill, what is a full completion) as the player types,
+without rebuilding the model or searching from scratch for each one.
+
+1. SolverSession object
+    - Created over a KenKen grid (in the format taken by kenken_csp_model).
+      The model is built and propagated at the root once.
+    - assign(cell, value) and unassign(cell) add and remove givens (the
+      player's entries). Cells are given in KenKen grid format, e.g. 23 or
+      (2, 3). Only the change is propagated: a new given is propagated from
+      its cell, and removing a given undoes the prunings of that given and of
+      the givens entered after it, which are then propagated again.
+    - feasible() tells if the givens can be completed into a solution,
+      completion() returns such a solution (a flat list of values, row by
+      row, like SolveResult.solution) and hint() the next cell to fill.
+
+Answers are cached until the givens change, and a completion stays cached
+while the new givens agree with it (it is then still a completion), so most
+keystrokes of a player heading for the solution need no search at all. Givens
+that contradict the puzzle are kept: the session is then infeasible until
+they are removed.
+'''
+
+import time
+
+from cspbase import BT
+from heuristics import ord_mrv
+from kenken_csp import kenken_csp_model, cell_position
+from propagators import prop_GAC
+
+class SolverSession:
+    '''
+    Class for an interactive solver session over a KenKen grid (see the file
+    header). nSearches counts the searches made, and last_time holds the
+    CPU time of the last request.
+    '''
+
+    def __init__(self, kenken_grid, propagator=prop_GAC, var_ord=ord_mrv,
+                 implied=False):
+        '''
+        Build and propagate the model of kenken_grid. Searches use propagator
+        and var_ord; implied is passed to kenken_csp_model.
+        '''
+        self.n = kenken_grid[0][0]
+        self.csp, self.board = kenken_csp_model(kenken_grid, implied)
+        self.propagator = propagator
+        self.var_ord = var_ord
+        self.solver = BT(self.csp)
+        self.nSearches = 0
+        self.last_time = 0
+
+        status, self.root_prunings = propagator(self.csp)
+        self.levels = [] #[var, val, prunings, applied] per given, in order
+        self.conflict = None if status else -1 #first failed level, if any
+        self.cached = None #(completion or None) while still valid
+        self.stale = True  #cached must be recomputed
+
+    def var(self, cell):
+        '''Internal routine. Return the Variable of a cell'''
+        i, j = cell_position(cell)
+        return self.board[i][j]
+
+    def givens(self):
+        '''Return the givens as a dictionary {(row, column): value}'''
+        return {self.cell(var): val for var, val, prunings, applied
+                in self.levels}
+
+    def cell(self, var):
+        '''Internal routine. Return the (row, column) pair of a Variable'''
+        return (var.id // self.n + 1, var.id % self.n + 1)
+
+    def apply(self, var, val):
+        '''
+        Internal routine. Add the level of the given var = val and propagate
+        it, unless a given before it failed.
+        '''
+        if self.conflict is not None:
+            self.levels.append([var, val, [], False])
+            return
+        if not var.in_cur_domain(val):
+            status, prunings, applied = False, [], False
+        else:
+            var.assign(val)
+            status, prunings = self.propagator(self.csp, var)
+            applied = True
+        self.levels.append([var, val, prunings, applied])
+        if not status:
+            self.conflict = len(self.levels) - 1
+
+    def undo(self):
+        '''Internal routine. Remove the last level, undoing its propagation'''
+        var, val, prunings, applied = self.levels.pop()
+        for pruned, value in prunings:
+            pruned.unprune_value(value)
+        if applied:
+            var.unassign()
+        if self.conflict == len(self.levels):
+            self.conflict = None
+        return var, val
+
+    def assign(self, cell, value):
+        '''
+        Enter value in cell, replacing the cell's given if it has one. Return
+        False if propagation shows that the givens cannot be completed
+        (feasible() may still find this later for the others).
+        '''
+        stime = time.process_time()
+        var = self.var(cell)
+        if any(level[0] is var for level in self.levels):
+            self.unassign(cell)
+        self.apply(var, value)
+        if self.cached is not None and self.cached[var.id] != value:
+            self.stale = True
+        elif self.conflict is not None:
+            self.cached, self.stale = None, False
+        self.last_time = time.process_time() - stime
+        return self.conflict is None
+
+    def unassign(self, cell):
+        '''Remove the given of cell, if any'''
+        stime = time.process_time()
+        var = self.var(cell)
+        for k, level in enumerate(self.levels):
+            if level[0] is var:
+                break
+        else:
+            return
+        #undo the givens entered after it, then propagate them again
+        later = [self.undo() for i in range(len(self.levels) - k - 1)]
+        self.undo()
+        for given, val in reversed(later):
+            self.apply(given, val)
+        #a completion of the givens is still one of fewer givens
+        if self.cached is None:
+            self.stale = True
+        self.last_time = time.process_time() - stime
+
+    def completion(self):
+        '''
+        Return a solution of the puzzle agreeing with the givens, as a flat
+        list of values row by row, or None if there is none.
+        '''
+        stime = time.process_time()
+        if self.stale:
+            self.stale = False
+            self.cached = None
+            if self.conflict is None:
+                self.nSearches += 1
+                found = self.solver.bt_extend(self.propagator, self.var_ord)
+                if found:
+                    self.cached = found[0]
+        self.last_time = time.process_time() - stime
+        return self.cached
+
+    def feasible(self):
+        '''Return True iff the givens can be completed into a solution'''
+        return self.completion() is not None
+
+    def hint(self):
+        '''
+        Return ((row, column), value) for the next cell to fill, or None if
+        the givens cannot be completed or fill the board. A cell whose value
+        is forced by propagation comes first (the first in row order);
+        otherwise the empty cell with the fewest values left is given its
+        value in a completion.
+        '''
+        solution = self.completion()
+        if solution is None:
+            return None
+        empty = [var for var in self.csp.vars if not var.is_assigned()]
+        if not empty:
+            return None
+        for var in empty:
+            if var.cur_domain_size() == 1:
+                return self.cell(var), var.cur_domain()[0]
+        var = min(empty, key=lambda var: var.cur_domain_size())
+        return self.cell(var), solution[var.id]
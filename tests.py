@@ -2,13 +2,33 @@ import unittest
 import sys
 import itertools
 import traceback
+import json
+import io
+import random
+import asyncio
+import contextlib
+import copy
+import os
+import pickle
+import tempfile
 
 from cspbase import *
 from kenken_csp import *
 from propagators import *
 from heuristics import *
+from profiler import *
+from searchtrace import *
+from kenken_generator import *
+from dlx import *
+from sat import *
+from localsearch import *
+from transposition import *
+from compiled import *
+from session import *
+from puzzlecache import *
 
 import propagators
+import kenken_csp
 
 BOARDS = [ [[3],[11,21,3,0],[12,22,2,1],[13,23,33,6,3],[31,32,5,0]],
 [[4],[11,21,6,3],[12,13,3,0],[14,24,3,1],[22,23,7,0],[31,32,2,2],[33,43,3,1],[34,44,6,3],[41,42,7,0]],
@@ -79,8 +99,7 @@ def check_cages(vars, board):
             continue
         if len(c) == 2:#forced value to a cell
             val = c[1]
-            cell_i = (c[0] // 10)-1
-            cell_j = (c[0] % 10)-1
+            cell_i, cell_j = cell_position(c[0])
             if vars[cell_i][cell_j].get_assigned_value() != val:
                 return False
         if len(c) > 2:#larger cage
@@ -88,8 +107,7 @@ def check_cages(vars, board):
             op = c[len(c)-1]
             cage_values = []
             for v in range(0,len(c)-2):#get vars in cage
-                cell_i = (c[v] // 10)-1
-                cell_j = (c[v] % 10)-1
+                cell_i, cell_j = cell_position(c[v])
                 cage_values.append(vars[cell_i][cell_j].get_assigned_value())
             if op == 0:
                 if add_check(cage_values,val) == False:
@@ -146,6 +164,31 @@ TEST_MODELS      = False
 TEST_HEURISTICS  = False
 TEST_PROPAGATORS = False
 TEST_FC          = True
+TEST_PROFILER    = True
+TEST_RESULT      = True
+TEST_TRACE       = True
+TEST_GENERATOR   = True
+TEST_LARGE       = True
+TEST_TEMPLATES   = True
+TEST_LS          = True
+TEST_SHAVING     = True
+TEST_IMPLIED     = True
+TEST_MDD         = True
+TEST_DP          = True
+TEST_IDS         = True
+TEST_ENGINE      = True
+TEST_NOT_EQUAL   = True
+TEST_BC          = True
+TEST_ASYNC       = True
+TEST_LIMITS      = True
+TEST_DLX         = True
+TEST_SAT         = True
+TEST_LOCAL       = True
+TEST_TABLE       = True
+TEST_CHECKPOINT  = True
+TEST_COMPILED    = True
+TEST_SESSION     = True
+TEST_CACHE       = True
 
 class TestStringMethods(unittest.TestCase):
     def helper_prop(self, board, prop=prop_FC, var_ord=ord_mrv):
@@ -274,5 +317,1070 @@ class TestStringMethods(unittest.TestCase):
             self.assertEqual(csp.vars[i].get_assigned_value(), answer[i], 
                 "Failed simple FC test: assigned values don't match expected results")
 
+    @unittest.skipUnless(TEST_PROFILER, "Not Testing Profiler.")
+    def test_profiler(self):
+        board = BOARDS[1]
+        csp, var_array = kenken_csp_model(board)
+        solver = BT(csp)
+        solver.quiet()
+        profiler = Profiler()
+        backtracks = []
+        profiler.add_callback('backtrack', lambda var, val, level: backtracks.append(level))
+        solver.set_profiler(profiler)
+        solver.bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        stats = profiler.as_dict()
+        self.assertEqual(stats['propagators']['prop_GAC']['calls'], solver.nDecisions + 1,
+            "Profiler should see the root propagation and one call per decision")
+        self.assertEqual(stats['propagators']['prop_GAC']['prunings'], solver.nPrunings,
+            "Profiler prunings don't match BT statistics")
+        self.assertEqual(stats['heuristics']['ord_mrv']['calls'], stats['events']['heuristic'])
+        self.assertEqual(len(backtracks), stats['events']['backtrack'])
+        self.assertEqual(len(stats['constraints']), len(csp.get_all_cons()),
+            "Every constraint should have been revised at the root")
+        self.assertEqual(json.loads(profiler.to_json()), stats)
+        self.assertEqual(len(profiler.hot_constraints(3)), 3)
+
+    @unittest.skipUnless(TEST_PROFILER, "Not Testing Profiler.")
+    def test_profiler_wipeout(self):
+        queens = nQueens(6)
+        profiler = Profiler()
+        queens.profiler = profiler
+        cur_var = queens.get_all_vars()
+        cur_var[0].assign(2)
+        propagators.prop_FC(queens, newVar=cur_var[0])
+        cur_var[1].assign(5)
+        propagators.prop_FC(queens, newVar=cur_var[1])
+        cur_var[4].assign(1)
+        status, _ = propagators.prop_FC(queens, newVar=cur_var[4])
+        self.assertFalse(status)
+        self.assertEqual(profiler.counts['wipeout'], 1, "Profiler missed the DWO")
+
+    @unittest.skipUnless(TEST_RESULT, "Not Testing SolveResult.")
+    def test_solve_result(self):
+        board = [[3], [11, 12, 2, 2], [13, 3], [21, 22, 2, 1], [31, 3], [23, 32, 33, 4, 3]]
+        csp, var_array = kenken_csp_model(board)
+        result = BT(csp).bt_search(prop_FC, timings=True)
+        self.assertTrue(result.solved())
+        self.assertEqual(result.solution, [2, 1, 3, 1, 3, 2, 3, 2, 1])
+        self.assertEqual(result.as_board(3), [[v.get_assigned_value() for v in row] for row in var_array])
+        self.assertGreater(result.nDecisions, 0)
+        self.assertEqual(set(result.timings), {'setup', 'root', 'search'})
+
+        #a default solver prints nothing, and trace_off keeps it that way
+        solver = BT(csp)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            solver.bt_search(prop_FC)
+            solver.trace_on()
+            solver.trace_off()
+            solver.bt_search(prop_FC)
+        self.assertEqual(out.getvalue(), "")
+
+    @unittest.skipUnless(TEST_RESULT, "Not Testing SolveResult.")
+    def test_solve_result_unsolvable(self):
+        csp, _ = kenken_csp_model([[3], [11, 12, 7, 0]])
+        result = BT(csp).bt_search(prop_GAC)
+        self.assertFalse(result)
+        self.assertEqual(result.status, SolveResult.UNSOLVABLE)
+        self.assertIsNone(result.solution)
+        self.assertIsNone(result.timings)
+
+    @unittest.skipUnless(TEST_TRACE, "Not Testing Search Trace.")
+    def test_trace_file(self):
+        board = BOARDS[2]
+        csp, var_array = kenken_csp_model(board)
+        solver = BT(csp)
+        out = io.BytesIO()
+        recorder = TraceRecorder(out, capacity=8)
+        solver.set_tracer(recorder)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        names, records = read_trace(out.getvalue())
+        self.assertEqual(names, [v.name for v in csp.vars])
+        self.assertEqual(records[0][4], TRACE_ROOT)
+        self.assertEqual(records[-1][4], TRACE_SOLUTION)
+        stats = summarize(names, records)
+        self.assertEqual(stats['decisions'], result.nDecisions)
+        self.assertEqual(stats['solutions'], 1)
+        self.assertEqual(sum(r[3] for r in records), result.nPrunings)
+        tree = build_search_tree(records)
+        self.assertEqual(tree.size(), result.nDecisions + 2, "One node per decision, plus root and solution")
+
+    @unittest.skipUnless(TEST_TRACE, "Not Testing Search Trace.")
+    def test_trace_ring_buffer(self):
+        csp, _ = kenken_csp_model(BOARDS[2])
+        solver = BT(csp)
+        recorder = TraceRecorder(capacity=4)
+        solver.set_tracer(recorder)
+        solver.bt_search(prop_FC, ord_mrv)
+        names, records = read_trace(recorder.getvalue())
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[-1][4], TRACE_SOLUTION)
+        self.assertEqual(recorder.dropped(), recorder.count - 4)
+        build_search_tree(records)
+
+        #a full buffer wraps back to its first slot and is still read whole
+        for count in (4, 8):
+            recorder = TraceRecorder(capacity=4)
+            recorder.start(csp)
+            for i in range(count):
+                recorder.record(i, csp.vars[i], i + 1, 0, TRACE_ASSIGN)
+            names, records = read_trace(recorder.getvalue())
+            self.assertEqual([r[0] for r in records], list(range(count - 4, count)))
+
+    @unittest.skipUnless(TEST_GENERATOR, "Not Testing Generator.")
+    def test_bt_solutions(self):
+        csp, _ = kenken_csp_model([[3]])
+        solver = BT(csp)
+        self.assertEqual(len(solver.bt_solutions(prop_FC, limit=100)), 12, "There are 12 Latin squares of order 3")
+        self.assertEqual(len(solver.bt_solutions(prop_FC, limit=2)), 2)
+        self.assertEqual(len(solver.bt_solutions(prop_GAC, limit=2)), 2)
+        self.assertEqual(csp.get_all_unasgn_vars(), csp.get_all_vars())
+
+    @unittest.skipUnless(TEST_GENERATOR, "Not Testing Generator.")
+    def test_generator(self):
+        generator = KenKenGenerator(4, seed=7)
+        for board, square in [generator.generate() for _ in range(5)]:
+            csp, var_array = kenken_csp_model(board)
+            solutions = BT(csp).bt_solutions(prop_GAC, ord_mrv)
+            self.assertEqual(len(solutions), 1, "Generated puzzle has more than one solution")
+            self.assertEqual(solutions[0], [v for row in square for v in row])
+            cells = sorted(cell for cage in board[1:] for cell in (cage[:1] if len(cage) == 2 else cage[:-2]))
+            self.assertEqual(cells, [(i+1)*10 + j+1 for i in range(4) for j in range(4)], "Cages must partition the board")
+        self.assertEqual(generator.stats['puzzles'], 5)
+
+    @unittest.skipUnless(TEST_LARGE, "Not Testing Large Boards.")
+    def test_alldiff_support(self):
+        rng = random.Random(5)
+        dom = [1, 2, 3, 4, 5]
+        for trial in range(50):
+            vars = [Variable('X{}'.format(i), dom) for i in range(5)]
+            table = Constraint('table', vars)
+            table.add_satisfying_tuples(itertools.permutations(dom, 5))
+            alldiff = AllDiffConstraint('alldiff', vars)
+            for var in vars:
+                for val in dom:
+                    if rng.random() < 0.4:
+                        var.prune_value(val)
+            if rng.random() < 0.5 and vars[0].cur_domain():
+                vars[0].assign(vars[0].cur_domain()[0])
+            if not any(table.tuple_is_valid(t) for t in table.sat_tuples):
+                continue #no matching: the propagator will wipe out a domain
+            self.assertEqual(set(alldiff.unsupported()), set(table.unsupported()),
+                             "AllDiffConstraint support differs from the table constraint")
+
+    @unittest.skipUnless(TEST_LARGE, "Not Testing Large Boards.")
+    def test_cell_pairs(self):
+        board = [[row[0]] if len(row) == 1 else
+                 [(c // 10, c % 10) for c in row[:-2]] + row[-2:] for row in BOARDS[1]]
+        csp, var_array = kenken_csp_model(board)
+        result = BT(csp).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        self.assertEqual(result.solution, BT(kenken_csp_model(BOARDS[1])[0]).bt_search(prop_GAC, ord_mrv).solution)
+
+    @unittest.skipUnless(TEST_LARGE, "Not Testing Large Boards.")
+    def test_large_board(self):
+        generator = KenKenGenerator(10, seed=3)
+        square = generator.latin_square()
+        board = [[10]] + [generator.make_cage(cells, square) for cells in generator.partition()]
+        csp, var_array = kenken_csp_model(board)
+        self.assertEqual(len(set(v.name for v in csp.get_all_vars())), 100, "Variable names must be unique")
+        self.assertTrue(all(type(c) is AllDiffConstraint for c in csp.get_all_cons() if not c.name.startswith('cage')))
+        result = BT(csp).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(result.solved())
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+
+    @unittest.skipUnless(TEST_TEMPLATES, "Not Testing Grid Templates.")
+    def test_template_clone(self):
+        csp1, vars1 = kenken_csp_model(BOARDS[1])
+        csp2, vars2 = kenken_csp_model(BOARDS[1])
+        self.assertTrue(set(csp1.get_all_vars()).isdisjoint(csp2.get_all_vars()), "Clones must not share Variables")
+        rows1 = [c for c in csp1.get_all_cons() if c.name.startswith('row')]
+        rows2 = [c for c in csp2.get_all_cons() if c.name.startswith('row')]
+        self.assertIs(rows1[0].sat_tuples, rows2[0].sat_tuples, "Clones should share the row tables")
+        self.assertEqual(rows2[0].get_scope(), vars2[0])
+        BT(csp1).bt_search(prop_GAC, ord_mrv)
+        self.assertEqual(csp2.get_all_unasgn_vars(), csp2.get_all_vars(), "Solving one clone changed another")
+        self.assertTrue(all(v.cur_domain_size() == 4 for v in csp2.get_all_vars()))
+        self.assertTrue(check_cages(vars1, BOARDS[1]))
+        BT(csp2).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(vars2, BOARDS[1]))
+
+    @unittest.skipUnless(TEST_TEMPLATES, "Not Testing Grid Templates.")
+    def test_nary_grid(self):
+        csp, var_array = nary_ad_grid([[4]])
+        self.assertEqual(len(csp.get_all_cons()), 8)
+        self.assertTrue(BT(csp).bt_search(prop_GAC).solved())
+        self.assertTrue(check_diff(var_array, [[4]]))
+
+    @unittest.skipUnless(TEST_LS, "Not Testing Latin-Square Propagation.")
+    def test_prop_LS(self):
+        csp, var_array = nary_ad_grid([[4]])
+        row = var_array[0]
+        for v in row[1:]:
+            v.prune_value(3)
+        status, pruned = prop_LS(csp, row[1])
+        self.assertTrue(status)
+        self.assertEqual(row[0].cur_domain(), [3], "3 can only go in the first cell of the row")
+        self.assertEqual(sorted(pruned, key=lambda p: p[1]), [(row[0], 1), (row[0], 2), (row[0], 4)])
+        BT(csp).restoreValues(pruned)
+        for v in row:
+            if v.in_cur_domain(2):
+                v.prune_value(2)
+        status, pruned = prop_LS(csp)
+        self.assertFalse(status, "2 has no cell left in the first row: should have resulted in a DWO")
+
+    @unittest.skipUnless(TEST_LS, "Not Testing Latin-Square Propagation.")
+    def test_combined_LS(self):
+        for board in BOARDS[:4]:
+            csp, var_array = kenken_csp_model(board)
+            plain = BT(csp).bt_search(prop_FC, ord_mrv)
+            result = BT(csp).bt_search(combine(prop_FC, prop_LS), ord_mrv)
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+            self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+            self.assertLessEqual(result.nDecisions, plain.nDecisions)
+
+    @unittest.skipUnless(TEST_SHAVING, "Not Testing Root Shaving.")
+    def test_shaving(self):
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        result = BT(csp).bt_search(prop_GAC, ord_mrv, timings=True, shave=prop_GAC)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+        self.assertGreater(result.nShaved, 0)
+        self.assertIn('shave', result.timings)
+        self.assertLess(result.nDecisions, 1153, "Shaving should cut the search")
+
+    @unittest.skipUnless(TEST_SHAVING, "Not Testing Root Shaving.")
+    def test_shaving_budget(self):
+        csp, _ = kenken_csp_model(BOARDS[5])
+        solver = BT(csp)
+        solver.unasgn_vars = csp.get_all_vars()
+        status, removed = solver.shave(prop_GAC, time_limit=0)
+        self.assertTrue(status)
+        self.assertEqual(removed, [], "A zero budget should stop shaving at once")
+
+    @unittest.skipUnless(TEST_IMPLIED, "Not Testing Implied Constraints.")
+    def test_sum_product_constraints(self):
+        x, y, z = Variable('X', [1, 2, 3, 4]), Variable('Y', [1, 2, 3, 4]), Variable('Z', [1, 2, 3, 4])
+        c = SumConstraint('sum', [x, y, z], 3, [1, 1, -1])
+        self.assertTrue(c.check([2, 2, 1]))
+        self.assertFalse(c.check([1, 1, 1]))
+        self.assertEqual(set(c.unsupported()), set()) #z can absorb anything
+        z.assign(4)
+        self.assertEqual(set(c.unsupported()), {(x, 1), (x, 2), (y, 1), (y, 2)})
+        z.unassign()
+        p = ProductConstraint('prod', [x, y], 12)
+        self.assertEqual(set(p.unsupported()), {(x, 1), (x, 2), (y, 1), (y, 2)})
+        self.assertTrue(p.has_support(x, 3))
+        self.assertTrue(p.check([3, 4]))
+
+    @unittest.skipUnless(TEST_IMPLIED, "Not Testing Implied Constraints.")
+    def test_implied_model(self):
+        board = BOARDS[4]
+        csp, var_array = kenken_csp_model(board, implied=True)
+        implied = [c for c in csp.get_all_cons() if c.name.startswith('implied')]
+        self.assertTrue(any(type(c) is SumConstraint for c in implied))
+        self.assertTrue(any(type(c) is ProductConstraint for c in implied))
+        plain = BT(kenken_csp_model(board)[0]).bt_search(prop_GAC, ord_mrv)
+        result = BT(csp).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+        for c in implied:
+            self.assertTrue(c.check([v.get_assigned_value() for v in c.get_scope()]), "Solution violates " + c.name)
+        self.assertLess(result.nDecisions, plain.nDecisions)
+
+    @unittest.skipUnless(TEST_MDD, "Not Testing MDD Constraints.")
+    def test_mdd_support(self):
+        rng = random.Random(3)
+        dom = [1, 2, 3, 4, 5, 6]
+        for target, op in [(3600, 3), (18, 0), (1, 1), (2, 2)]:
+            vars = [Variable('X{}'.format(i), dom) for i in range(5)]
+            table = Constraint('table', vars)
+            check = {0: check_add, 1: check_sub, 2: check_div, 3: check_mult}[op]
+            tuples = [t for t in itertools.product(dom, repeat=5) if check(t, target)]
+            table.add_satisfying_tuples(tuples)
+            mdd = cage_mdd('mdd', vars, target, op, dom)
+            self.assertEqual(sorted(mdd.tuples()), sorted(tuples))
+            self.assertLess(mdd.size()[1], len(tuples) * 5, "MDD should be smaller than the table")
+            for trial in range(20):
+                for var in vars:
+                    var.restore_curdom()
+                    for val in dom:
+                        if rng.random() < 0.3:
+                            var.prune_value(val)
+                self.assertEqual(set(mdd.unsupported()), set(table.unsupported()),
+                                 "MDD support differs from the table constraint")
+            self.assertTrue(mdd.check(tuples[0]))
+            self.assertFalse(mdd.check((7,) * 5))
+
+    @unittest.skipUnless(TEST_MDD, "Not Testing MDD Constraints.")
+    def test_mdd_model(self):
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        self.assertFalse(any(type(c) is MDDConstraint for c in csp.get_all_cons()),
+                         "Cages are not compiled into MDDs automatically")
+
+        #a model built by hand with an MDD for the 6-cell cage
+        template = grid_template(6)
+        board_vars, line_cons = template.clone()
+        csp = CSP('mdd-model')
+        for row in board_vars:
+            for var in row:
+                csp.add_var(var)
+        for cage in board[1:]:
+            if len(cage) - 2 > 4:
+                scope = [board_vars[i][j] for i, j in map(cell_position, cage[:-2])]
+                c = cage_mdd('mdd', scope, cage[-2], cage[-1], template.domain)
+            else:
+                c = cage_constraint(cage, board_vars, template.domain)
+            csp.add_constraint(c)
+        for c in line_cons:
+            csp.add_constraint(c)
+        mdds = [c for c in csp.get_all_cons() if type(c) is MDDConstraint]
+        self.assertEqual(len(mdds), 1)
+        self.assertEqual(mdds[0].sat_tuples, {})
+        BT(csp).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(board_vars, board), "Incorrect value in a cage!")
+        self.assertTrue(check_diff(board_vars, board), "Repeated value in a row or column!")
+
+    @unittest.skipUnless(TEST_DP, "Not Testing DP Cage Supports.")
+    def test_dp_support(self):
+        rng = random.Random(5)
+        dom = [1, 2, 3, 4, 5, 6]
+        for size, target, op in [(3, 11, 0), (4, 14, 0), (5, 18, 0), (3, 60, 3), (4, 120, 3), (5, 3600, 3)]:
+            vars = [Variable('X{}'.format(i), dom) for i in range(size)]
+            table = Constraint('table', vars)
+            check = check_add if op == 0 else check_mult
+            tuples = [t for t in itertools.product(dom, repeat=size) if check(t, target)]
+            table.add_satisfying_tuples(tuples)
+            if op == 0:
+                c = SumConstraint('sum', vars, target, exact=True)
+            else:
+                c = ProductConstraint('product', vars, target, exact=True)
+            for trial in range(30):
+                for var in vars:
+                    var.restore_curdom()
+                    for val in dom:
+                        if rng.random() < 0.3:
+                            var.prune_value(val)
+                self.assertEqual(set(c.unsupported()), set(table.unsupported()),
+                                 "DP support differs from the table constraint")
+                var = vars[trial % size]
+                for val in var.cur_domain():
+                    self.assertEqual(c.has_support(var, val), table.has_support(var, val))
+
+    @unittest.skipUnless(TEST_DP, "Not Testing DP Cage Supports.")
+    def test_dp_model(self):
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        cages = [c for c in csp.get_all_cons() if c.name.startswith('cage')]
+        exact = [c for c in cages if type(c) in (SumConstraint, ProductConstraint)]
+        self.assertEqual(len(exact), 5, "Add/mult cages of 3 or more cells should be DP constraints")
+        self.assertTrue(all(c.exact for c in exact))
+        for board, propagator in ((BOARDS[4], prop_FC), (BOARDS[5], prop_GAC)):
+            csp, var_array = kenken_csp_model(board)
+            BT(csp).bt_search(propagator, ord_mrv)
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+            self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+
+    @unittest.skipUnless(TEST_IDS, "Not Testing CSP Ids.")
+    def test_csp_ids(self):
+        board = BOARDS[1]
+        csp, var_array = kenken_csp_model(board)
+        self.assertEqual([v.id for v in csp.vars], list(range(len(csp.vars))))
+        self.assertEqual([c.id for c in csp.cons], list(range(len(csp.cons))))
+        for v in csp.vars:
+            cons = csp.get_cons_with_var(v)
+            self.assertIs(cons, csp.get_cons_with_var(v), "Adjacency should not be copied")
+            self.assertEqual(set(cons), set(c for c in csp.cons if v in c.scope))
+            nbrs = set(u for c in cons for u in c.scope if u is not v)
+            self.assertEqual(len(csp.get_neighbours(v)), len(nbrs))
+            self.assertEqual(set(csp.get_neighbours(v)), nbrs)
+        #V11 shares its row, its column and its cage (V21) with 6 variables
+        self.assertEqual(len(csp.get_neighbours(var_array[0][0])), 6)
+        self.assertTrue(csp.has_var(var_array[0][0]))
+        self.assertFalse(csp.has_var(Variable('X', [1, 2])))
+        self.assertIn(ord_dh(csp), csp.vars)
+
+        #variables and constraints shared with a second CSP keep working in both
+        var, con = var_array[0][1], csp.get_cons_with_var(var_array[0][1])[0]
+        cons, neighbours = csp.get_cons_with_var(var), csp.get_neighbours(var)
+        other = CSP('other', [var, var_array[0][2]])
+        other.add_constraint(con)
+        self.assertEqual((var.id, con.id), (0, 0), "Ids index the CSP last added to")
+        self.assertEqual(other.get_cons_with_var(var), (con,))
+        self.assertEqual(csp.get_cons_with_var(var), cons)
+        self.assertEqual(csp.get_neighbours(var), neighbours)
+        self.assertTrue(csp.has_var(var) and csp.has_constraint(con))
+        self.assertEqual(var.id, 1)
+        self.assertTrue(other.has_var(var))
+        self.assertFalse(other.has_var(var_array[2][2]))
+        self.assertRaises(KeyError, other.get_cons_with_var, var_array[2][2])
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            csp.add_var(var)
+            csp.add_constraint(con)
+        self.assertEqual(out.getvalue().count("already has it"), 2)
+        self.assertEqual((len(csp.vars), len(csp.cons)), (16, len(set(csp.cons))))
+        other.add_var(var_array[0][0])
+        self.assertEqual(var_array[0][0].id, 2)
+
+        BT(csp).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+
+    @unittest.skipUnless(TEST_ENGINE, "Not Testing Propagation Engine.")
+    def test_engine_events(self):
+        #bounds reasoning is not idempotent: after pruning X=1, sum runs once more
+        for forbidden, sum_revisions in ((3, 1), (5, 3)):
+            x = Variable('X', [1, 2, 3, 4, 5])
+            y = Variable('Y', [1, 2, 3, 4, 5])
+            csp = CSP('events', [x, y])
+            total = SumConstraint('sum', [x, y], 6)
+            table = Constraint('table', [y])
+            table.add_satisfying_tuples([(d,) for d in y.domain() if d != forbidden])
+            csp.add_constraint(table)
+            csp.add_constraint(total)
+            profiler = Profiler()
+            order = []
+            profiler.add_callback('revise', lambda c, elapsed: order.append(c.name))
+            csp.profiler = profiler
+            status, pruned = prop_GAC(csp)
+            self.assertTrue(status)
+            self.assertEqual(order[:2], ['sum', 'table'], "Bounds reasoning should run before tables")
+            #removing Y=3 leaves the bounds of Y alone, removing Y=5 does not
+            self.assertEqual(order.count('sum'), sum_revisions)
+            if forbidden == 5:
+                self.assertEqual(x.cur_domain(), [2, 3, 4, 5])
+
+    @unittest.skipUnless(TEST_ENGINE, "Not Testing Propagation Engine.")
+    def test_engine_fixpoint(self):
+        #revising only the constraints of the assigned variable took 1153 decisions
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        result = BT(csp).bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+        self.assertLess(result.nDecisions, 1153)
+        #a GAC fixpoint at the root: every remaining value is supported
+        csp, var_array = kenken_csp_model(board)
+        status, pruned = prop_GAC(csp)
+        self.assertTrue(status)
+        for c in csp.get_all_cons():
+            self.assertEqual(list(c.unsupported()), [], c.name + " is not GAC")
+
+    @unittest.skipUnless(TEST_NOT_EQUAL, "Not Testing Not-Equal Constraints.")
+    def test_not_equal(self):
+        x = Variable('X', [1, 2, 3])
+        y = Variable('Y', [1, 2, 3])
+        c = NotEqualConstraint('ne', [x, y])
+        table = Constraint('table', [x, y])
+        table.add_satisfying_tuples(itertools.permutations([1, 2, 3], 2))
+        for vals in itertools.product([1, 2, 3], repeat=2):
+            self.assertEqual(c.check(vals), table.check(vals))
+        self.assertRaises(TypeError, c.add_satisfying_tuples, [(1, 2)])
+        self.assertRaises(ValueError, NotEqualConstraint, 'ne', [x])
+        for xs, ys in [([1, 2, 3], [2]), ([3], [1, 3]), ([2], [2]), ([1, 2], [2, 3])]:
+            for var, dom in ((x, xs), (y, ys)):
+                var.restore_curdom()
+                for val in var.domain():
+                    if val not in dom:
+                        var.prune_value(val)
+            self.assertEqual(set(c.unsupported()), set(table.unsupported()))
+            for var in (x, y):
+                for val in var.cur_domain():
+                    self.assertEqual(c.has_support(var, val), table.has_support(var, val))
+
+    @unittest.skipUnless(TEST_NOT_EQUAL, "Not Testing Not-Equal Constraints.")
+    def test_binary_ne_model(self):
+        n = 12
+        csp, board = binary_ne_grid([[n]])
+        cons = csp.get_all_cons()
+        self.assertEqual(len(cons), n * n * (n - 1))
+        self.assertTrue(all(type(c) is NotEqualConstraint for c in cons))
+        self.assertTrue(all(c.sat_tuples == {} for c in cons), "Not-equal constraints need no tables")
+        for propagator in (prop_FC, prop_GAC):
+            csp, board = binary_ne_grid([[n]])
+            result = BT(csp).bt_search(propagator, ord_mrv)
+            self.assertTrue(result.solved())
+            rows = result.as_board(n)
+            for i in range(n):
+                self.assertEqual(sorted(rows[i]), list(range(1, n + 1)))
+                self.assertEqual(sorted(row[i] for row in rows), list(range(1, n + 1)))
+
+    @unittest.skipUnless(TEST_BC, "Not Testing Bounds Consistency.")
+    def test_hall_bounds(self):
+        rng = random.Random(7)
+        for trial in range(500):
+            n = rng.randint(1, 5)
+            lows = [rng.randint(1, 6) for i in range(n)]
+            highs = [rng.randint(low, 6) for low in lows]
+            sols = [t for t in itertools.product(*[range(l, h + 1) for l, h in zip(lows, highs)])
+                    if len(set(t)) == n]
+            narrowed = propagators.hall_bounds(lows, highs)
+            if not sols:
+                self.assertIsNone(narrowed)
+            else:
+                self.assertEqual(narrowed, ([min(t[i] for t in sols) for i in range(n)],
+                                            [max(t[i] for t in sols) for i in range(n)]))
+
+    @unittest.skipUnless(TEST_BC, "Not Testing Bounds Consistency.")
+    def test_alldiff_bounds(self):
+        row = [Variable('X{}'.format(i), [1, 2, 3, 4, 5]) for i in range(5)]
+        c = AllDiffConstraint('row', row)
+        #X0, X1 in {1, 2} form a Hall interval; X2 = 4 sits inside the others' domains
+        for var in row[:2]:
+            for val in (3, 4, 5):
+                var.prune_value(val)
+        row[2].assign(4)
+        pairs = propagators.alldiff_bounds(row)
+        self.assertEqual(sorted((v.name, d) for v, d in pairs),
+                         [('X3', 1), ('X3', 2), ('X3', 4), ('X4', 1), ('X4', 2), ('X4', 4)])
+        #and forward checking on the n-ary row finds nothing
+        self.assertEqual(propagators.revise_FC(c), [])
+        #three variables in {1, 2}: no solution
+        row[2].unassign()
+        for val in (3, 4, 5):
+            row[2].prune_value(val)
+        pairs = propagators.alldiff_bounds(row)
+        self.assertEqual(set(pairs), set((v, d) for v in row for d in v.cur_domain()))
+
+    @unittest.skipUnless(TEST_BC, "Not Testing Bounds Consistency.")
+    def test_prop_BC(self):
+        for board in BOARDS:
+            csp, var_array = kenken_csp_model(board)
+            result = BT(csp).bt_search(prop_BC, ord_mrv)
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+            self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+
+    @unittest.skipUnless(TEST_ASYNC, "Not Testing Async Search.")
+    def test_async_search(self):
+        async def solve_all():
+            models = [kenken_csp_model(board) for board in BOARDS[:5]]
+            slices = []
+            async def ticker():
+                #runs between the slices of the searches
+                while True:
+                    slices.append(1)
+                    await asyncio.sleep(0)
+            tick = asyncio.ensure_future(ticker())
+            results = await asyncio.gather(*[BT(csp).bt_search_async(prop_FC, ord_mrv, slice_nodes=50)
+                                             for csp, var_array in models])
+            tick.cancel()
+            return models, results, len(slices)
+
+        models, results, slices = asyncio.run(solve_all())
+        for board, (csp, var_array), result in zip(BOARDS[:5], models, results):
+            self.assertTrue(result.solved())
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+            self.assertTrue(check_diff(var_array, board), "Repeated value in a row or column!")
+        #the ticker runs once per round of slices, i.e. for as long as the longest search
+        self.assertGreaterEqual(slices, max(r.nDecisions for r in results) // 50,
+                                "The event loop should run between slices")
+        #the same search, run synchronously
+        csp, var_array = kenken_csp_model(BOARDS[4])
+        self.assertEqual(BT(csp).bt_search(prop_FC, ord_mrv).solution, results[4].solution)
+
+    @unittest.skipUnless(TEST_ASYNC, "Not Testing Async Search.")
+    def test_async_cancel(self):
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        solver = BT(csp)
+
+        async def solve():
+            #FC needs millions of nodes on this board
+            return await asyncio.wait_for(solver.bt_search_async(prop_FC, ord_mrv, slice_nodes=100,
+                                                                 shave=prop_GAC), 0.2)
+
+        self.assertRaises(asyncio.TimeoutError, asyncio.run, solve())
+        self.assertGreater(solver.nDecisions, 0)
+        for var in csp.get_all_vars():
+            self.assertFalse(var.is_assigned())
+            self.assertEqual(var.cur_domain(), var.domain(), "Domains should be restored")
+        #the same solver is usable afterwards
+        result = solver.bt_search(prop_GAC, ord_mrv)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+
+    @unittest.skipUnless(TEST_LIMITS, "Not Testing Search Limits.")
+    def test_search_limits(self):
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        solver = BT(csp)
+
+        #FC needs millions of nodes on this board
+        solver.set_limits(nodes=500)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        self.assertEqual(result.status, SolveResult.TIMEOUT)
+        self.assertFalse(result)
+        self.assertEqual(result.limit, 'nodes')
+        self.assertEqual(result.nDecisions, 500)
+        self.assertIsNone(result.solution)
+        self.assertGreater(result.nFailures, 0)
+        assigned = [val for val in result.partial if val is not None]
+        self.assertGreater(len(assigned), 0, "The deepest partial assignment should be reported")
+        self.assertLess(len(assigned), len(csp.get_all_vars()))
+        for var in csp.get_all_vars():
+            self.assertFalse(var.is_assigned())
+            self.assertEqual(var.cur_domain(), var.domain(), "Domains should be restored")
+
+        solver.set_limits(failures=100)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        self.assertEqual((result.status, result.limit, result.nFailures),
+                         (SolveResult.TIMEOUT, 'failures', 100))
+
+        solver.set_limits(trail=0)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        self.assertEqual((result.status, result.limit), (SolveResult.TIMEOUT, 'trail'))
+
+        solver.set_limits(cpu_time=0.1)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        self.assertEqual((result.status, result.limit), (SolveResult.TIMEOUT, 'cpu_time'))
+        self.assertLess(result.runtime, 1)
+
+        solver.set_limits(wall_time=0.1)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        self.assertEqual((result.status, result.limit), (SolveResult.TIMEOUT, 'wall_time'))
+
+        #limits that are not reached leave the search unchanged
+        solver.set_limits(nodes=10000, cpu_time=10)
+        result = solver.bt_search(prop_GAC, ord_mrv)
+        self.assertEqual(result.status, SolveResult.SOLVED)
+        self.assertIsNone(result.partial)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        solver.set_limits()
+        self.assertEqual(solver.bt_search(prop_GAC, ord_mrv).solution, result.solution)
+
+        #bt_solutions cannot tell how many solutions a stopped search missed
+        csp, var_array = kenken_csp_model([[4]])
+        solver = BT(csp)
+        solver.set_limits(nodes=5)
+        self.assertIsNone(solver.bt_solutions(prop_FC, ord_mrv, limit=100))
+        for var in csp.get_all_vars():
+            self.assertFalse(var.is_assigned())
+            self.assertEqual(var.cur_domain(), var.domain())
+        solver.set_limits(nodes=10000)
+        self.assertEqual(len(solver.bt_solutions(prop_FC, ord_mrv, limit=100)), 100)
+
+    @unittest.skipUnless(TEST_DLX, "Not Testing Dancing Links.")
+    def test_dlx(self):
+        for board in BOARDS:
+            n = board[0][0]
+            result = dlx_solve(board)
+            self.assertEqual(result.status, SolveResult.SOLVED)
+            csp, var_array = kenken_csp_model(board)
+            for var, val in zip(csp.get_all_vars(), result.solution):
+                var.assign(val)
+            self.assertTrue(check_diff(var_array, board), "Failed a Diff Constraint")
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+            self.assertEqual(len(result.as_board(n)), n)
+
+            #the same solutions as BT, counted and listed
+            csp, var_array = kenken_csp_model(board)
+            solutions = BT(csp).bt_solutions(prop_GAC, ord_mrv, limit=100)
+            self.assertEqual(dlx_count(board), len(solutions))
+            self.assertEqual(dlx_count(board, limit=2), min(2, len(solutions)))
+            self.assertEqual(sorted(dlx_solutions(board, limit=100)), sorted(solutions))
+
+        #the matrix is restored after a search stopped early
+        n_items, options, placements = kenken_exact_cover(BOARDS[5])
+        matrix = DLX(n_items, options)
+        steps = matrix.solutions()
+        first = next(steps)
+        steps.close()
+        self.assertEqual(matrix.count(), 28)
+        self.assertEqual(next(matrix.solutions()), first)
+
+        #cells outside every cage take any value
+        self.assertEqual(dlx_count([[4]]), 576)
+        self.assertEqual(dlx_solve([[3], [11, 12, 7, 0]]).status, SolveResult.UNSOLVABLE)
+
+    @unittest.skipUnless(TEST_SAT, "Not Testing SAT Backend.")
+    def test_sat(self):
+        for board in BOARDS:
+            csp, var_array = kenken_csp_model(board)
+            result = sat_solve(csp)
+            self.assertEqual(result.status, SolveResult.SOLVED)
+            self.assertEqual(result.solution, [var.get_assigned_value() for var in csp.get_all_vars()])
+            self.assertTrue(check_diff(var_array, board), "Failed a Diff Constraint")
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+
+        #count solutions by blocking each one found
+        for board, count in ((BOARDS[0], 2), (BOARDS[1], 1)):
+            csp, var_array = kenken_csp_model(board)
+            encoding = CSPEncoding(csp)
+            found = 0
+            while True:
+                solver = CDCLSolver(encoding.cnf)
+                if not solver.solve():
+                    break
+                found += 1
+                solution = encoding.solution(solver.model)
+                encoding.cnf.add_clause([-encoding.lits[var.id][val]
+                                         for var, val in zip(csp.get_all_vars(), solution)])
+            self.assertEqual(found, count)
+
+        csp, var_array = kenken_csp_model([[3], [11, 12, 7, 0]])
+        self.assertEqual(sat_solve(csp).status, SolveResult.UNSOLVABLE)
+
+        #pigeonhole: 6 pigeons do not fit in 5 holes
+        cnf = CNF()
+        x = [[cnf.new_var() for j in range(5)] for i in range(6)]
+        for i in range(6):
+            cnf.add_clause(x[i])
+        for j in range(5):
+            for a, b in itertools.combinations(range(6), 2):
+                cnf.add_clause([-x[a][j], -x[b][j]])
+        self.assertIsNone(CDCLSolver(cnf).solve(conflict_limit=5))
+        solver = CDCLSolver(cnf)
+        self.assertFalse(solver.solve())
+        self.assertGreater(solver.nLearned, 0)
+
+        #DIMACS export
+        text = cnf.dimacs()
+        self.assertTrue(text.startswith("p cnf 30 81\n"))
+        self.assertEqual(CNF.from_dimacs(text).clauses, cnf.clauses)
+        out = io.StringIO()
+        cnf.write_dimacs(out)
+        self.assertEqual(out.getvalue(), text)
+
+    @unittest.skipUnless(TEST_LOCAL, "Not Testing Local Search.")
+    def test_local_search(self):
+        for board in BOARDS:
+            csp, var_array = kenken_csp_model(board)
+            search = LocalSearch(csp, seed=1)
+            result = search.solve()
+            self.assertEqual(result.status, SolveResult.SOLVED)
+            self.assertEqual(result.nDecisions, search.nIterations)
+            self.assertTrue(check_diff(var_array, board), "Failed a Diff Constraint")
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+
+        #BOARDS[5] needs some iterations after root propagation
+        board = BOARDS[5]
+        csp, var_array = kenken_csp_model(board)
+        search = LocalSearch(csp, seed=1)
+        self.assertTrue(search.solve())
+        self.assertGreater(search.nIterations, 0)
+        self.assertGreater(search.iterations_per_second(), 0)
+
+        result = search.solve(max_iters=1)
+        self.assertEqual((result.status, result.limit), (SolveResult.TIMEOUT, 'iterations'))
+        for var in csp.get_all_vars():
+            self.assertFalse(var.is_assigned())
+            self.assertEqual(var.cur_domain(), var.domain(), "Domains should be restored")
+
+        #completeness: fall back to BT
+        result = search.solve(max_iters=1, complete=True)
+        self.assertEqual(result.status, SolveResult.SOLVED)
+        self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+
+        csp, var_array = kenken_csp_model([[3], [11, 12, 7, 0]])
+        self.assertEqual(LocalSearch(csp).solve().status, SolveResult.UNSOLVABLE)
+
+    @unittest.skipUnless(TEST_TABLE, "Not Testing Transposition Table.")
+    def test_transposition_table(self):
+        checks = []
+
+        class CheckedTable(TranspositionTable):
+            #compare the incremental hash with one computed from scratch
+            def is_failed(self):
+                fresh = copy.copy(self)
+                fresh.start(self.csp)
+                checks.append(fresh.hash == self.hash)
+                return TranspositionTable.is_failed(self)
+
+        board = BOARDS[4]
+        csp, var_array = kenken_csp_model(board)
+        plain = BT(csp).bt_search(prop_FC, ord_mrv)
+        solver = BT(csp)
+        table = CheckedTable()
+        solver.set_transposition_table(table)
+        result = solver.bt_search(prop_FC, ord_mrv)
+        self.assertTrue(all(checks) and checks, "The incremental hash drifted")
+        #only failed subtrees are skipped: same solution, fewer nodes
+        self.assertEqual(result.solution, plain.solution)
+        self.assertGreater(table.hits, 0)
+        self.assertLess(result.nDecisions, plain.nDecisions)
+        self.assertEqual(table.hit_rate(), table.hits / table.lookups)
+        self.assertGreater(table.memory_bytes(), 0)
+        self.assertEqual(table.as_dict()['entries'], table.stores)
+
+        #states with solutions below them are never stored
+        solver.set_transposition_table(TranspositionTable())
+        self.assertEqual(len(solver.bt_solutions(prop_FC, ord_mrv, limit=100)), 48)
+
+        #LRU eviction
+        table = TranspositionTable(capacity=2)
+        for h in (1, 2, 3):
+            table.hash = h
+            table.add_failed()
+        table.hash = 1
+        self.assertFalse(table.is_failed())
+        table.hash = 2
+        self.assertTrue(table.is_failed())
+        table.hash = 4
+        table.add_failed()
+        self.assertEqual(list(table.entries), [2, 4])
+        self.assertEqual((table.evictions, table.hits, table.lookups), (2, 1, 2))
+
+    @unittest.skipUnless(TEST_CHECKPOINT, "Not Testing Checkpoints.")
+    def test_checkpoint(self):
+        board = BOARDS[4]
+        csp, var_array = kenken_csp_model(board)
+        plain = BT(csp).bt_search(prop_FC, ord_mrv)
+
+        #stop the search part way, then resume it on a fresh model
+        solver = BT(csp)
+        steps = solver.bt_search_steps(prop_FC, ord_mrv)
+        for i in range(plain.nDecisions // 2):
+            next(steps)
+        state = json.loads(json.dumps(solver.checkpoint()))
+        steps.close()
+        self.assertTrue(state['path'])
+
+        csp, var_array = kenken_csp_model(board)
+        solver = BT(csp)
+        result = solver.bt_search(prop_FC, ord_mrv, resume=state)
+        self.assertEqual(result.solution, plain.solution)
+        self.assertEqual(result.nDecisions, plain.nDecisions)
+        self.assertEqual(result.nPrunings, plain.nPrunings)
+        self.assertEqual(result.nFailures, plain.nFailures)
+
+        #periodic checkpoints on disk while collecting solutions
+        every = BT(csp).bt_solutions(prop_FC, ord_mrv, limit=100)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.ckpt')
+            solver = BT(csp)
+            solver.set_checkpoint(path, every_nodes=50)
+            solver.set_limits(nodes=300)
+            self.assertEqual(solver.bt_search(prop_FC, ord_mrv).status,
+                             SolveResult.TIMEOUT)
+            self.assertGreater(solver.nCheckpoints, 0)
+            state = load_checkpoint(path)
+            self.assertEqual(os.listdir(tmp), ['search.ckpt'])
+
+            solver = BT(csp)
+            solver.set_checkpoint(path, every_nodes=1000)
+            solver.set_limits(nodes=5000)
+            solver.bt_solutions(prop_FC, ord_mrv, limit=100)
+            state = load_checkpoint(path)
+            self.assertTrue(state['solutions'])
+            solver = BT(csp)
+            found = solver.bt_solutions(prop_FC, ord_mrv, limit=100,
+                                        resume=state)
+            self.assertEqual(found, every)
+
+        #a checkpoint only resumes on the model and propagator it was taken on
+        other, var_array = kenken_csp_model(BOARDS[1])
+        self.assertRaises(ValueError, BT(other).bt_search, prop_FC, ord_mrv,
+                          resume=state)
+        self.assertRaises(ValueError, BT(csp).bt_search, prop_GAC, ord_mrv,
+                          resume=state)
+        for var in csp.vars:
+            self.assertFalse(var.is_assigned())
+            self.assertEqual(var.cur_domain(), var.domain())
+
+        #nor on the same cage layout with other targets or operations
+        csp, var_array = kenken_csp_model(BOARDS[1])
+        solver = BT(csp)
+        steps = solver.bt_search_steps(prop_FC, ord_mrv)
+        for i in range(5):
+            next(steps)
+        state = json.loads(json.dumps(solver.checkpoint()))
+        steps.close()
+        changed = [[4], [11, 21, 5, 0], [12, 13, 2, 3]] + BOARDS[1][3:]
+        other, var_array = kenken_csp_model(changed)
+        self.assertRaises(ValueError, BT(other).bt_search, prop_FC, ord_mrv,
+                          resume=state)
+        csp, var_array = kenken_csp_model(BOARDS[1])
+        self.assertTrue(BT(csp).bt_search(prop_FC, ord_mrv, resume=state).solved())
+
+    @unittest.skipUnless(TEST_COMPILED, "Not Testing Compiled Models.")
+    def test_compiled_model(self):
+        for board in BOARDS[:5]:
+            csp, var_array = kenken_csp_model(board, implied=True)
+            model = compile_model(csp, var_array)
+            data = pickle.dumps(model)
+            self.assertLess(len(data), len(pickle.dumps((csp, var_array))))
+            other, other_array = pickle.loads(data).rehydrate()
+            self.assertEqual([[var.name for var in row] for row in other_array],
+                             [[var.name for var in row] for row in var_array])
+            self.assertEqual([str(c) for c in other.cons],
+                             [str(c) for c in csp.cons])
+            for var, copy_var in zip(csp.vars, other.vars):
+                self.assertEqual([c.id for c in other.get_cons_with_var(copy_var)],
+                                 [c.id for c in csp.get_cons_with_var(var)])
+                self.assertEqual([u.id for u in other.get_neighbours(copy_var)],
+                                 [u.id for u in csp.get_neighbours(var)])
+            #the same search on the rehydrated model
+            first = BT(csp).bt_search(prop_GAC, ord_mrv)
+            second = BT(other).bt_search(prop_GAC, ord_mrv)
+            self.assertEqual(second.solution, first.solution)
+            self.assertEqual((second.nDecisions, second.nPrunings),
+                             (first.nDecisions, first.nPrunings))
+
+        #the row and column tables are stored once
+        csp, var_array = kenken_csp_model(BOARDS[4])
+        model = compile_model(csp, var_array)
+        self.assertEqual(len(model.digests), 1 + len(set(
+            tuple(c.sat_tuples) for c in csp.cons
+            if type(c) is Constraint and not c.alldiff)))
+
+        #on disk
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'model.kkcm')
+            model.save(path)
+            self.assertEqual(load_model(path).to_bytes(), model.to_bytes())
+
+        #the other kinds of constraints
+        x, y, z = Variable('x', [1, 2, 3]), Variable('y', [1, 2, 3]), \
+                  Variable('z', [0, 1, 2, 3])
+        csp = CSP('kinds', [x, y, z])
+        csp.add_constraint(NotEqualConstraint('ne', [x, y]))
+        csp.add_constraint(SumConstraint('sum', [x, y, z], 4, [1, 2, -1]))
+        csp.add_constraint(ProductConstraint('prod', [x, y], 2, exact=True))
+        csp.add_constraint(MDDConstraint('mdd', [x, y, z], 0,
+                                         lambda s, val, i: s + val,
+                                         lambda s: s % 2 == 0))
+        other, no_board = compile_model(csp).rehydrate()
+        self.assertIsNone(no_board)
+        for c, copy_c in zip(csp.cons, other.cons):
+            self.assertIs(type(copy_c), type(c))
+            self.assertEqual((copy_c.events, copy_c.priority),
+                             (c.events, c.priority))
+            for vals in itertools.product([0, 1, 2, 3], repeat=len(c.scope)):
+                self.assertEqual(copy_c.check(vals), c.check(vals))
+        self.assertEqual(BT(other).bt_search(prop_GAC).solution,
+                         BT(csp).bt_search(prop_GAC).solution)
+
+        class Odd(Constraint):
+            pass
+        csp.add_constraint(Odd('odd', [x]))
+        self.assertRaises(TypeError, compile_model, csp)
+        self.assertRaises(ValueError, CompiledModel.from_bytes, b'not a model')
+
+    @unittest.skipUnless(TEST_SESSION, "Not Testing Solver Sessions.")
+    def test_session(self):
+        #bt_extend leaves the CSP as it found it
+        csp, var_array = kenken_csp_model(BOARDS[0])
+        solver = BT(csp)
+        self.assertEqual(len(solver.bt_extend(prop_GAC, ord_mrv, limit=5)), 2)
+        self.assertEqual(solver.bt_extend(prop_GAC, ord_mrv, limit=5),
+                         BT(csp).bt_solutions(prop_GAC, ord_mrv, limit=5))
+        var_array[0][0].assign(var_array[0][0].domain()[0])
+        found = solver.bt_extend(prop_FC, ord_mrv, limit=5)
+        self.assertTrue(all(sol[0] == var_array[0][0].domain()[0] for sol in found))
+        var_array[0][0].unassign()
+        for var in csp.vars:
+            self.assertFalse(var.is_assigned())
+            self.assertEqual(var.cur_domain(), var.domain())
+
+        grid, square = KenKenGenerator(6, seed=5).generate()
+        solution = [val for row in square for val in row]
+        session = SolverSession(grid)
+        self.assertTrue(session.feasible())
+        self.assertEqual(session.completion(), solution)
+
+        #following the hints fills the board with one search
+        while session.hint() is not None:
+            cell, value = session.hint()
+            self.assertEqual(value, square[cell[0]-1][cell[1]-1])
+            self.assertTrue(session.assign(cell, value))
+        self.assertEqual(len(session.givens()), 36)
+        self.assertEqual(session.nSearches, 1)
+
+        #wrong givens, replaced and removed
+        session = SolverSession(grid)
+        session.assign(11, square[0][0])
+        session.assign((2, 2), square[1][1])
+        wrong = square[0][1] % 6 + 1
+        session.assign(12, wrong)
+        session.assign(33, square[2][2])
+        self.assertFalse(session.feasible())
+        self.assertIsNone(session.hint())
+        session.assign(12, square[0][1])
+        self.assertTrue(session.feasible())
+        session.unassign((1, 2))
+        session.unassign(22)
+        session.unassign(22)
+        self.assertEqual(session.givens(), {(1, 1): square[0][0],
+                                            (3, 3): square[2][2]})
+        self.assertEqual(session.completion(), solution)
+
+        #the state is that of the remaining givens propagated afresh
+        fresh = SolverSession(grid)
+        fresh.assign(11, square[0][0])
+        fresh.assign(33, square[2][2])
+        self.assertEqual([var.cur_domain() for var in session.csp.vars],
+                         [var.cur_domain() for var in fresh.csp.vars])
+
+    @unittest.skipUnless(TEST_CACHE, "Not Testing Result Cache.")
+    def test_result_cache(self):
+        def shuffled(grid, transpose, seed):
+            #the same puzzle, reordered and written with (row, column) cells
+            rng = random.Random(seed)
+            cages = []
+            for cage in grid[1:]:
+                k = 1 if len(cage) == 2 else len(cage) - 2
+                cells = []
+                for cell in cage[:k]:
+                    i, j = cell_position(cell)
+                    cells.append((j+1, i+1) if transpose else (i+1, j+1))
+                rng.shuffle(cells)
+                cages.append(cells + cage[k:])
+            rng.shuffle(cages)
+            return [grid[0]] + cages
+
+        grid = BOARDS[1]
+        n = grid[0][0]
+        h = puzzle_hash(grid)
+        for seed in range(4):
+            self.assertEqual(puzzle_hash(shuffled(grid, seed % 2, seed)), h)
+            self.assertEqual(canonical_grid(shuffled(grid, seed % 2, seed))[0],
+                             canonical_grid(grid)[0])
+        self.assertNotEqual(puzzle_hash(BOARDS[2]), h)
+        form, transposed = canonical_grid(shuffled(grid, True, 0))
+        self.assertNotEqual(canonical_grid(grid)[1], transposed)
+
+        calls = []
+        def solver(grid):
+            calls.append(grid)
+            return bt_solver(grid)
+
+        cache = ResultCache()
+        plain = bt_solver(grid)
+        flipped = shuffled(grid, True, 1)
+        self.assertEqual(cache.solve(grid, solver).solution, plain.solution)
+        #a transposed duplicate gets the transposed solution
+        result = cache.solve(flipped, solver)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(result.solution, transpose_solution(plain.solution, n))
+        self.assertEqual(result.solution, bt_solver(flipped).solution)
+        self.assertEqual((cache.lookups, cache.hits, len(cache)), (2, 1, 1))
+        self.assertGreater(cache.lookup_cost(), 0)
+
+        #batches solve every distinct puzzle once
+        batch = [BOARDS[0], shuffled(BOARDS[0], True, 2), grid, BOARDS[0]]
+        results = cache.solve_batch(batch, solver)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.duplicates, 2)
+        for board, result in zip(batch, results):
+            csp, var_array = kenken_csp_model(board)
+            for var, val in zip(csp.vars, result.solution):
+                var.assign(val)
+            self.assertTrue(check_cages(var_array, board), "Incorrect value in a cage!")
+        self.assertEqual(cache.as_dict()['entries'], 2)
+
+        #results persist, but timeouts are not cached
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.db')
+            with ResultCache(path) as cache:
+                cache.put(grid, plain)
+                cache.put(BOARDS[0], SolveResult(SolveResult.TIMEOUT, None,
+                                                 0, 0, 0))
+            with ResultCache(path) as cache:
+                self.assertEqual(cache.get(grid).solution, plain.solution)
+                self.assertIsNone(cache.get(BOARDS[0]))
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
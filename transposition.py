@@ -0,0 +1,191 @@
+'''
+This file contains a transposition table of failed search states for
+bt_search.
+
+1. TranspositionTable object
+    - Attach it with BT.set_transposition_table(table). bt_search then looks
+      up the state of every node after propagating its assignment, and skips
+      the node if the state is known to fail; when the search below a node
+      finds no solution, the node's state is stored as failed.
+    - Holds at most capacity states, evicting the least recently used.
+    - hit_rate() and memory_bytes() report its effectiveness and footprint;
+      as_dict() returns all its counters.
+
+The state of a node is what the rest of the search depends on: the current
+domains of the unassigned variables, the values of the assigned variables
+that still share a table (cage) constraint with an unassigned variable
+("open" variables), and for every unfinished all-different line the set of
+values used in it, whatever cells hold them. Two nodes reached by different
+assignment orders, or differing only in cells whose constraints are all
+complete, or only in where values sit in an unfinished line, have the same
+state; if one fails, so does the other.
+
+States are keyed by a 64-bit Zobrist hash: the XOR of a random key for every
+(unassigned variable, current value), (open variable, assigned value) and
+(unfinished line, used value) pair. The hash is updated incrementally on
+every assignment and pruning, and restored on undo. The number of
+unassigned variables of every constraint, and of unfinished table
+constraints of every variable, is tracked to know when a variable stops
+being open. Two different states share a hash with probability about 2^-64
+per pair; such a collision could wrongly skip a node.
+'''
+
+import collections
+import random
+import sys
+
+class TranspositionTable:
+    '''
+    Class for a bounded, LRU-evicted table of the Zobrist hashes of failed
+    search states. One table can be reused over several searches of the same
+    CSP; its entries are dropped when it is started on another CSP.
+    '''
+
+    def __init__(self, capacity=100000, seed=0):
+        self.capacity = capacity
+        self.rng = random.Random(seed)
+        self.entries = collections.OrderedDict() #hash -> None, LRU first
+        self.csp = None
+        self.reset()
+
+    def reset(self):
+        '''Drop every entry and clear the counters'''
+        self.entries.clear()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def start(self, csp):
+        '''
+        Start tracking the state of csp from its current assignment and
+        domains (called by bt_search before descending from the root).
+        '''
+        if csp is not self.csp:
+            self.reset()
+            self.csp = csp
+            rand = lambda: self.rng.getrandbits(64)
+            self.dom_keys = [{val: rand() for val in var.domain()}
+                             for var in csp.vars]
+            self.asgn_keys = [{val: rand() for val in var.domain()}
+                              for var in csp.vars]
+            self.line_keys = [dict() for c in csp.cons]
+            for c in csp.cons:
+                if c.alldiff:
+                    for var in c.scope:
+                        for val in var.domain():
+                            if val not in self.line_keys[c.id]:
+                                self.line_keys[c.id][val] = rand()
+
+        self.n_unasgn = [sum(1 for var in c.scope if not var.is_assigned())
+                         for c in csp.cons]
+        self.n_open = [sum(1 for c in csp.get_cons_with_var(var)
+                           if self.n_unasgn[c.id] and not c.alldiff)
+                       for var in csp.vars]
+        h = 0
+        for var in csp.vars:
+            if not var.is_assigned():
+                keys = self.dom_keys[var.id]
+                for val in var.cur_domain():
+                    h ^= keys[val]
+            elif self.n_open[var.id]:
+                h ^= self.asgn_keys[var.id][var.get_assigned_value()]
+        for c in csp.cons:
+            if c.alldiff and self.n_unasgn[c.id]:
+                for var in c.scope:
+                    if var.is_assigned():
+                        h ^= self.line_keys[c.id][var.get_assigned_value()]
+        self.hash = h
+        self.saved = [] #hash before each assignment, for undo
+
+    def assign(self, var, val):
+        '''
+        Update the hash for var = val. Called right after var.assign(val),
+        before propagation, while var's domain flags are unchanged.
+        '''
+        self.saved.append(self.hash)
+        h = self.hash
+        keys = self.dom_keys[var.id]
+        for i, d in enumerate(var.dom):
+            if var.curdom[i]:
+                h ^= keys[d]
+        n_unasgn, n_open = self.n_unasgn, self.n_open
+        for c in self.csp.get_cons_with_var(var):
+            n_unasgn[c.id] -= 1
+            if c.alldiff:
+                line_keys = self.line_keys[c.id]
+                if n_unasgn[c.id]:
+                    h ^= line_keys[val]
+                else:
+                    #the line is complete: drop the values used in it
+                    for u in c.scope:
+                        if u is not var:
+                            h ^= line_keys[u.get_assigned_value()]
+            elif n_unasgn[c.id] == 0:
+                #c is complete: its variables may stop being open
+                for u in c.scope:
+                    n_open[u.id] -= 1
+                    if n_open[u.id] == 0 and u is not var:
+                        h ^= self.asgn_keys[u.id][u.get_assigned_value()]
+        if n_open[var.id]:
+            h ^= self.asgn_keys[var.id][val]
+        self.hash = h
+
+    def prune(self, prunings):
+        '''Update the hash for the (var, val) pairs pruned by propagation'''
+        h = self.hash
+        keys = self.dom_keys
+        for var, val in prunings:
+            if not var.is_assigned():
+                h ^= keys[var.id][val]
+        self.hash = h
+
+    def unassign(self, var):
+        '''Undo assign(var, val) (and the prunings that followed it)'''
+        n_unasgn, n_open = self.n_unasgn, self.n_open
+        for c in self.csp.get_cons_with_var(var):
+            if n_unasgn[c.id] == 0 and not c.alldiff:
+                for u in c.scope:
+                    n_open[u.id] += 1
+            n_unasgn[c.id] += 1
+        self.hash = self.saved.pop()
+
+    def is_failed(self):
+        '''Return True iff the current state is stored as failed'''
+        self.lookups += 1
+        if self.hash in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(self.hash)
+            return True
+        return False
+
+    def add_failed(self):
+        '''Store the current state as failed, evicting the LRU entry if full'''
+        self.stores += 1
+        self.entries[self.hash] = None
+        self.entries.move_to_end(self.hash)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        '''Return the fraction of lookups that found a failed state'''
+        if not self.lookups:
+            return 0.0
+        return self.hits / self.lookups
+
+    def memory_bytes(self):
+        '''
+        Return the approximate memory used by the entries: the table itself
+        and the stored hashes.
+        '''
+        return sys.getsizeof(self.entries) + \
+               sum(sys.getsizeof(h) for h in self.entries)
+
+    def as_dict(self):
+        '''Return the counters of the table as a dictionary'''
+        return {'entries': len(self.entries), 'capacity': self.capacity,
+                'lookups': self.lookups, 'hits': self.hits,
+                'hit_rate': self.hit_rate(), 'stores': self.stores,
+                'evictions': self.evictions,
+                'memory_bytes': self.memory_bytes()}